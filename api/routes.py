@@ -2,12 +2,23 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional, Dict
 from database.connection import get_async_session
-from database.models import CurrentValues, Sensors, Events, Users, Role, ProductionLine, EquipmentSettings
+from database.models import CurrentValues, Sensors, Events, Users, Role, ProductionLine, SensorRollup
 from datetime import datetime, timedelta
 from sqlalchemy import func, select
 from api.schemas import SensorOverview, CurrentValueData, EventData, ExtruderSensorData, ExtruderStats
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 import json
+from metrics import metrics
+from processing.aggregator import RESOLUTIONS, rollup_resolution
+from processing.running_stats import get_running_stats
+from processing.metadata import get_metadata, is_extruder
+from processing.latest_values import get_latest_values
+from processing.spc import get_spc_engine
+from processing.analytics_executor import get_analytics_executor
+from processing import analytics_jobs
+import asyncio
+import numpy as np
 
 from mqtt.client import logger
 
@@ -21,6 +32,12 @@ SENSOR_UNITS = {
     "Сечение жилы": "мм²"
 }
 
+@router.get("/metrics")
+async def get_metrics():
+    """Внутренние метрики конвейера обработки (очереди, пропускная способность, задержки)"""
+    return metrics.snapshot()
+
+
 @router.get("/sensors", response_model=List[SensorOverview])
 async def get_sensors(db: AsyncSession = Depends(get_async_session)):
     """Получение списка всех датчиков"""
@@ -58,6 +75,146 @@ async def get_sensor_data(
     return readings
 
 
+@router.get("/sensors/stats")
+async def get_sensors_running_stats():
+    """Текущая статистика датчиков из памяти: окна 5 мин, 1 ч, смена и EWMA.
+    Ведется в процессе, записывающем показания: при MQTT_INGEST_WORKERS > 1 или
+    KAFKA_CONSUMER_MODE=processes в этом процессе она пуста"""
+    return get_running_stats().summary()
+
+
+@router.get("/sensors/{sensor_id}/stats")
+async def get_sensor_running_stats(sensor_id: int):
+    """Текущая статистика одного датчика из памяти"""
+    stats = get_running_stats().summary(sensor_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Нет показаний датчика")
+    return stats
+
+
+@router.get("/spc")
+async def get_spc_summary():
+    """Контрольные карты и индексы пригодности (Cp/Cpk, Pp/Ppk) по датчикам параметров качества.
+    Как и текущая статистика, ведутся только в процессе, записывающем показания"""
+    metadata = await get_metadata()
+    engine = get_spc_engine()
+    return [engine.summary(metadata, sensor_id) for sensor_id in sorted(engine.sensors)]
+
+
+@router.get("/spc/{sensor_id}")
+async def get_sensor_spc(sensor_id: int):
+    """Контрольные карты датчика с точками подгрупп и нарушениями правил Western Electric"""
+    summary = get_spc_engine().summary(await get_metadata(), sensor_id, detail=True)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Нет данных контрольных карт датчика")
+    return summary
+
+
+def packed_floats(column):
+    """Столбец выборки одним значением bytea: числа float8 подряд (big-endian), в порядке времени"""
+    return func.string_agg(func.float8send(sa.cast(column, sa.Float)),
+                           aggregate_order_by(sa.literal_column("''::bytea"), CurrentValues.time))
+
+
+async def load_sensor_series(db, sensor_id, from_time, to_time):
+    """Показания датчика за период в виде массивов NumPy (время в секундах эпохи, значения).
+    БД возвращает каждый столбец одним двоичным значением, поэтому строки показаний
+    не создаются в цикле событий"""
+    to_time = to_time or datetime.now()
+    from_time = from_time or to_time - timedelta(days=7)
+    result = await db.execute(
+        select(packed_floats(func.extract("epoch", CurrentValues.time)), packed_floats(CurrentValues.value))
+        .filter(CurrentValues.sensors_id == sensor_id, CurrentValues.time.between(from_time, to_time))
+    )
+    timestamps, values = result.one()
+    if not values:
+        raise HTTPException(status_code=404, detail="Данные не найдены")
+    return np.frombuffer(timestamps, dtype=">f8").astype(np.float64), np.frombuffer(values, dtype=">f8").astype(np.float64)
+
+
+async def run_analytics(job, *arrays, **kwargs):
+    """Запускает задачу в пуле процессов аналитики, не блокируя цикл событий"""
+    try:
+        return await get_analytics_executor().run(job, *arrays, **kwargs)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Превышено время расчета")
+
+
+@router.get("/analytics/sensors/{sensor_id}/statistics")
+async def get_sensor_long_range_statistics(
+        sensor_id: int,
+        from_time: Optional[datetime] = None,
+        to_time: Optional[datetime] = None,
+        bins: int = 50,
+        db: AsyncSession = Depends(get_async_session)
+):
+    """Статистика показаний датчика за длительный период (по умолчанию 7 дней): процентили и гистограмма"""
+    if bins <= 0:
+        raise HTTPException(status_code=400, detail="Число интервалов гистограммы должно быть положительным")
+    timestamps, values = await load_sensor_series(db, sensor_id, from_time, to_time)
+    return await run_analytics(analytics_jobs.long_range_statistics, timestamps, values, bins=bins)
+
+
+@router.get("/analytics/report")
+async def get_sensors_report(
+        from_time: Optional[datetime] = None,
+        to_time: Optional[datetime] = None,
+        bucket_seconds: int = 3600,
+        db: AsyncSession = Depends(get_async_session)
+):
+    """Отчет по всем датчикам за период (по умолчанию сутки): среднее, минимум и максимум по интервалам.
+    Собирается в БД из агрегатов окон (sensor_rollups), длина окна делит длину интервала"""
+    if bucket_seconds <= 0:
+        raise HTTPException(status_code=400, detail="Длина интервала должна быть положительной")
+    to_time = to_time or datetime.now()
+    from_time = from_time or to_time - timedelta(days=1)
+    longest = rollup_resolution((to_time - from_time).total_seconds())
+    resolution = max(r for r in RESOLUTIONS if r <= longest and bucket_seconds % r == 0)
+    # Длина интервала подставляется в запрос литералом: одно и то же выражение в SELECT и GROUP BY
+    bucket = sa.func.floor(sa.func.extract("epoch", SensorRollup.window_start) / sa.literal_column(str(int(bucket_seconds))))
+    result = await db.execute(
+        select(
+            SensorRollup.sensors_id,
+            bucket.label("bucket"),
+            func.sum(SensorRollup.count).label("count"),
+            func.sum(SensorRollup.sum).label("sum"),
+            func.min(SensorRollup.min).label("min"),
+            func.max(SensorRollup.max).label("max")
+        ).where(
+            SensorRollup.resolution == resolution,
+            SensorRollup.window_start >= from_time,
+            SensorRollup.window_start < to_time
+        ).group_by(SensorRollup.sensors_id, bucket)
+        .order_by(SensorRollup.sensors_id, bucket)
+    )
+    report = {}
+    for row in result.all():
+        count = int(row.count)
+        report.setdefault(row.sensors_id, []).append({
+            "start": float(row.bucket) * bucket_seconds,
+            "count": count,
+            "mean": row.sum / count,
+            "min": row.min,
+            "max": row.max,
+        })
+    return {"from": from_time.isoformat(), "to": to_time.isoformat(), "sensors": report}
+
+
+@router.get("/analytics/sensors/{sensor_id}/spectrum")
+async def get_sensor_spectrum(
+        sensor_id: int,
+        from_time: Optional[datetime] = None,
+        to_time: Optional[datetime] = None,
+        top: int = 10,
+        db: AsyncSession = Depends(get_async_session)
+):
+    """Спектральный анализ показаний датчика (например, периодические колебания толщины изоляции)"""
+    if top <= 0:
+        raise HTTPException(status_code=400, detail="Число частот должно быть положительным")
+    timestamps, values = await load_sensor_series(db, sensor_id, from_time, to_time)
+    return await run_analytics(analytics_jobs.spectrum, timestamps, values, top=top)
+
+
 @router.get("/alerts")
 async def get_alerts(
     from_time: Optional[datetime] = None,
@@ -115,65 +272,29 @@ async def get_alerts(
 async def get_extruder_dashboard(db: AsyncSession = Depends(get_async_session)):
     """Получение данных дашборда для экструдера"""
     try:
-        # Получаем последние показания всех датчиков экструдера
-        location_query = sa.select(ProductionLine.id).where(ProductionLine.name == "экструдер")
-        location_result = await db.execute(location_query)
-        location_id = location_result.scalar()
-        
-        if not location_id:
+        # Датчики, пределы и последние показания берутся из памяти, без запросов по каждому датчику
+        metadata = await get_metadata()
+        latest_values = await get_latest_values()
+        sensors = [meta for meta in metadata.values() if is_extruder(meta)]
+        if not sensors:
             raise HTTPException(status_code=404, detail="Местоположение 'экструдер' не найдено")
-        
-        # Получаем все датчики экструдера
-        sensors_query = sa.select(Sensors).where(Sensors.location == location_id, Sensors.active == True)
-        sensors_result = await db.execute(sensors_query)
-        sensors = sensors_result.scalars().all()
-        
+
         sensors_data = []
-        
-        for sensor in sensors:
-            # Получаем последнее показание датчика
-            latest_reading_query = sa.select(CurrentValues).where(
-                CurrentValues.sensors_id == sensor.id
-            ).order_by(CurrentValues.time.desc()).limit(1)
-            
-            latest_reading_result = await db.execute(latest_reading_query)
-            latest_reading = latest_reading_result.scalar_one_or_none()
-            
-            # Получаем настройки датчика
-            settings_query = sa.select(EquipmentSettings).where(
-                EquipmentSettings.sensor_id == sensor.id
-            )
-            settings_result = await db.execute(settings_query)
-            settings = settings_result.scalar_one_or_none()
-            
-            # Получаем имя местоположения
-            location_name_query = sa.select(ProductionLine.name).where(
-                ProductionLine.id == sensor.location
-            )
-            location_name_result = await db.execute(location_name_query)
-            location_name = location_name_result.scalar_one_or_none() or "Неизвестно"
-            
-            if latest_reading:
-                # Проверяем статус показания
-                status = "normal"
-                if settings:
-                    if latest_reading.value < settings.min_value:
-                        status = "low"
-                    elif latest_reading.value > settings.max_value:
-                        status = "high"
-                
+        for meta in sensors:
+            latest = latest_values.get(meta.sensor_id)
+            if meta.active and latest is not None:
                 sensors_data.append({
-                    "id": sensor.id,
-                    "sensor_name": sensor.sensor_name,
-                    "location": location_name,
-                    "value": float(latest_reading.value),
-                    "time": latest_reading.time.isoformat(),
-                    "min_value": float(settings.min_value) if settings else None,
-                    "max_value": float(settings.max_value) if settings else None,
-                    "unit": SENSOR_UNITS.get(sensor.sensor_name, ""),
-                    "status": status
+                    "id": meta.sensor_id,
+                    "sensor_name": meta.sensor_name,
+                    "location": meta.location_name,
+                    "value": latest.value,
+                    "time": latest.time.isoformat(),
+                    "min_value": meta.min_value,
+                    "max_value": meta.max_value,
+                    "unit": SENSOR_UNITS.get(meta.sensor_name, ""),
+                    "status": latest.status
                 })
-        
+
         # Получаем последние 5 событий/оповещений
         events_query = sa.select(Events, Sensors.sensor_name).join(
             Sensors, Events.sensors_id == Sensors.id
@@ -227,43 +348,37 @@ async def get_extruder_statistics(
         sensors_result = await db.execute(sensors_query)
         sensors = {s.sensor_name: s.id for s in sensors_result.scalars().all()}
         
+        # Статистика собирается из агрегатов окон (sensor_rollups), а не из всех показаний:
+        # длина окна выбирается так, чтобы погрешность на границах периода не превышала 1%
+        resolution = rollup_resolution((to_time - from_time).total_seconds())
+        stats_query = sa.select(
+            SensorRollup.sensors_id,
+            sa.func.sum(SensorRollup.count).label("count"),
+            sa.func.sum(SensorRollup.sum).label("sum"),
+            sa.func.min(SensorRollup.min).label("min"),
+            sa.func.max(SensorRollup.max).label("max"),
+            sa.func.sum(SensorRollup.out_of_range).label("out_of_range")
+        ).where(
+            SensorRollup.resolution == resolution,
+            SensorRollup.sensors_id.in_(list(sensors.values())),
+            SensorRollup.window_start >= from_time,
+            SensorRollup.window_start < to_time
+        ).group_by(SensorRollup.sensors_id)
+        stats_result = await db.execute(stats_query)
+        stats = {row.sensors_id: row for row in stats_result.all()}
+
         result = {}
         
         # Для каждого типа датчика получаем статистику
         for sensor_name, sensor_id in sensors.items():
-            # Получаем показания за период
-            readings_query = sa.select(
-                CurrentValues.time, 
-                CurrentValues.value
-            ).where(
-                CurrentValues.sensors_id == sensor_id,
-                CurrentValues.time.between(from_time, to_time)
-            ).order_by(CurrentValues.time)
-            
-            readings_result = await db.execute(readings_query)
-            readings = readings_result.all()
-            
-            # Вычисляем статистику
-            values = [float(r.value) for r in readings]
+            row = stats.get(sensor_id)
+            readings_count = int(row.count) if row is not None and row.count else 0
             
-            if values:
-                avg_value = sum(values) / len(values)
-                min_value = min(values)
-                max_value = max(values)
-                
-                # Получаем настройки для проверки отклонений
-                settings_query = sa.select(EquipmentSettings).where(
-                    EquipmentSettings.sensor_id == sensor_id
-                )
-                settings_result = await db.execute(settings_query)
-                settings = settings_result.scalar_one_or_none()
-                
-                # Считаем отклонения, если есть настройки
-                deviations = 0
-                if settings:
-                    for value in values:
-                        if value < settings.min_value or value > settings.max_value:
-                            deviations += 1
+            if readings_count:
+                avg_value = row.sum / readings_count
+                min_value = row.min
+                max_value = row.max
+                deviations = int(row.out_of_range)
                 
                 # Выбираем ключ для словаря статистики
                 key = sensor_name.lower().replace(" ", "_")
@@ -289,8 +404,8 @@ async def get_extruder_statistics(
                     "max_value": round(max_value, 2),
                     "unit": SENSOR_UNITS.get(sensor_name, ""),
                     "deviations": deviations,
-                    "deviation_percent": round(deviations / len(values) * 100, 1) if values else 0,
-                    "readings_count": len(values)
+                    "deviation_percent": round(deviations / readings_count * 100, 1),
+                    "readings_count": readings_count
                 }
             else:
                 result[sensor_name.lower().replace(" ", "_")] = {
@@ -312,67 +427,28 @@ async def get_extruder_statistics(
 
 
 @router.get("/sensors/latest")
-async def get_latest_sensor_data(db: AsyncSession = Depends(get_async_session)):
+async def get_latest_sensor_data():
+    """Последние показания датчиков из памяти; из БД загружаются только при холодном старте"""
     try:
-        # Подзапрос для получения последнего времени для каждого датчика
-        latest_time_subquery = sa.select(
-            CurrentValues.sensors_id,
-            sa.func.max(CurrentValues.time).label("latest_time")
-        ).group_by(CurrentValues.sensors_id).subquery()
-        
-        # Основной запрос с джойнами для получения всей информации
-        query = sa.select(
-            CurrentValues, 
-            Sensors.sensor_name, 
-            ProductionLine.name.label("location_name"),
-            EquipmentSettings.min_value,
-            EquipmentSettings.max_value
-        ).join(
-            latest_time_subquery,
-            sa.and_(
-                CurrentValues.sensors_id == latest_time_subquery.c.sensors_id,
-                CurrentValues.time == latest_time_subquery.c.latest_time
-            )
-        ).join(
-            Sensors, CurrentValues.sensors_id == Sensors.id
-        ).join(
-            ProductionLine, Sensors.location == ProductionLine.id
-        ).outerjoin(
-            EquipmentSettings, Sensors.id == EquipmentSettings.sensor_id
-        ).order_by(ProductionLine.name, Sensors.sensor_name)
-        
-        result = await db.execute(query)
-        rows = result.all()
-        
-        return [
-            {
-                "sensor_id": row.CurrentValues.sensors_id,
-                "sensor_name": row.sensor_name,
-                "location": row.location_name,
-                "value": float(row.CurrentValues.value),
-                "time": row.CurrentValues.time.isoformat(),
-                "min_value": float(row.min_value) if row.min_value is not None else None,
-                "max_value": float(row.max_value) if row.max_value is not None else None,
-                "unit": SENSOR_UNITS.get(row.sensor_name, ""),
-                "status": get_sensor_status(float(row.CurrentValues.value), row.min_value, row.max_value)
-            }
-            for row in rows
-        ]
+        metadata = await get_metadata()
+        latest_values = await get_latest_values()
+        rows = []
+        for meta in sorted(metadata.values(), key=lambda meta: (meta.location_name, meta.sensor_name)):
+            latest = latest_values.get(meta.sensor_id)
+            if latest is None:
+                continue
+            rows.append({
+                "sensor_id": meta.sensor_id,
+                "sensor_name": meta.sensor_name,
+                "location": meta.location_name,
+                "value": latest.value,
+                "time": latest.time.isoformat(),
+                "min_value": meta.min_value,
+                "max_value": meta.max_value,
+                "unit": SENSOR_UNITS.get(meta.sensor_name, ""),
+                "status": latest.status
+            })
+        return rows
     except Exception as e:
         logger.error(f"Ошибка получения данных датчиков: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-
-
-def get_sensor_status(value, min_value, max_value):
-    # Функция для определения статуса датчика с учетом возможных None-значений
-    try:
-        # Проверяем условия только если значения не None
-        if min_value is not None and value < min_value:
-            return "low"
-        elif max_value is not None and value > max_value:
-            return "high"
-        else:
-            return "normal"
-    except (ValueError, TypeError):
-        # В случае ошибки конвертации возвращаем "normal"
-        return "normal"
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""Микробенчмарк декодирования сообщений датчиков: прежний путь против ReadingDecoder
+
+Запуск: python benchmarks/decode_benchmark.py [--count 200000]
+"""
+import argparse
+import json
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mqtt.router import DEFAULT_ROUTES
+from processing.decoder import ReadingDecoder, orjson
+
+
+def make_payload():
+    # Сообщение в формате simulator.py
+    return json.dumps({
+        "sensor_id": 1,
+        "timestamp": datetime.now().isoformat(),
+        "unit": "°C",
+        "sensor_name": "Температура экструдера",
+        "temperature": 171.4
+    }).encode()
+
+
+def legacy_decode(payload):
+    """Прежний путь: bytes -> str -> json.loads -> перебор ключей значения"""
+    data = json.loads(payload.decode())
+    if "sensor_id" in data:
+        sensor_id = data["sensor_id"]
+    elif "id" in data:
+        sensor_id = data["id"]
+    else:
+        return None
+    numeric_value = None
+    for key in ['value', 'temperature', 'move_speed', 'isolation_thickness', 'cable_core_profile']:
+        if key in data and isinstance(data[key], (int, float)):
+            numeric_value = data[key]
+            break
+    return sensor_id, numeric_value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк декодирования сообщений датчиков')
+    parser.add_argument('--count', type=int, default=200000, help='Количество сообщений на замер')
+    args = parser.parse_args()
+
+    payload = make_payload()
+    route = DEFAULT_ROUTES["extruder/temperature/#"]
+
+    cases = {
+        "прежний путь (json)": lambda: legacy_decode(payload),
+        "ReadingDecoder (json)": lambda d=ReadingDecoder("json"): d.decode(payload, route),
+    }
+    if orjson is not None:
+        cases["ReadingDecoder (orjson)"] = lambda d=ReadingDecoder("orjson"): d.decode(payload, route)
+    else:
+        print("orjson не установлен, замер для него пропущен")
+
+    print(f"Размер сообщения: {len(payload)} байт, сообщений на замер: {args.count}")
+    baseline = None
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=args.count, repeat=3))
+        rate = args.count / seconds
+        baseline = baseline or rate
+        print(f"{name:28s} {seconds * 1e9 / args.count:8.0f} нс/сообщ. {rate:12.0f} сообщ./с  x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
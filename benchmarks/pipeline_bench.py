@@ -0,0 +1,104 @@
+"""Бенчмарк конвейера: шина отдельно, шина с декодированием и полный путь до БД
+
+Запуск: python benchmarks/pipeline_bench.py [--count 200000] [--backend memory|kafka] [--format json|binary] [--db]
+По умолчанию используется шина в памяти, Kafka и Zookeeper не нужны.
+Замер с --db пишет показания в БД из .env.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import config
+from kafka.bus import create_producer, create_consumer
+from kafka.consumer import decode_records
+from kafka.producer import serialize_key
+from processing.wire import encode_frame
+
+TOPIC_PREFIX = "bench_extruder_temperature"
+
+
+def make_messages(count, fmt, pack):
+    """Сообщения в формате simulator.py: JSON по одному или двоичные кадры по pack показаний"""
+    now = time.time()
+    if fmt == "binary":
+        return [
+            (encode_frame((1 + j % 4, now + i + j / 1000, 170.0) for j in range(pack)), 1)
+            for i in range(0, count, pack)
+        ]
+    return [
+        (json.dumps({"sensor_id": 1 + i % 4, "timestamp": now + i / 1000, "temperature": 170.0}).encode(), 1 + i % 4)
+        for i in range(count)
+    ]
+
+
+async def run_stage(name, messages, readings, handler=None):
+    """Публикует сообщения и читает их консьюмером группы, handler получает каждый пакет"""
+    # Отдельный топик и группа на замер: консьюмер читает только свои сообщения
+    topic = f"{TOPIC_PREFIX}_{time.monotonic_ns()}"
+    producer = create_producer(key_serializer=serialize_key)
+    consumer = create_consumer(topic, group_id=f"bench-{topic}", enable_auto_commit=False,
+                               auto_offset_reset="earliest", max_poll_records=config.KAFKA_CONSUMER_BATCH_SIZE)
+    await producer.start()
+    await consumer.start()
+    try:
+        started = time.perf_counter()
+        futures = [await producer.send(topic, value, key=key) for value, key in messages]
+        await asyncio.gather(*futures)
+        produced = time.perf_counter() - started
+
+        received = 0
+        while received < len(messages):
+            batch = await consumer.getmany(timeout_ms=1000, max_records=config.KAFKA_CONSUMER_BATCH_SIZE)
+            if not batch:
+                print(f"{name}: сообщения перестали поступать, получено {received} из {len(messages)}")
+                break
+            records = [record for partition_records in batch.values() for record in partition_records]
+            if handler is not None:
+                await handler(records)
+            await consumer.commit()
+            received += len(records)
+        total = time.perf_counter() - started
+    finally:
+        await consumer.stop()
+        await producer.stop()
+
+    print(f"{name:28s} публикация {len(messages) / produced:10.0f} сообщ./с, "
+          f"сквозной путь {received / total:10.0f} сообщ./с, "
+          f"{readings * received / len(messages) / total:10.0f} показ./с ({total:.2f} с)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк конвейера обработки показаний')
+    parser.add_argument('--count', type=int, default=200000, help='Количество показаний')
+    parser.add_argument('--backend', choices=['memory', 'kafka'], default='memory', help='Шина сообщений')
+    parser.add_argument('--format', choices=['json', 'binary'], default='json', help='Формат сообщений')
+    parser.add_argument('--pack', type=int, default=100, help='Показаний в двоичном кадре')
+    parser.add_argument('--db', action='store_true', help='Добавить замер с записью в БД')
+    args = parser.parse_args()
+
+    config.BUS_BACKEND = args.backend
+    messages = make_messages(args.count, args.format, args.pack)
+    print(f"Шина: {args.backend}, формат: {args.format}, показаний: {args.count}, сообщений: {len(messages)}")
+
+    await run_stage("шина", messages, args.count)
+
+    async def decode(records):
+        decode_records(records)
+    await run_stage("шина + декодирование", messages, args.count, decode)
+
+    if args.db:
+        from processing.data_processor import process_batch
+
+        async def write(records):
+            readings, alerts = decode_records(records)
+            await process_batch(readings, alerts)
+        await run_stage("шина + декодирование + БД", messages, args.count, write)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,4 @@
+import tempfile
 from pathlib import Path
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -10,16 +11,89 @@ class Settings(BaseSettings):
     DB_USER: str
     DB_PASS: str
     DB_NAME: str
+    DB_ECHO: bool = False  # Вывод всех SQL-запросов в журнал (для отладки)
+    TELEMETRY_WRITE_METHOD: str = "copy"  # copy - COPY через asyncpg, insert - многострочный INSERT
+    TELEMETRY_WRITE_RETRIES: int = 3  # Повторов записи пакета при временной ошибке БД
+    TELEMETRY_RETRY_DELAY: float = 0.5  # Пауза перед первым повтором, секунды; далее удваивается
 
     MQTT_BROKER: str
     MQTT_PORT: int
     MQTT_USERNAME: str
     MQTT_PASSWORD: str
     MQTT_QOS: int
+    MQTT_QUEUE_MAXSIZE: int = 10000
+    INGEST_OVERLOAD_POLICY: str = "block"  # block, drop_oldest или coalesce (последнее показание по датчику)
+    INGEST_QUEUE_HIGH_WATER: float = 0.8  # Доля MQTT_QUEUE_MAXSIZE, с которой очередь считается перегруженной
+    INGEST_QUEUE_LOW_WATER: float = 0.5  # Доля, до которой очередь должна опустеть для выхода из перегрузки
+    MQTT_RECONNECT_INTERVAL: int = 5
+    MQTT_INGEST_WORKERS: int = 1
+    MQTT_SHARED_GROUP: str = "ingest"
+    MQTT_WORKER_STATS_INTERVAL: int = 5
+    ROUTER_RELOAD_INTERVAL: int = 30
+    ROUTER_CACHE_SIZE: int = 100000
 
+    METADATA_TTL_SECONDS: int = 300  # Перезагрузка кэша метаданных датчиков без уведомлений
+    METADATA_RETRY_INTERVAL: int = 5
+    ALERT_HYSTERESIS: float = 0.02  # Доля диапазона, на которую значение должно вернуться внутрь пределов
+    ALERT_MIN_DURATION_SECONDS: float = 0  # Отклонения короче не регистрируются
+    ALERT_CLEAR_DURATION_SECONDS: float = 0  # Сколько значение должно быть в норме до закрытия отклонения
+    ALERT_DEVICE_STALE_SECONDS: float = 300  # Закрытие отклонения, открытого оповещением, если нет ни показаний, ни новых оповещений
+    ROLLUP_FLUSH_INTERVAL: int = 1
+    ROLLUP_LATENESS_SECONDS: int = 5  # Сколько ждать опоздавшие показания перед записью окна
+    ROLLUP_BACKFILL_ON_STARTUP: bool = True  # Один раз построить при запуске агрегаты по показаниям, сохраненным до агрегатора
+    ANOMALY_ENABLED: bool = True
+    ANOMALY_MAX_SENSORS: int = 1024  # Память буферов: ANOMALY_MAX_SENSORS * ANOMALY_WINDOW * 8 байт
+    ANOMALY_WINDOW: int = 256
+    ANOMALY_MIN_SAMPLES: int = 30
+    ANOMALY_Z_THRESHOLD: float = 4.0
+    ANOMALY_EWMA_LAMBDA: float = 0.2
+    ANOMALY_EWMA_WIDTH: float = 3.5
+    ANOMALY_COOLDOWN_SECONDS: int = 60
+    SPC_SUBGROUP_SIZE: int = 5  # Последовательных показаний в подгруппе, от 2 до 10
+    SPC_WINDOW_SUBGROUPS: int = 100  # Подгрупп, по которым рассчитываются границы карт и индексы
+    SPC_MIN_SUBGROUPS: int = 20  # Подгрупп до начала проверки правил
+    SPC_SENSOR_TYPES: str = "isolation_thickness,cable_core_profile"  # Типы датчиков-параметров качества, пусто - все
+    SPC_COOLDOWN_SECONDS: int = 300
+    LATEST_VALUES_REFRESH_SECONDS: float = 1  # Перечитывание последних показаний из БД, если их пишут другие процессы
+    ANALYTICS_WORKERS: int = 2  # Процессов для тяжелой аналитики
+    ANALYTICS_TIMEOUT_SECONDS: int = 30
+    STATS_EWMA_ALPHA: float = 0.1
+    SHIFT_HOURS: int = 8
+    SHIFT_START_HOUR: int = 0  # Начало первой смены суток
+    INGEST_MODE: str = "direct"  # direct - в БД пишет MQTT-клиент, kafka - консьюмеры Kafka, both - оба с отсевом повторов
+    INGEST_BATCH_SIZE: int = 500
+    PIPELINE_STAGES: str = "dedup,validate,enrich,alert,spc,persist,aggregate,latest"  # Стадии обработки пакета по порядку
+    DEDUP_WINDOW_SECONDS: int = 300
+    DEDUP_WINDOW_SIZE: int = 200000
+    PAYLOAD_JSON_BACKEND: str = "auto"  # auto, orjson или json
+    INGEST_BATCH_LINGER_MS: int = 50
+
+    BUS_BACKEND: str = "kafka"  # kafka или memory - брокер в памяти процесса для тестов и бенчмарков
+    BUS_MEMORY_PARTITIONS: int = 4
+    BUS_MEMORY_RETENTION: int = 100000  # Записей на партицию
     KAFKA_BOOTSTRAP_SERVERS: str
     KAFKA_MAX_BATCH_SIZE: int
     KAFKA_LINGER_MS: int
+    KAFKA_PRODUCER_MODE: str = "async"  # async - без ожидания подтверждений, wait - ждать каждый пакет
+    KAFKA_COMPRESSION: str = ""  # gzip, snappy, lz4, zstd или пусто
+    KAFKA_ACKS: int = 1  # 0, 1 или -1 (все реплики)
+    # Каталог спула неотправленных сообщений (относительный - от каталога проекта), пусто - без спула.
+    # По умолчанию во временном каталоге: каталог проекта в контейнере недоступен для записи appuser
+    KAFKA_SPOOL_DIR: str = str(Path(tempfile.gettempdir(), "extruder-spool"))
+    KAFKA_SPOOL_SEGMENT_BYTES: int = 16 * 1024 * 1024
+    KAFKA_SPOOL_MAX_BYTES: int = 1024 * 1024 * 1024
+    KAFKA_SPOOL_REPLAY_INTERVAL: int = 5
+    KAFKA_SPOOL_FSYNC: bool = False
+    KAFKA_CONSUMER_GROUP: str = "extruder-processing"
+    KAFKA_CONSUMER_COUNT: int = 1
+    KAFKA_CONSUMER_MODE: str = "tasks"  # tasks - задачи в этом процессе, processes - отдельные процессы
+    KAFKA_CONSUMER_BATCH_SIZE: int = 500  # Сообщений за один getmany(), 1 - по одному
+    KAFKA_CONSUMER_BATCH_TIMEOUT_MS: int = 200
+    KAFKA_CONSUMER_RETRY_INTERVAL: int = 5  # Пауза перед повторной обработкой пакета после ошибки
+    KAFKA_CONSUMER_RESTART_MAX_DELAY: int = 60  # Наибольшая пауза перед перезапуском консьюмера после ошибки
+    KAFKA_CONSUMER_MAX_RETRIES: int = 3  # Повторов пакета при постоянной ошибке до поиска сбойных сообщений
+    KAFKA_DEAD_LETTER_TOPIC: str = "dead_letter"  # Топик для необрабатываемых сообщений, пусто - только в журнал
+    KAFKA_WIRE_FORMAT: str = "passthrough"  # passthrough - как пришло из MQTT, binary - двоичные кадры
 
     SECRET_KEY: str
     ALGORITHM: str
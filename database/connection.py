@@ -1,9 +1,41 @@
-from database.models import Role, Users, Sensors, CurrentValues, EquipmentSettings, Events, ProductionLine
+from database.models import Role, Users, Sensors, CurrentValues, EquipmentSettings, Events, ProductionLine, SensorRollup, RollupBackfill
 from database.data_base import async_session, engine, Base
 import logging
+from sqlalchemy import text
 
 logger = logging.getLogger(__name__)
 
+# Изменения после первой версии схемы (create_all не изменяет существующие таблицы)
+SCHEMA_MIGRATIONS = [
+    "ALTER TABLE sensors ADD COLUMN IF NOT EXISTS mqtt_topic VARCHAR",
+    "ALTER TABLE sensors ADD COLUMN IF NOT EXISTS kafka_topic VARCHAR",
+    "ALTER TABLE sensors ADD COLUMN IF NOT EXISTS value_key VARCHAR",
+    # Ключ значения стандартных датчиков, созданных до появления столбца: по нему SPC выбирает
+    # датчики параметров качества, а проверка показаний - физически допустимые значения
+    """UPDATE sensors SET value_key = CASE sensor_name
+        WHEN 'Температура экструдера' THEN 'temperature'
+        WHEN 'Скорость протяжки' THEN 'move_speed'
+        WHEN 'Толщина изоляции' THEN 'isolation_thickness'
+        WHEN 'Сечение жилы' THEN 'cable_core_profile'
+    END
+    WHERE value_key IS NULL
+      AND sensor_name IN ('Температура экструдера', 'Скорость протяжки', 'Толщина изоляции', 'Сечение жилы')""",
+    "ALTER TABLE events ADD COLUMN IF NOT EXISTS event_type VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_current_values_sensor_time ON current_values (sensors_id, time)",
+    # Уведомление кэша метаданных (processing/metadata.py) об изменении датчиков и пределов
+    """CREATE OR REPLACE FUNCTION notify_sensor_metadata() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('sensor_metadata', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql""",
+] + [
+    f"""CREATE OR REPLACE TRIGGER {table}_metadata_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_sensor_metadata()"""
+    for table in ("sensors", "equipment_settings", "production_line")
+]
+
 
 def connection(func):
     async def wrapper(*args, **kwargs):
@@ -29,4 +61,13 @@ async def get_async_session():
 
 async def create_tables():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def migrate_schema():
+    """Создает новые таблицы и добавляет в существующие столбцы из новых версий схемы"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_MIGRATIONS:
+            await conn.execute(text(statement))
+    logger.info("Схема БД обновлена")
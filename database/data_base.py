@@ -4,7 +4,7 @@ from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine, AsyncSession
 from config import config
 
-engine = create_async_engine(url=config.DATABASE_URL, echo=True, pool_size=5, max_overflow=10, pool_timeout=60)
+engine = create_async_engine(url=config.DATABASE_URL, echo=config.DB_ECHO, pool_size=5, max_overflow=10, pool_timeout=60)
 async_session = async_sessionmaker(engine, class_=AsyncSession)
 
 
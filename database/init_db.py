@@ -7,7 +7,8 @@ from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy import select
 
-from database.connection import engine, async_session
+from database.connection import engine, async_session, migrate_schema
+from processing.aggregator import prepare_rollup_backfill, backfill_rollups
 from database.models import Role, Users, Sensors, CurrentValues, EquipmentSettings, Events, ProductionLine, Base
 
 
@@ -32,10 +33,16 @@ LOCATIONS = [
 
 # Датчики экструдера из таблицы
 SENSORS = [
-    {"sensor_name": "Температура экструдера", "location": "Экструдер", "active": True},
-    {"sensor_name": "Скорость протяжки", "location": "Экструдер", "active": True},
-    {"sensor_name": "Толщина изоляции", "location": "Экструдер", "active": True},
-    {"sensor_name": "Сечение жилы", "location": "Экструдер", "active": True}
+    {"sensor_name": "Температура экструдера", "location": "Экструдер", "active": True,
+     "mqtt_topic": "extruder/temperature/#", "kafka_topic": "extruder_temperature", "value_key": "temperature"},
+    {"sensor_name": "Скорость протяжки", "location": "Экструдер", "active": True,
+     "mqtt_topic": "extruder/move_speed/#", "kafka_topic": "extruder_move_speed", "value_key": "move_speed"},
+    {"sensor_name": "Толщина изоляции", "location": "Экструдер", "active": True,
+     "mqtt_topic": "extruder/isolation_thickness/#", "kafka_topic": "extruder_isolation_thickness",
+     "value_key": "isolation_thickness"},
+    {"sensor_name": "Сечение жилы", "location": "Экструдер", "active": True,
+     "mqtt_topic": "extruder/cable_core_profile/#", "kafka_topic": "extruder_cable_core_profile",
+     "value_key": "cable_core_profile"}
 ]
 
 # Настройки для датчиков экструдера
@@ -60,7 +67,6 @@ async def create_tables():
         await conn.run_sync(Base.metadata.create_all)
         logger.info("Таблицы успешно созданы.")
 
-
 async def create_roles():
     async with async_session() as session:
         try:
@@ -175,7 +181,10 @@ async def create_sensors(locations):
                 sensor = Sensors(
                     sensor_name=sensor_data["sensor_name"],
                     location=location_id,
-                    active=sensor_data["active"]
+                    active=sensor_data["active"],
+                    mqtt_topic=sensor_data["mqtt_topic"],
+                    kafka_topic=sensor_data["kafka_topic"],
+                    value_key=sensor_data["value_key"]
                 )
                 sensors.append(sensor)
                 session.add(sensor)
@@ -236,6 +245,30 @@ async def create_equipment_settings(sensors):
             logger.error(f"Ошибка при создании настроек оборудования: {e}")
             raise
 
+async def update_sensor_routes():
+    """Заполняет топики MQTT/Kafka для датчиков, созданных до появления этих столбцов"""
+    async with async_session() as session:
+        try:
+            updated = 0
+            for sensor_data in SENSORS:
+                query = select(Sensors).where(
+                    Sensors.sensor_name == sensor_data["sensor_name"],
+                    Sensors.mqtt_topic.is_(None)
+                )
+                result = await session.execute(query)
+                for sensor in result.scalars().all():
+                    sensor.mqtt_topic = sensor_data["mqtt_topic"]
+                    sensor.kafka_topic = sensor_data["kafka_topic"]
+                    sensor.value_key = sensor_data["value_key"]
+                    updated += 1
+
+            await session.commit()
+            logger.info(f"Обновлено маршрутов датчиков: {updated}")
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Ошибка при обновлении маршрутов датчиков: {e}")
+            raise
+
 # Датчиков у нас нет, поэтому делаем вид, что есть
 async def generate_sensor_readings():
     async with async_session() as session:
@@ -302,12 +335,17 @@ async def generate_sensor_readings():
 async def main():
     try:
         await create_tables()
+        await migrate_schema()
         roles = await create_roles()
         await create_users(roles)
         locations = await create_locations()
         sensors = await create_sensors(locations)
+        await update_sensor_routes()
         await create_equipment_settings(sensors)
         await generate_sensor_readings()
+        cutoff_id = await prepare_rollup_backfill()
+        if cutoff_id is not None:
+            await backfill_rollups(cutoff_id)
 
         logger.info("БД инициализована.")
 
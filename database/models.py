@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, create_engine, BigInteger
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, create_engine, BigInteger, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import datetime
@@ -36,6 +36,9 @@ class Sensors(Base):
     sensor_name = Column(String, nullable=False)
     location = Column(BigInteger)
     active = Column(Boolean, default=True)
+    mqtt_topic = Column(String)  # Шаблон MQTT топика (допускаются + и #)
+    kafka_topic = Column(String)
+    value_key = Column(String)  # Ключ значения в сообщении датчика
 
     current_values = relationship("CurrentValues", back_populates="sensor")
     equipment_settings = relationship("EquipmentSettings", back_populates="sensor")
@@ -44,6 +47,8 @@ class Sensors(Base):
 
 class CurrentValues(Base):
     __tablename__ = "current_values"
+    # Последние показания датчика (кэш последних значений, выборки за период)
+    __table_args__ = (Index("ix_current_values_sensor_time", "sensors_id", "time"),)
 
     id = Column(BigInteger, primary_key=True)
     sensors_id = Column(BigInteger, ForeignKey("sensors.id"), nullable=False)
@@ -53,6 +58,31 @@ class CurrentValues(Base):
     sensor = relationship("Sensors", back_populates="current_values")
 
 
+class SensorRollup(Base):
+    """Агрегаты показаний датчика за окно фиксированной длины (1 с, 1 мин, 1 ч)"""
+    __tablename__ = "sensor_rollups"
+    __table_args__ = (UniqueConstraint("sensors_id", "resolution", "window_start"),)
+
+    id = Column(BigInteger, primary_key=True)
+    sensors_id = Column(BigInteger, ForeignKey("sensors.id"), nullable=False)
+    resolution = Column(Integer, nullable=False)  # Длина окна, секунды
+    window_start = Column(DateTime, nullable=False, index=True)
+    count = Column(BigInteger, nullable=False)
+    sum = Column(Float, nullable=False)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+    out_of_range = Column(BigInteger, nullable=False, default=0)
+
+
+class RollupBackfill(Base):
+    """Отметка построения агрегатов по показаниям, сохраненным до запуска агрегатора (одна строка)"""
+    __tablename__ = "rollup_backfill"
+
+    id = Column(Integer, primary_key=True)
+    cutoff_id = Column(BigInteger)  # Агрегаты строятся по показаниям с id не больше этого
+    done = Column(Boolean, nullable=False, default=False)
+
+
 class EquipmentSettings(Base):
     __tablename__ = 'equipment_settings'
 
@@ -72,6 +102,7 @@ class Events(Base):
     description = Column(String)
     sensors_id = Column(BigInteger, ForeignKey("sensors.id"))
     users_id = Column(BigInteger, ForeignKey("users.id"))
+    event_type = Column(String)  # excursion_open, excursion_close, device_alert, anomaly; пусто - прочие события
 
     sensor = relationship("Sensors", back_populates="events")
     user = relationship("Users", back_populates="events")
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+import asyncpg
+from sqlalchemy import insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from config import config
+from metrics import metrics
+from database.data_base import async_session
+from database.models import CurrentValues
+
+logger = logging.getLogger(__name__)
+
+# Столбцы current_values, заполняемые при записи показаний
+COPY_COLUMNS = ("sensors_id", "value", "time")
+
+# Ошибки, после которых запись повторяется: потеря соединения, перегрузка или перезапуск сервера,
+# конфликт транзакций (взаимоблокировка, сериализация), нет свободного соединения в пуле
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    PoolTimeoutError,
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.TransactionRollbackError,
+    asyncpg.exceptions.InsufficientResourcesError,
+    asyncpg.exceptions.OperatorInterventionError,
+)
+
+flush_ms = metrics.histogram("telemetry_flush_ms")
+rows_meter = metrics.meter("telemetry_rows")
+retries_counter = metrics.counter("telemetry_retries")
+failures_counter = metrics.counter("telemetry_failures")
+
+
+def is_transient(error):
+    """Проверяет ошибку и ее причины (SQLAlchemy оборачивает ошибки драйвера)"""
+    while error is not None:
+        if isinstance(error, TRANSIENT_ERRORS) or getattr(error, "connection_invalidated", False):
+            return True
+        error = error.__cause__
+    return False
+
+
+async def copy_readings(session, readings):
+    """Записывает показания командой COPY в транзакции сессии"""
+    connection = await session.connection()
+    # Адаптер SQLAlchemy открывает транзакцию asyncpg только при первом запросе, а COPY выполняется
+    # самим драйвером: без этого показания записались бы вне транзакции с событиями
+    await connection.exec_driver_sql("SELECT 1")
+    raw = await connection.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        CurrentValues.__tablename__,
+        columns=COPY_COLUMNS,
+        records=[(reading.sensor_id, reading.value, reading.time) for reading in readings]
+    )
+
+
+async def insert_readings(session, readings):
+    """Записывает показания одной многострочной вставкой"""
+    await session.execute(insert(CurrentValues), [
+        {"sensors_id": reading.sensor_id, "value": reading.value, "time": reading.time}
+        for reading in readings
+    ])
+
+
+async def write_telemetry(readings, events=()):
+    """Записывает показания (COPY или INSERT, по TELEMETRY_WRITE_METHOD) и события одной транзакцией.
+    Временные ошибки повторяются TELEMETRY_WRITE_RETRIES раз с удваивающейся паузой, остальные - исключение"""
+    write = copy_readings if config.TELEMETRY_WRITE_METHOD == "copy" else insert_readings
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    if readings:
+                        await write(session, readings)
+                    session.add_all(events)
+        except Exception as e:
+            if attempt >= config.TELEMETRY_WRITE_RETRIES or not is_transient(e):
+                failures_counter.inc()
+                raise
+            delay = config.TELEMETRY_RETRY_DELAY * 2 ** attempt
+            attempt += 1
+            retries_counter.inc()
+            logger.warning(f"Ошибка записи показаний ({len(readings)}), попытка {attempt} через {delay} с: {e}")
+            await asyncio.sleep(delay)
+            continue
+        flush_ms.observe((time.perf_counter() - started) * 1000)
+        rows_meter.mark(len(readings))
+        return
@@ -0,0 +1,238 @@
+import asyncio
+import time
+import zlib
+import logging
+from collections import namedtuple, deque
+from aiokafka import AIOKafkaProducer, AIOKafkaConsumer
+from aiokafka.coordinator.assignors.range import RangePartitionAssignor
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Шина сообщений: продюсер и консьюмер с интерфейсом aiokafka.
+# kafka - брокер Kafka через aiokafka, memory - брокер в памяти процесса
+# (для нагрузочных тестов и бенчмарков без Kafka и Zookeeper).
+# Продюсер: start(), stop(), send(topic, value, key) -> future доставки.
+# Консьюмер: start(), stop(), getmany(), commit(), seek(), highwater().
+
+TopicPartition = namedtuple("TopicPartition", ["topic", "partition"])
+ConsumerRecord = namedtuple("ConsumerRecord", ["topic", "partition", "offset", "timestamp", "key", "value"])
+
+
+class MemoryPartition:
+    """Журнал партиции с ограниченным хранением: смещения растут, старые записи вытесняются"""
+
+    def __init__(self, retention):
+        self.records = deque(maxlen=retention)
+        self.base_offset = 0  # Смещение первой хранимой записи
+
+    @property
+    def end_offset(self):
+        return self.base_offset + len(self.records)
+
+    def append(self, record):
+        if len(self.records) == self.records.maxlen:
+            self.base_offset += 1
+        self.records.append(record)
+
+    def read(self, offset, limit):
+        start = max(offset, self.base_offset) - self.base_offset
+        return [self.records[i] for i in range(start, min(start + limit, len(self.records)))]
+
+
+class MemoryBroker:
+    """Брокер в памяти: топики с партициями, смещения и группы консьюмеров"""
+
+    def __init__(self, partitions, retention):
+        self.partitions = partitions
+        self.retention = retention
+        self.topics = {}  # топик -> [MemoryPartition]
+        self.groups = {}  # группа -> {"members": [консьюмеры], "committed": {tp: смещение}}
+        self._data = asyncio.Event()
+        self._next_partition = 0
+
+    def _topic(self, topic):
+        if topic not in self.topics:
+            self.topics[topic] = [MemoryPartition(self.retention) for _ in range(self.partitions)]
+        return self.topics[topic]
+
+    def partition_for(self, key, partitions):
+        # Сообщения без ключа раскладываются по кругу, с ключом - по хешу ключа
+        if key is None:
+            self._next_partition = (self._next_partition + 1) % partitions
+            return self._next_partition
+        return zlib.crc32(key) % partitions
+
+    def append(self, topic, key, value):
+        partitions = self._topic(topic)
+        index = self.partition_for(key, len(partitions))
+        partition = partitions[index]
+        record = ConsumerRecord(topic, index, partition.end_offset, int(time.time() * 1000), key, value)
+        partition.append(record)
+        # Будим ожидающих консьюмеров
+        if not self._data.is_set():
+            self._data.set()
+        return record
+
+    async def wait_for_data(self, timeout):
+        # Сработавшее событие заменяется новым для следующего ожидания
+        if self._data.is_set():
+            self._data = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._data.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def join(self, group, consumer):
+        state = self.groups.setdefault(group, {"members": [], "committed": {}})
+        state["members"].append(consumer)
+        self.rebalance(group)
+
+    def leave(self, group, consumer):
+        state = self.groups.get(group)
+        if state and consumer in state["members"]:
+            state["members"].remove(consumer)
+            self.rebalance(group)
+
+    def rebalance(self, group):
+        """Раздает партиции подписанных топиков участникам группы по кругу"""
+        state = self.groups[group]
+        members = state["members"]
+        for member in members:
+            member.assign([])
+        topics = sorted({topic for member in members for topic in member.topics})
+        for topic in topics:
+            subscribers = [member for member in members if topic in member.topics]
+            for index in range(len(self._topic(topic))):
+                subscribers[index % len(subscribers)].assigned.append(TopicPartition(topic, index))
+        for member in members:
+            member.reset_positions(state["committed"])
+
+    def commit(self, group, offsets):
+        self.groups[group]["committed"].update(offsets)
+
+
+class MemoryProducer:
+    """Продюсер брокера в памяти: доставка подтверждается сразу"""
+
+    def __init__(self, broker, key_serializer=None, value_serializer=None, **kwargs):
+        self.broker = broker
+        self.key_serializer = key_serializer
+        self.value_serializer = value_serializer
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def send(self, topic, value=None, key=None):
+        if self.key_serializer is not None:
+            key = self.key_serializer(key)
+        if self.value_serializer is not None:
+            value = self.value_serializer(value)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self.broker.append(topic, key, value))
+        return future
+
+
+class MemoryConsumer:
+    """Консьюмер брокера в памяти, участник группы с ручной фиксацией смещений"""
+
+    def __init__(self, broker, *topics, group_id=None, client_id=None, enable_auto_commit=True,
+                 max_poll_records=None, auto_offset_reset="latest", **kwargs):
+        self.broker = broker
+        self.topics = set(topics)
+        # Без группы консьюмер читает все партиции сам
+        self.group_id = group_id or f"{client_id or 'consumer'}-{id(self)}"
+        self.client_id = client_id
+        self.auto_commit = enable_auto_commit
+        self.auto_offset_reset = auto_offset_reset
+        self.max_poll_records = max_poll_records or 500
+        self.assigned = []
+        self.positions = {}
+        self._poll_start = 0
+
+    def assign(self, partitions):
+        self.assigned = list(partitions)
+
+    def reset_positions(self, committed):
+        # Новое назначение читается с зафиксированного смещения группы, без него - как в aiokafka
+        self.positions = {}
+        for tp in self.assigned:
+            partition = self.broker.topics[tp.topic][tp.partition]
+            default = partition.base_offset if self.auto_offset_reset == "earliest" else partition.end_offset
+            self.positions[tp] = committed.get(tp, default)
+
+    async def start(self):
+        self.broker.join(self.group_id, self)
+
+    async def stop(self):
+        self.broker.leave(self.group_id, self)
+
+    def _poll(self, max_records):
+        result = {}
+        # Начало обхода сдвигается, чтобы первые партиции не забирали весь лимит
+        self._poll_start = (self._poll_start + 1) % max(1, len(self.assigned))
+        for tp in self.assigned[self._poll_start:] + self.assigned[:self._poll_start]:
+            if max_records <= 0:
+                break
+            partition = self.broker.topics[tp.topic][tp.partition]
+            records = partition.read(self.positions[tp], max_records)
+            if records:
+                result[tp] = records
+                self.positions[tp] = records[-1].offset + 1
+                max_records -= len(records)
+        return result
+
+    async def getmany(self, timeout_ms=0, max_records=None):
+        """Возвращает {TopicPartition: [ConsumerRecord]}, ожидая данные не дольше timeout_ms"""
+        max_records = max_records or self.max_poll_records
+        deadline = time.monotonic() + timeout_ms / 1000
+        while True:
+            result = self._poll(max_records)
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                if result and self.auto_commit:
+                    await self.commit()
+                return result
+            await self.broker.wait_for_data(remaining)
+
+    async def commit(self):
+        self.broker.commit(self.group_id, dict(self.positions))
+
+    def seek(self, tp, offset):
+        self.positions[tp] = offset
+
+    def assignment(self):
+        return set(self.assigned)
+
+    def highwater(self, tp):
+        return self.broker.topics[tp.topic][tp.partition].end_offset
+
+
+_memory_broker = None
+
+
+def get_memory_broker():
+    global _memory_broker
+    if _memory_broker is None:
+        _memory_broker = MemoryBroker(config.BUS_MEMORY_PARTITIONS, config.BUS_MEMORY_RETENTION)
+    return _memory_broker
+
+
+def create_producer(**kwargs):
+    """Создает продюсер выбранной шины (BUS_BACKEND)"""
+    if config.BUS_BACKEND == "memory":
+        return MemoryProducer(get_memory_broker(), **kwargs)
+    return AIOKafkaProducer(bootstrap_servers=config.KAFKA_BOOTSTRAP_SERVERS, **kwargs)
+
+
+def create_consumer(*topics, **kwargs):
+    """Создает консьюмер выбранной шины (BUS_BACKEND)"""
+    if config.BUS_BACKEND == "memory":
+        return MemoryConsumer(get_memory_broker(), *topics, **kwargs)
+    # Партиции с одним номером во всех топиках достаются одному консьюмеру: показания и оповещения
+    # датчика (ключ - id датчика) обрабатываются в одном процессе, как и в брокере в памяти
+    kwargs.setdefault("partition_assignment_strategy", (RangePartitionAssignor,))
+    return AIOKafkaConsumer(*topics, bootstrap_servers=config.KAFKA_BOOTSTRAP_SERVERS, **kwargs)
@@ -1,48 +1,241 @@
-import json
+import time
 import asyncio
-from aiokafka import AIOKafkaConsumer
-from config import config
-from processing.data_processor import process_data
 import logging
+import multiprocessing
+from config import config
+from metrics import metrics
+from kafka.bus import create_consumer
+from mqtt.router import Route, ALERTS_TOPIC
+from database.telemetry_writer import is_transient
+from processing.data_processor import process_batch
+from processing.decoder import Reading, get_decoder, decode_stage
+from processing.wire import is_binary
 
 logger = logging.getLogger(__name__)
 
+# Топики экструдера
+TOPICS = [
+    "extruder_temperature",
+    "extruder_move_speed",
+    "extruder_isolation_thickness",
+    "extruder_cable_core_profile",
+    "alerts"
+]
 
-async def consume_messages(topics):
-    """Асинхронный консьюмер для Kafka топиков"""
-    consumer = AIOKafkaConsumer(
-        *topics,
-        bootstrap_servers=config.KAFKA_BOOTSTRAP_SERVERS,
-        value_deserializer=lambda m: json.loads(m.decode('utf-8')),
-    )
+consumed_meter = metrics.meter("kafka_consumed")
+batch_latency = metrics.histogram("kafka_consumer_batch_ms")
+batch_errors = metrics.counter("kafka_consumer_batch_errors")
+dead_letter_counter = metrics.counter("kafka_dead_letter")
+commit_errors = metrics.counter("kafka_consumer_commit_errors")
+restarts_counter = metrics.counter("kafka_consumer_restarts")
 
-    try:
-        await consumer.start()
-        logger.info(f"Kafka консьюмер запущен для топиков: {topics}")
+# Оповещения разбираются как JSON без интерпретации полей
+ALERTS_ROUTE = Route(ALERTS_TOPIC, None, None, alert=True)
+
+
+def decode_records(records):
+    """Декодирует сообщения пакета в показания и оповещения"""
+    decoder = get_decoder()
+    started = time.perf_counter()
+    readings = []
+    alerts = []
+    for record in records:
+        # Двоичный кадр содержит пакет показаний, остальные сообщения - JSON
+        if is_binary(record.value):
+            readings.extend(decoder.decode_binary(record.value))
+            continue
+        decoded = decoder.decode(record.value, ALERTS_ROUTE if record.topic == ALERTS_TOPIC else None)
+        if decoded is None:
+            continue
+        if isinstance(decoded, Reading):
+            readings.append(decoded)
+        else:
+            alerts.append(decoded)
+    decode_stage.record(started, len(records))
+    return readings, alerts
+
+
+async def process_records_separately(records):
+    """Обрабатывает сообщения сбойного пакета по одному; возвращает сообщения, которые обработать нельзя.
+    Временная ошибка (БД недоступна) прерывает обработку - пакет повторяется целиком"""
+    dead = []
+    for record in records:
+        try:
+            readings, alerts = decode_records([record])
+            await process_batch(readings, alerts)
+        except Exception as e:
+            if is_transient(e):
+                raise
+            logger.error(f"Сообщение {record.topic}[{record.partition}]@{record.offset} не обработано: {e}")
+            dead.append(record)
+    return dead
 
-        async for msg in consumer:
-            logger.debug(f"Получено сообщение из {msg.topic}: {msg.value}")
 
-            # Асинхронная обработка сообщения
-            await process_data(msg.topic, msg.value)
+async def dead_letter(records):
+    """Отправляет необрабатываемые сообщения в KAFKA_DEAD_LETTER_TOPIC с исходными ключом и значением"""
+    from kafka.producer import produce_batch
 
+    dead_letter_counter.inc(len(records))
+    if not config.KAFKA_DEAD_LETTER_TOPIC:
+        return
+    try:
+        await produce_batch([(config.KAFKA_DEAD_LETTER_TOPIC, record.value, record.key) for record in records])
     except Exception as e:
-        logger.error(f"Ошибка при работе Kafka консьюмера: {e}")
+        logger.error(f"Ошибка отправки в {config.KAFKA_DEAD_LETTER_TOPIC}, пропущено сообщений: {len(records)}: {e}")
+
+
+def update_lag(consumer, batch):
+    """Отставание по партициям пакета: последнее смещение в партиции минус обработанное"""
+    for tp, records in batch.items():
+        highwater = consumer.highwater(tp)
+        if highwater is not None:
+            metrics.gauge(f"kafka_lag_{tp.topic}_{tp.partition}").set(highwater - records[-1].offset - 1)
+
+
+def rewind(consumer, batch):
+    """Возвращает партиции пакета к его началу. Партиции, отобранные при перебалансировке группы,
+    пропускаются: новый владелец прочитает их с последнего зафиксированного смещения"""
+    assigned = consumer.assignment()
+    for tp, partition_records in batch.items():
+        if tp in assigned:
+            consumer.seek(tp, partition_records[0].offset)
+
+
+async def consume_batches(consumer):
+    """Читает и обрабатывает пакеты; смещения фиксируются только после записи пакета в БД"""
+    # Партиции внутри группы распределяются между консьюмерами, а пакеты
+    # обрабатываются последовательно - порядок по датчику сохраняется
+    failures = 0  # Подряд неудачных попыток обработки пакета с постоянной ошибкой
+    while True:
+        batch = await consumer.getmany(
+            timeout_ms=config.KAFKA_CONSUMER_BATCH_TIMEOUT_MS,
+            max_records=config.KAFKA_CONSUMER_BATCH_SIZE
+        )
+        if not batch:
+            continue
+
+        records = [record for partition_records in batch.values() for record in partition_records]
+        logger.debug(f"Получен пакет из {len(records)} сообщений по {len(batch)} партициям")
+        consumed_meter.mark(len(records))
+
+        started = time.perf_counter()
+        try:
+            try:
+                readings, alerts = decode_records(records)
+                await process_batch(readings, alerts)
+            except Exception as e:
+                # Временные ошибки повторяются без ограничения, постоянные - KAFKA_CONSUMER_MAX_RETRIES раз,
+                # после чего сообщения пакета обрабатываются по одному, а сбойные пропускаются
+                if is_transient(e) or failures < config.KAFKA_CONSUMER_MAX_RETRIES:
+                    raise
+                logger.error(f"Пакет Kafka не обработан после {failures} повторов, поиск сбойных сообщений: {e}")
+                dead = await process_records_separately(records)
+                if dead:
+                    await dead_letter(dead)
+        except Exception as e:
+            # Возвращаемся к началу пакета: смещения не зафиксированы, пакет будет прочитан снова
+            batch_errors.inc()
+            if not is_transient(e):
+                failures += 1
+            logger.error(f"Ошибка обработки пакета Kafka, повтор через {config.KAFKA_CONSUMER_RETRY_INTERVAL} с: {e}")
+            rewind(consumer, batch)
+            await asyncio.sleep(config.KAFKA_CONSUMER_RETRY_INTERVAL)
+            continue
+
+        failures = 0
+        try:
+            await consumer.commit()
+        except Exception as e:
+            # Обычно перебалансировка группы: пакет записан, но будет прочитан снова
+            # (повторы отсеиваются окном dedup и ключами идемпотентности)
+            commit_errors.inc()
+            logger.warning(f"Смещения пакета Kafka не зафиксированы, пакет будет прочитан снова: {e}")
+            rewind(consumer, batch)
+            continue
+        batch_latency.observe((time.perf_counter() - started) * 1000)
+        update_lag(consumer, batch)
+
+
+async def consume_messages(topics, index=0):
+    """Асинхронный консьюмер для Kafka топиков, участник группы KAFKA_CONSUMER_GROUP.
+    При ошибке (Kafka еще не готова, сбой при перебалансировке) консьюмер пересоздается
+    с паузой, растущей до KAFKA_CONSUMER_RESTART_MAX_DELAY"""
+    delay = config.KAFKA_CONSUMER_RETRY_INTERVAL
+    while True:
+        consumer = create_consumer(
+            *topics,
+            group_id=config.KAFKA_CONSUMER_GROUP or None,
+            client_id=f"{config.KAFKA_CONSUMER_GROUP or 'consumer'}-{index}",
+            # Смещения фиксируются только после записи пакета в БД
+            enable_auto_commit=False,
+            max_poll_records=config.KAFKA_CONSUMER_BATCH_SIZE,
+        )
+        try:
+            await consumer.start()
+            logger.info(f"Kafka консьюмер {index} запущен для топиков: {topics}")
+            delay = config.KAFKA_CONSUMER_RETRY_INTERVAL
+            await consume_batches(consumer)
+        except Exception as e:
+            restarts_counter.inc()
+            logger.error(f"Ошибка при работе Kafka консьюмера {index}, перезапуск через {delay} с: {e}")
+        finally:
+            try:
+                await consumer.stop()
+            except Exception as e:
+                logger.warning(f"Ошибка остановки Kafka консьюмера {index}: {e}")
+            logger.info(f"Kafka консьюмер {index} остановлен")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, config.KAFKA_CONSUMER_RESTART_MAX_DELAY)
+
+
+def consumer_process_main(index, topics):
+    """Точка входа отдельного процесса-консьюмера"""
+    from kafka import producer
+
+    # Сообщения в топик необрабатываемых уходят через спул процесса
+    producer.spool_name = f"consumer-{index}"
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - consumer-{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    try:
+        asyncio.run(consume_messages(topics, index))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_consumer_processes(topics, count):
+    """Запускает консьюмеры группы в отдельных процессах и ждет их завершения"""
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=consumer_process_main, args=(index, topics), name=f"kafka-consumer-{index}", daemon=True)
+        for index in range(count)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        while any(process.is_alive() for process in processes):
+            await asyncio.sleep(1)
     finally:
-        await consumer.stop()
-        logger.info("Kafka консьюмер остановлен")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join(timeout=5)
 
 
 async def start_consumers():
     """Запускает консьюмеры для топиков экструдера"""
-    topics = [
-        "extruder_temperature",
-        "extruder_move_speed",
-        "extruder_isolation_thickness",
-        "extruder_cable_core_profile",
-        "alerts"
-    ]
+    count = max(1, config.KAFKA_CONSUMER_COUNT)
+
+    mode = config.KAFKA_CONSUMER_MODE
+    # Брокер в памяти доступен только внутри процесса
+    if mode == "processes" and config.BUS_BACKEND == "memory":
+        logger.warning("Шина memory не поддерживает консьюмеры в отдельных процессах, используются задачи")
+        mode = "tasks"
 
-    # Запускаем консьюмер как отдельную задачу
-    consumer_task = asyncio.create_task(consume_messages(topics))
-    return consumer_task
\ No newline at end of file
+    # Консьюмеры как задачи в этом процессе или как отдельные процессы
+    if mode == "processes":
+        consumer_task = asyncio.create_task(run_consumer_processes(TOPICS, count))
+    else:
+        consumer_task = asyncio.gather(*[consume_messages(TOPICS, index) for index in range(count)])
+    return consumer_task
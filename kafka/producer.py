@@ -1,39 +1,214 @@
 import json
+import time
 import asyncio
-from aiokafka import AIOKafkaProducer
-from config import config
+from pathlib import Path
+from config import config, BASE_DIR
+from metrics import metrics
+from kafka.spool import DiskSpool, replayed_meter
+from kafka.bus import create_producer
 import logging
 
 logger = logging.getLogger(__name__)
 
 # Глобальная переменная для продюсера
 _producer = None
+# Неподтвержденные отправки, отслеживаемые в фоне
+_in_flight = set()
+_last_error_log = 0.0
+# Спул неотправленных сообщений; воркеры приема задают собственное имя каталога
+_spool = None
+_spool_disabled = False
+spool_name = "main"
+
+# Метрики продюсера
+in_flight_gauge = metrics.gauge("kafka_in_flight")
+sent_counter = metrics.counter("kafka_delivered")
+error_counter = metrics.counter("kafka_delivery_errors")
+delivery_ms = metrics.histogram("kafka_delivery_ms")
+
+def serialize_key(key):
+    """Ключ сообщения - идентификатор датчика: все показания датчика попадают в одну партицию"""
+    if key is None or isinstance(key, bytes):
+        return key
+    return str(key).encode('utf-8')
+
+def serialize_value(value):
+    """Уже закодированные сообщения передаются как есть, остальные сериализуются в JSON"""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return json.dumps(value).encode('utf-8')
 
 async def get_producer():
     """Создает и возвращает экземпляр Kafka продюсера"""
     global _producer
     if _producer is None:
-        _producer = AIOKafkaProducer(
-            bootstrap_servers=config.KAFKA_BOOTSTRAP_SERVERS,
-            value_serializer=lambda v: json.dumps(v).encode('utf-8')
+        producer = create_producer(
+            key_serializer=serialize_key,
+            value_serializer=serialize_value,
+            max_batch_size=config.KAFKA_MAX_BATCH_SIZE,
+            linger_ms=config.KAFKA_LINGER_MS,
+            compression_type=config.KAFKA_COMPRESSION or None,
+            acks=config.KAFKA_ACKS
         )
-        await _producer.start()
-        logger.info(f"Kafka продюсер подключен к {config.KAFKA_BOOTSTRAP_SERVERS}")
+        try:
+            await producer.start()
+        except Exception:
+            # Незапущенный продюсер закрываем, следующая попытка создаст новый
+            await producer.stop()
+            raise
+        _producer = producer
+        logger.info(f"Kafka продюсер подключен к {config.KAFKA_BOOTSTRAP_SERVERS} (шина {config.BUS_BACKEND})")
     return _producer
 
-async def produce_message(topic, data):
+def _log_delivery_error(error):
+    """Ошибки доставки выводятся не чаще раза в 10 секунд, остальные только считаются"""
+    global _last_error_log
+    now = time.monotonic()
+    if now - _last_error_log >= 10:
+        _last_error_log = now
+        logger.error(f"Ошибка доставки в Kafka (всего ошибок: {error_counter.value}): {error}")
+
+def get_spool():
+    """Возвращает спул неотправленных сообщений или None, если он отключен"""
+    global _spool, _spool_disabled
+    if _spool is None and config.KAFKA_SPOOL_DIR and not _spool_disabled:
+        directory = Path(BASE_DIR, config.KAFKA_SPOOL_DIR, spool_name)
+        try:
+            _spool = DiskSpool(
+                directory,
+                config.KAFKA_SPOOL_SEGMENT_BYTES,
+                config.KAFKA_SPOOL_MAX_BYTES,
+                fsync=config.KAFKA_SPOOL_FSYNC
+            )
+        except OSError as e:
+            # Недоступный каталог не должен останавливать прием: работаем без спула
+            _spool_disabled = True
+            logger.error(f"Спул {directory} недоступен, неотправленные в Kafka сообщения не сохраняются: {e}")
+    return _spool
+
+def spool_messages(messages):
+    """Сохраняет сериализованные сообщения [(topic, key, value), ...] для повторной отправки"""
+    spool = get_spool()
+    if spool is None:
+        return False
+    try:
+        spool.append(messages)
+    except OSError as e:
+        logger.error(f"Ошибка записи в спул, потеряно сообщений: {len(messages)}: {e}")
+        return False
+    return True
+
+def _on_delivery(future, started, message):
+    _in_flight.discard(future)
+    in_flight_gauge.set(len(_in_flight))
+    if future.cancelled():
+        error_counter.inc()
+        spool_messages([message])
+        return
+    error = future.exception()
+    if error is not None:
+        error_counter.inc()
+        _log_delivery_error(error)
+        # Недоставленное сообщение уходит в спул и будет отправлено после восстановления Kafka
+        spool_messages([message])
+    else:
+        sent_counter.inc()
+        delivery_ms.observe((time.perf_counter() - started) * 1000)
+
+async def send_message(topic, data, key=None):
+    """Кладет сообщение в буфер продюсера и возвращает future подтверждения доставки"""
+    message = (topic, serialize_key(key), serialize_value(data))
+    producer = await get_producer()
+    started = time.perf_counter()
+    # send() ожидает только при заполненном буфере продюсера
+    future = await producer.send(topic, message[2], key=message[1])
+    _in_flight.add(future)
+    in_flight_gauge.set(len(_in_flight))
+    future.add_done_callback(lambda f: _on_delivery(f, started, message))
+    return future
+
+async def produce_message(topic, data, key=None):
     """Отправляет сообщение в Kafka топик"""
+    await produce_batch([(topic, data, key)])
+
+async def produce_batch(messages):
+    """Отправляет пакет сообщений [(topic, data, key), ...]; в режиме wait дожидается подтверждений"""
+    messages = [(topic, serialize_key(key), serialize_value(data)) for topic, data, key in messages]
+
+    # Пока спул не отправлен, новые сообщения дописываются за ним - порядок сохраняется
+    spool = get_spool()
+    if spool is not None and spool.pending:
+        spool_messages(messages)
+        return
+
+    futures = []
     try:
-        producer = await get_producer()
-        await producer.send_and_wait(topic, data)
-        logger.debug(f"Сообщение отправлено в Kafka топик {topic}: {data}")
+        for topic, key, value in messages:
+            futures.append(await send_message(topic, value, key))
     except Exception as e:
-        logger.error(f"Ошибка отправки сообщения в Kafka: {e}")
+        logger.error(f"Ошибка отправки пакета сообщений в Kafka: {e}")
+        if not spool_messages(messages[len(futures):]):
+            return
+
+    if config.KAFKA_PRODUCER_MODE == "wait":
+        await asyncio.gather(*futures, return_exceptions=True)
+    logger.debug(f"Пакет из {len(messages)} сообщений передан продюсеру Kafka")
+
+async def replay_spool():
+    """Отправляет накопленные в спуле сообщения по порядку, сегмент удаляется после подтверждения.
+    Подтвержденное начало сегмента запоминается и после сбоя не отправляется повторно"""
+    spool = get_spool()
+    if spool is None:
+        return
+    while True:
+        if not spool.pending:
+            await asyncio.sleep(config.KAFKA_SPOOL_REPLAY_INTERVAL)
+            continue
+
+        try:
+            path, records, start = spool.oldest()
+            pending = records[start:]
+            futures = []
+            error = None
+            try:
+                producer = await get_producer()
+                for topic, key, value in pending:
+                    futures.append(await producer.send(topic, value, key=key))
+            except Exception as e:
+                error = e
+
+            # Подтвержденными считаются записи до первой недоставленной
+            acked = 0
+            for result in await asyncio.gather(*futures, return_exceptions=True):
+                if isinstance(result, BaseException):
+                    error = error or result
+                    break
+                acked += 1
+            if acked:
+                replayed_meter.mark(acked)
+
+            if acked < len(pending):
+                if acked:
+                    spool.ack(path, start + acked)
+                logger.warning(f"Kafka недоступна, в спуле {spool.size} байт, повтор через "
+                               f"{config.KAFKA_SPOOL_REPLAY_INTERVAL} с: {error}")
+                await asyncio.sleep(config.KAFKA_SPOOL_REPLAY_INTERVAL)
+                continue
+
+            spool.remove(path)
+            logger.info(f"Из спула отправлено сообщений: {len(pending)}, осталось {spool.size} байт")
+        except Exception as e:
+            # Ошибка чтения сегмента не должна останавливать прием, в который входит воспроизведение
+            logger.error(f"Ошибка воспроизведения спула, повтор через {config.KAFKA_SPOOL_REPLAY_INTERVAL} с: {e}")
+            await asyncio.sleep(config.KAFKA_SPOOL_REPLAY_INTERVAL)
 
 async def close_producer():
     """Закрывает соединение с Kafka продюсером"""
     global _producer
     if _producer:
+        # stop() дожидается отправки накопленных сообщений
         await _producer.stop()
         _producer = None
-        logger.info("Kafka продюсер отключен")
\ No newline at end of file
+        logger.info("Kafka продюсер отключен")
+    if _spool is not None:
+        _spool.close()
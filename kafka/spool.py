@@ -0,0 +1,173 @@
+import os
+import struct
+import logging
+from pathlib import Path
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Формат записи спула: длина топика (uint16), длина ключа (uint32, NO_KEY - без ключа),
+# длина значения (uint32), затем топик в UTF-8, ключ и значение как есть.
+RECORD_HEADER = struct.Struct("<HII")
+NO_KEY = 0xFFFFFFFF
+SEGMENT_SUFFIX = ".spool"
+# Рядом с сегментом хранится число его записей, уже подтвержденных Kafka при воспроизведении
+ACK_SUFFIX = ".ack"
+
+# Метрики спула
+spool_bytes = metrics.gauge("kafka_spool_bytes")
+spool_segments = metrics.gauge("kafka_spool_segments")
+spooled_counter = metrics.counter("kafka_spool_written")
+evicted_counter = metrics.counter("kafka_spool_evicted_bytes")
+replayed_meter = metrics.meter("kafka_spool_replayed")
+
+
+def pack_records(messages):
+    """Упаковывает [(topic, key, value), ...] с уже сериализованными ключом и значением"""
+    buffer = bytearray()
+    for topic, key, value in messages:
+        topic_bytes = topic.encode('utf-8')
+        key_length = NO_KEY if key is None else len(key)
+        buffer += RECORD_HEADER.pack(len(topic_bytes), key_length, len(value))
+        buffer += topic_bytes
+        if key is not None:
+            buffer += key
+        buffer += value
+    return bytes(buffer)
+
+
+def unpack_records(data):
+    """Распаковывает записи сегмента; недописанный хвост (сбой при записи) отбрасывается"""
+    records = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        topic_length, key_length, value_length = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + topic_length + (0 if key_length == NO_KEY else key_length) + value_length
+        if end > len(data):
+            break
+        topic = data[start:start + topic_length].decode('utf-8')
+        start += topic_length
+        key = None
+        if key_length != NO_KEY:
+            key = data[start:start + key_length]
+            start += key_length
+        records.append((topic, key, data[start:end]))
+        offset = end
+    if offset != len(data):
+        logger.warning(f"В сегменте спула отброшен недописанный хвост: {len(data) - offset} байт")
+    return records
+
+
+class DiskSpool:
+    """Журнал неотправленных в Kafka сообщений: файлы-сегменты только на дозапись,
+    старые сегменты удаляются при превышении квоты"""
+
+    def __init__(self, directory, segment_bytes, max_bytes, fsync=False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+
+        # Сегменты, оставшиеся после перезапуска, воспроизводятся первыми
+        self.segments = sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+        self._sizes = {path: path.stat().st_size for path in self.segments}
+        self._acked = {path: self._read_ack(path) for path in self.segments}
+        self._next_seq = int(self.segments[-1].stem) + 1 if self.segments else 0
+        self._active = None
+        self._active_path = None
+        self._update_metrics()
+        if self.segments:
+            logger.info(f"В спуле {self.directory} найдено {len(self.segments)} сегментов, {self.size} байт")
+
+    @property
+    def size(self):
+        return sum(self._sizes.values())
+
+    @property
+    def pending(self):
+        return bool(self.segments)
+
+    def _update_metrics(self):
+        spool_bytes.set(self.size)
+        spool_segments.set(len(self.segments))
+
+    def _close_active(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+            self._active_path = None
+
+    def _rotate(self):
+        self._close_active()
+        path = self.directory / f"{self._next_seq:012d}{SEGMENT_SUFFIX}"
+        self._next_seq += 1
+        self._active = open(path, "ab")
+        self._active_path = path
+        self.segments.append(path)
+        self._sizes[path] = 0
+
+    def append(self, messages):
+        """Дописывает пакет сообщений в конец спула"""
+        data = pack_records(messages)
+        if self._active is None or (self._sizes[self._active_path] and
+                                    self._sizes[self._active_path] + len(data) > self.segment_bytes):
+            self._rotate()
+        self._active.write(data)
+        self._active.flush()
+        if self.fsync:
+            os.fsync(self._active.fileno())
+        self._sizes[self._active_path] += len(data)
+        spooled_counter.inc(len(messages))
+        self._enforce_quota()
+        self._update_metrics()
+
+    def _enforce_quota(self):
+        # Вытесняются самые старые сегменты, текущий сегмент остается
+        while self.size > self.max_bytes and len(self.segments) > 1:
+            path = self.segments[0]
+            evicted_counter.inc(self._sizes[path])
+            logger.error(f"Квота спула {self.max_bytes} байт превышена, удален сегмент {path.name} ({self._sizes[path]} байт)")
+            self.remove(path)
+
+    @staticmethod
+    def _ack_path(path):
+        return path.with_suffix(ACK_SUFFIX)
+
+    def _read_ack(self, path):
+        try:
+            return int(self._ack_path(path).read_text())
+        except (OSError, ValueError):
+            return 0
+
+    def oldest(self):
+        """Возвращает самый старый сегмент, его записи и число уже подтвержденных из них;
+        текущий сегмент при этом закрывается, и новые сообщения пишутся в следующий"""
+        path = self.segments[0]
+        if path == self._active_path:
+            self._close_active()
+        return path, unpack_records(path.read_bytes()), self._acked.get(path, 0)
+
+    def ack(self, path, count):
+        """Запоминает, что первые count записей сегмента доставлены: после сбоя они не отправляются повторно"""
+        if path not in self._sizes:
+            return
+        self._acked[path] = count
+        self._ack_path(path).write_text(str(count))
+
+    def remove(self, path):
+        """Удаляет сегмент после успешной отправки (или вытеснения)"""
+        if path not in self._sizes:
+            return
+        if path == self._active_path:
+            self._close_active()
+        self.segments.remove(path)
+        del self._sizes[path]
+        self._acked.pop(path, None)
+        path.unlink(missing_ok=True)
+        self._ack_path(path).unlink(missing_ok=True)
+        self._update_metrics()
+
+    def close(self):
+        self._close_active()
@@ -1,24 +1,91 @@
 import asyncio
 import logging
 from mqtt.client import mqtt_client
+from mqtt.workers import run_ingest_workers
+from config import config
 from kafka.consumer import start_consumers
 from kafka.producer import close_producer
-from database.connection import Base, engine
+from database.connection import Base, engine, migrate_schema
+from processing.metadata import get_metadata
+from processing.data_processor import get_pipeline
+from processing.aggregator import get_aggregator, prepare_rollup_backfill, backfill_rollups
+from processing.analytics_executor import get_analytics_executor
+from processing.latest_values import readings_written_here
 import uvicorn
 from web.app import app
 
 
 logger = logging.getLogger(__name__)
 
+# Режимы записи показаний в БД (INGEST_MODE)
+INGEST_MODES = ("direct", "kafka", "both")
+
+
+def check_ingest_mode():
+    """Проверяет INGEST_MODE до запуска приема"""
+    if config.INGEST_MODE not in INGEST_MODES:
+        raise ValueError(f"Неизвестный режим записи INGEST_MODE={config.INGEST_MODE}; доступны: {', '.join(INGEST_MODES)}")
+    # Окно отсева повторов хранится в памяти процесса: в режиме both обе записи должны идти через него
+    if config.INGEST_MODE == "both" and (config.MQTT_INGEST_WORKERS > 1 or config.KAFKA_CONSUMER_MODE == "processes"):
+        raise ValueError("Режим both несовместим с MQTT_INGEST_WORKERS > 1 и KAFKA_CONSUMER_MODE=processes: "
+                         "повторы отсеиваются только внутри одного процесса")
+
+
+async def backfill_history(cutoff_id):
+    """Агрегаты по показаниям, сохраненным до запуска агрегатора"""
+    try:
+        await backfill_rollups(cutoff_id)
+    except Exception as e:
+        logger.error(f"Ошибка построения агрегатов по сохраненным показаниям: {e}")
+
 
 async def startup():
     """Запуск всех компонентов системы"""
     try:
-        # Запуск MQTT клиента
-        mqtt_task = asyncio.create_task(mqtt_client())
+        # Обновление схемы БД до текущей версии моделей
+        try:
+            await migrate_schema()
+        except Exception as e:
+            logger.error(f"Ошибка обновления схемы БД: {e}")
+
+        check_ingest_mode()
+
+        # Граница построения агрегатов по сохраненным показаниям фиксируется до начала приема
+        backfill_cutoff = None
+        if config.ROLLUP_BACKFILL_ON_STARTUP:
+            try:
+                backfill_cutoff = await prepare_rollup_backfill()
+            except Exception as e:
+                logger.error(f"Ошибка подготовки агрегатов по сохраненным показаниям: {e}")
+
+        # Кэш метаданных датчиков загружается до приема первых показаний
+        await get_metadata()
+        # Конвейер обработки собирается до приема: ошибка в PIPELINE_STAGES видна сразу
+        get_pipeline()
+
+        # Запуск MQTT клиента: в этом процессе или в нескольких воркерах с общей подпиской
+        if config.MQTT_INGEST_WORKERS > 1 and config.BUS_BACKEND == "memory":
+            logger.warning("Шина memory доступна только внутри процесса: сообщения воркеров приема не дойдут до консьюмеров")
+        if config.MQTT_INGEST_WORKERS > 1:
+            mqtt_task = asyncio.create_task(run_ingest_workers(config.MQTT_INGEST_WORKERS))
+        else:
+            mqtt_task = asyncio.create_task(mqtt_client())
+
+        # Запуск Kafka консьюмеров: в режиме direct в БД пишет только MQTT-клиент,
+        # а Kafka остается шиной для внешних подписчиков
+        tasks = [mqtt_task]
+        if config.INGEST_MODE in ("kafka", "both"):
+            tasks.append(await start_consumers())
+        logger.info(f"Режим записи показаний: {config.INGEST_MODE}")
+        if not readings_written_here():
+            # Последние значения перечитываются из БД, а SPC и текущая статистика есть только в памяти
+            logger.warning("Показания записываются в других процессах: /api/spc и /api/sensors/stats "
+                           "этого процесса пусты")
 
-        # Запуск Kafka консьюмеров
-        consumer_task = await start_consumers()
+        # Статистика читается из агрегатов: показания, сохраненные до их появления, агрегируются
+        # один раз в фоне, не задерживая прием
+        if backfill_cutoff is not None:
+            tasks.append(asyncio.create_task(backfill_history(backfill_cutoff)))
 
         # Запуск веб-сервера
         web_server = uvicorn.Server(
@@ -29,16 +96,18 @@ async def startup():
                 reload=False
             )
         )
-        web_task = asyncio.create_task(web_server.serve())
+        tasks.append(asyncio.create_task(web_server.serve()))
 
         # Ожидаем завершения всех задач
-        await asyncio.gather(mqtt_task, consumer_task, web_task)
+        await asyncio.gather(*tasks)
 
     except Exception as e:
         logger.error(f"Ошибка запуска системы: {e}")
     finally:
-        # Закрываем соединения при завершении
+        # Записываем незакрытые окна агрегации и закрываем соединения при завершении
+        await get_aggregator().flush(force=True)
         await close_producer()
+        get_analytics_executor().shutdown()
 
 
 async def shutdown():
@@ -0,0 +1,145 @@
+import time
+from bisect import bisect_left
+from collections import deque
+
+# Границы гистограмм по умолчанию (миллисекунды)
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Counter:
+    """Монотонно возрастающий счетчик"""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Текущее значение (глубина очереди, размер буфера и т.п.)"""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def snapshot(self):
+        return self.value
+
+
+class Meter:
+    """Счетчик событий со скоростью за последние window секунд"""
+
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self._buckets = deque()  # (секунда, количество)
+
+    def mark(self, n=1):
+        self.total += n
+        second = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += n
+        else:
+            self._buckets.append([second, n])
+            self._trim(second)
+
+    def _trim(self, now_second):
+        while self._buckets and self._buckets[0][0] <= now_second - self.window:
+            self._buckets.popleft()
+
+    def rate(self):
+        """Среднее число событий в секунду за окно"""
+        self._trim(int(time.monotonic()))
+        return sum(n for _, n in self._buckets) / self.window
+
+    def snapshot(self):
+        return {"total": self.total, "rate": round(self.rate(), 2)}
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Оценка перцентиля по верхней границе корзины"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 3) if self.count else 0,
+            "max": round(self.max, 3),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "buckets": {
+                **{f"le_{b}": n for b, n in zip(self.buckets, self.counts)},
+                "inf": self.counts[-1],
+            },
+        }
+
+
+class MetricsRegistry:
+    """Реестр именованных метрик процесса"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _get(self, name, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = factory()
+            self._metrics[name] = metric
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def meter(self, name, window=10):
+        return self._get(name, lambda: Meter(window))
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS):
+        return self._get(name, lambda: Histogram(buckets))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in sorted(self._metrics.items())}
+
+
+# Глобальный реестр метрик
+metrics = MetricsRegistry()
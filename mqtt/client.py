@@ -1,234 +1,266 @@
-import paho.mqtt.client as mqtt
-import threading
-import json
 import logging
 import time
-import queue
 import asyncio
+from asyncio_mqtt import Client, MqttError, ProtocolVersion
 from config import config
+from metrics import metrics
+from processing.batcher import MicroBatcher
+from processing.overload import OverloadQueue
+from mqtt.router import get_router, add_reload_listener, reload_router, router_reload_loop
+from mqtt.workers import shared_topic
+from processing.decoder import Reading, get_decoder, malformed_counter, decode_stage, receive_time
+from processing.wire import is_binary, encode_frames
 
 logger = logging.getLogger(__name__)
 
 # Глобальные переменные
-mqtt_client_instance = None
 mqtt_connected = False
 stop_flag = False
-message_queue = queue.Queue()  # Очередь для хранения сообщений
+message_queue = None  # Ограниченная очередь asyncio для полученных сообщений
+mqtt_client_instance = None
+subscribed_topics = set()
+subscription_group = None  # Группа общей подписки ($share/<group>/...) в режиме нескольких воркеров
+protocol_version = None  # Версия протокола MQTT (None - по умолчанию клиента)
+
+# Метрики приема
+received_meter = metrics.meter("mqtt_received")
+processed_meter = metrics.meter("mqtt_processed")
+queue_depth = metrics.gauge("mqtt_queue_depth")
+
+
+def overload_key(item):
+    """Ключ объединения сообщений при перегрузке: датчик маршрута или топик (датчик публикует в свой топик).
+    Оповещения и сообщения без маршрута не отбрасываются"""
+    topic = item[0]
+    route = get_router().match(topic)
+    if route is None or route.alert:
+        return None
+    return route.sensor_id if route.sensor_id is not None else topic
+
+
+def get_message_queue():
+    """Возвращает очередь сообщений, создавая ее в текущем цикле событий"""
+    global message_queue
+    if message_queue is None:
+        maxsize = config.MQTT_QUEUE_MAXSIZE
+        message_queue = OverloadQueue(
+            maxsize,
+            policy=config.INGEST_OVERLOAD_POLICY,
+            high_water=max(1, int(maxsize * config.INGEST_QUEUE_HIGH_WATER)),
+            low_water=int(maxsize * config.INGEST_QUEUE_LOW_WATER),
+            key=overload_key,
+            name="mqtt"
+        )
+    return message_queue
 
 
 # Определение соответствующего Kafka топика
 def determine_kafka_topic(mqtt_topic):
-    topic_mapping = {
-        "extruder/temperature": "extruder_temperature",
-        "extruder/move_speed": "extruder_move_speed",
-        "extruder/isolation_thickness": "extruder_isolation_thickness",
-        "extruder/cable_core_profile": "extruder_cable_core_profile",
-        "extruder/alerts": "alerts"
-    }
-
-    # Находим подходящий ключ
-    for key in topic_mapping:
-        if key in mqtt_topic:
-            return topic_mapping[key]
-
-    return "default_data"
-
-
-# Обработчик сообщений - только помещает в очередь
-def on_message(client, userdata, msg):
-    try:
-        payload = msg.payload.decode()
-        logger.debug(f"Получено сообщение от {msg.topic}: {payload}")
-        
-        # Помещаем сообщение в очередь для асинхронной обработки
-        message_queue.put((msg.topic, payload))
-        
-    except Exception as e:
-        logger.error(f"Ошибка обработки MQTT сообщения: {e}")
-
-
-# Остальные обработчики MQTT
-def on_connect(client, userdata, flags, rc):
-    global mqtt_connected
-
-    connection_result = {
-        0: "Успешное подключение",
-        1: "Неверная версия протокола",
-        2: "Неверный идентификатор клиента",
-        3: "Сервер недоступен",
-        4: "Неверные учетные данные",
-        5: "Не авторизован"
-    }
-
-    if rc == 0:
-        mqtt_connected = True
-        logger.info(f"Подключено к MQTT брокеру {config.MQTT_BROKER}:{config.MQTT_PORT}")
-
-        # Подписываемся на топики экструдера
-        topics = [
-            "extruder/temperature/#",
-            "extruder/move_speed/#",
-            "extruder/isolation_thickness/#",
-            "extruder/cable_core_profile/#",
-            "extruder/alerts/#"
-        ]
-
-        for topic in topics:
-            client.subscribe(topic)
-            logger.info(f"Подписка на топик: {topic}")
-    else:
-        mqtt_connected = False
-        logger.error(
-            f"Не удалось подключиться к MQTT брокеру: {connection_result.get(rc, f'Неизвестная ошибка: {rc}')}")
-
+    route = get_router().match(mqtt_topic)
+    return route.kafka_topic if route else "default_data"
 
-def on_disconnect(client, userdata, rc):
-    global mqtt_connected
-    mqtt_connected = False
 
-    if rc == 0:
-        logger.info("Отключено от MQTT брокера")
-    else:
-        logger.warning(f"Неожиданное отключение от MQTT брокера, код: {rc}")
+async def sync_subscriptions(router):
+    """Приводит подписки клиента в соответствие с шаблонами маршрутизатора"""
+    client = mqtt_client_instance
+    if client is None:
+        return
 
+    wanted = set(router.subscriptions())
+    if subscription_group:
+        wanted = {shared_topic(topic, subscription_group) for topic in wanted}
 
-def on_log(client, userdata, level, buf):
-    logger.debug(f"MQTT лог: {buf}")
+    for topic in sorted(wanted - subscribed_topics):
+        await client.subscribe(topic, qos=config.MQTT_QOS)
+        subscribed_topics.add(topic)
+        logger.info(f"Подписка на топик: {topic} (QoS {config.MQTT_QOS})")
+    for topic in sorted(subscribed_topics - wanted):
+        await client.unsubscribe(topic)
+        subscribed_topics.discard(topic)
+        logger.info(f"Отписка от топика: {topic}")
 
 
-# Функция для запуска MQTT клиента в отдельном потоке
-def mqtt_client_thread():
-    global mqtt_client_instance, mqtt_connected, stop_flag
+def enqueue_message(queue, topic, payload):
+    """Помещает сообщение в очередь вместе со временем приема. Клиент MQTT подтверждает сообщения
+    при получении (PUBACK для QoS 1) и не может приостановить брокер, поэтому ожидание здесь
+    лишь копило бы сообщения во внутренней очереди клиента: при переполнении показания
+    отбрасываются очередью приема с учетом в mqtt_queue_shed, оповещения принимаются всегда"""
+    received_meter.mark()
+    queue.offer((topic, payload, receive_time()))
+    queue_depth.set(queue.qsize())
 
-    # Создаем и настраиваем клиент
-    client = mqtt.Client()
-    mqtt_client_instance = client
 
-    # Устанавливаем обработчики
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.on_disconnect = on_disconnect
+# Асинхронный цикл приема сообщений из MQTT брокера
+async def mqtt_ingest():
+    global mqtt_connected, mqtt_client_instance
 
-    # Устанавливаем учетные данные, если указаны
-    if config.MQTT_USERNAME and config.MQTT_PASSWORD:
-        client.username_pw_set(config.MQTT_USERNAME, config.MQTT_PASSWORD)
+    queue = get_message_queue()
 
     # Бесконечный цикл повторных попыток подключения
     while not stop_flag:
         try:
-            if not mqtt_connected:
-                logger.info(f"Попытка подключения к MQTT брокеру {config.MQTT_BROKER}:{int(config.MQTT_PORT)}...")
-                client.connect(config.MQTT_BROKER, int(config.MQTT_PORT), 60)
-
-            # Запускаем цикл обработки сообщений
-            client.loop_start()
-
-            # Ожидаем, пока не будет установлен флаг остановки
-            while not stop_flag:
-                time.sleep(1)
-                if not mqtt_connected:
-                    break
-
-            # Останавливаем цикл
-            client.loop_stop()
-
-            # Если установлен флаг остановки, выходим из основного цикла
-            if stop_flag:
-                break
+            logger.info(f"Попытка подключения к MQTT брокеру {config.MQTT_BROKER}:{int(config.MQTT_PORT)}...")
+            async with Client(
+                hostname=config.MQTT_BROKER,
+                port=int(config.MQTT_PORT),
+                username=config.MQTT_USERNAME or None,
+                password=config.MQTT_PASSWORD or None,
+                protocol=ProtocolVersion(protocol_version) if protocol_version else None,
+            ) as client:
+                mqtt_connected = True
+                mqtt_client_instance = client
+                subscribed_topics.clear()
+                logger.info(f"Подключено к MQTT брокеру {config.MQTT_BROKER}:{config.MQTT_PORT}")
+
+                # Внутренняя очередь клиента не ограничена: она сразу разбирается в очередь приема,
+                # которая и задает предел (клиент отбрасывал бы сообщения сверх своего предела без учета)
+                async with client.messages() as messages:
+                    await sync_subscriptions(get_router())
+
+                    async for message in messages:
+                        logger.debug(f"Получено сообщение от {message.topic.value}")
+                        enqueue_message(queue, message.topic.value, message.payload)
+                        if stop_flag:
+                            break
+
+        except MqttError as e:
+            logger.warning(f"Соединение с MQTT брокером потеряно: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка MQTT клиента: {e}")
+        finally:
+            mqtt_connected = False
+            mqtt_client_instance = None
 
-            # Иначе ждем немного и пробуем подключиться снова
+        if not stop_flag:
+            # Ждем немного и пробуем подключиться снова
             logger.info("Переподключение к MQTT брокеру...")
-            time.sleep(5)
+            await asyncio.sleep(config.MQTT_RECONNECT_INTERVAL)
+
+    logger.info("MQTT клиент отключен")
+
+
+# Обработка пакета сообщений из очереди
+async def handle_batch(batch):
+    from kafka.producer import produce_batch
+    from processing.data_processor import process_batch
+
+    router = get_router()
+    decoder = get_decoder()
+    malformed_before = malformed_counter.value
+    started = time.perf_counter()
+
+    binary_kafka = config.KAFKA_WIRE_FORMAT == "binary"
+    kafka_messages = []
+    kafka_readings = {}  # Показания для упаковки в двоичные кадры по топику Kafka и датчику
+    readings = []
+    alerts = []
+    for topic, payload, received in batch:
+        route = router.match(topic)
+        if route is None:
+            continue
+
+        # Формат определяется по первому байту: двоичный кадр или JSON
+        if is_binary(payload):
+            decoded = decoder.decode_binary(payload)
+            if not decoded:
+                continue
+            readings.extend(decoded)
+            key = decoded[0].sensor_id
+        else:
+            # Декодируем сообщение за один проход: показание или оповещение. Сообщению без метки
+            # времени устройства присваивается время приема, и в Kafka оно уходит уже с ним:
+            # в режиме both консьюмер получит то же время, и повтор будет отсеян
+            decoded, payload = decoder.decode_received(payload, route, received)
+            if decoded is None:
+                continue
+            if isinstance(decoded, Reading):
+                readings.append(decoded)
+                if binary_kafka:
+                    # JSON-показания перекодируются для Kafka в двоичные кадры
+                    kafka_readings.setdefault((route.kafka_topic, decoded.sensor_id), []).append(decoded)
+                    continue
+                key = decoded.sensor_id
+            else:
+                alerts.append(decoded)
+                key = decoded.get("sensor_id")
+
+        # В Kafka передаем исходные байты (кроме дополненных временем приема), ключ - датчик
+        kafka_messages.append((route.kafka_topic, payload, key))
+
+    for (kafka_topic, sensor_id), topic_readings in kafka_readings.items():
+        for frame in encode_frames((r.sensor_id, r.ts, r.value) for r in topic_readings):
+            kafka_messages.append((kafka_topic, frame, sensor_id))
+
+    decode_stage.record(started, len(batch))
+    processed_meter.mark(len(batch))
+    queue_depth.set(message_queue.qsize())
+
+    malformed = malformed_counter.value - malformed_before
+    if malformed:
+        logger.warning(f"Пропущено некорректных сообщений в пакете: {malformed} из {len(batch)}")
+
+    if not kafka_messages:
+        return
+
+    # Отправляем в Kafka (если доступен)
+    try:
+        await produce_batch(kafka_messages)
+    except Exception as e:
+        logger.error(f"Ошибка отправки в Kafka: {e}")
 
-        except Exception as e:
-            logger.error(f"Ошибка MQTT клиента: {e}")
-            time.sleep(5)
+    # В режиме kafka показания в БД записывают консьюмеры, здесь только публикация
+    if config.INGEST_MODE == "kafka":
+        return
 
-    # Отключаемся при выходе
+    # Обрабатываем данные напрямую (без Kafka)
     try:
-        if mqtt_connected:
-            client.disconnect()
-            logger.info("MQTT клиент отключен")
+        await process_batch(readings, alerts)
     except Exception as e:
-        logger.error(f"Ошибка при отключении MQTT клиента: {e}")
+        logger.error(f"Ошибка обработки данных: {e}")
 
 
 # Асинхронная функция для обработки сообщений из очереди
 async def process_message_queue():
-    from kafka.producer import produce_message
-    from processing.data_processor import process_data
-    
-    while not stop_flag:
-        try:
-            # Проверяем очередь
-            if not message_queue.empty():
-                try:
-                    topic, payload = message_queue.get_nowait()
-                    
-                    # Парсим данные
-                    data = json.loads(payload)
-                    
-                    # Определяем топик Kafka
-                    kafka_topic = determine_kafka_topic(topic)
-                    
-                    # Отправляем в Kafka (если доступен)
-                    try:
-                        await produce_message(kafka_topic, data)
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки в Kafka: {e}")
-                    
-                    # Обрабатываем данные напрямую (без Kafka)
-                    try:
-                        await process_data(topic, data)
-                    except Exception as e:
-                        logger.error(f"Ошибка обработки данных: {e}")
-                    
-                except json.JSONDecodeError:
-                    logger.error(f"Ошибка декодирования JSON: {payload}")
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке сообщения из очереди: {e}")
-            
-            # Небольшая пауза для экономии ресурсов
-            await asyncio.sleep(0.1)
-            
-        except Exception as e:
-            logger.error(f"Ошибка в обработчике очереди сообщений: {e}")
-            await asyncio.sleep(1)
+    batcher = MicroBatcher(
+        get_message_queue(),
+        handle_batch,
+        max_size=config.INGEST_BATCH_SIZE,
+        max_delay_ms=config.INGEST_BATCH_LINGER_MS,
+        name="ingest"
+    )
+    await batcher.run()
 
 
 # Асинхронная функция для запуска MQTT клиента
 async def mqtt_client():
+    from kafka.producer import replay_spool
     global stop_flag
 
     # Сбрасываем флаг остановки
     stop_flag = False
 
-    # Создаем и запускаем поток MQTT клиента
-    thread = threading.Thread(target=mqtt_client_thread)
-    thread.daemon = True
-    thread.start()
+    # Маршруты загружаются до подключения, чтобы сразу подписаться на нужные топики
+    add_reload_listener(sync_subscriptions)
+    await reload_router()
 
-    # Запускаем асинхронную обработку сообщений
-    queue_processor = asyncio.create_task(process_message_queue())
+    # Запускаем прием и обработку сообщений в одном цикле событий
+    tasks = [
+        asyncio.create_task(mqtt_ingest()),
+        asyncio.create_task(process_message_queue()),
+        asyncio.create_task(router_reload_loop()),
+        asyncio.create_task(replay_spool())
+    ]
 
-    # Ждем, пока не будет установлен флаг остановки
     try:
-        while not stop_flag:
-            await asyncio.sleep(1)
+        await asyncio.gather(*tasks)
     except asyncio.CancelledError:
         logger.info("Получен сигнал остановки MQTT клиента")
         stop_flag = True
 
-        # Отменяем обработчик очереди
-        queue_processor.cancel()
-        try:
-            await queue_processor
-        except asyncio.CancelledError:
-            pass
-
-        # Ждем завершения потока
-        if thread.is_alive():
-            thread.join(timeout=5)
+        # Отменяем прием и обработку сообщений
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
         raise
 
@@ -237,4 +269,4 @@ async def mqtt_client():
 async def stop_mqtt_client():
     global stop_flag
     stop_flag = True
-    logger.info("Отправлен запрос на остановку MQTT клиента")
\ No newline at end of file
+    logger.info("Отправлен запрос на остановку MQTT клиента")
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from collections import namedtuple
+from sqlalchemy import select
+from config import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Результат маршрутизации: топик Kafka, датчик, ключ значения в сообщении и признак топика оповещений
+Route = namedtuple("Route", ["kafka_topic", "sensor_id", "value_key", "alert"], defaults=(False,))
+
+# Топик Kafka оповещений устройств
+ALERTS_TOPIC = "alerts"
+
+# Маршруты по умолчанию, если в таблице sensors нет настроенных топиков
+DEFAULT_ROUTES = {
+    "extruder/temperature/#": Route("extruder_temperature", None, "temperature"),
+    "extruder/move_speed/#": Route("extruder_move_speed", None, "move_speed"),
+    "extruder/isolation_thickness/#": Route("extruder_isolation_thickness", None, "isolation_thickness"),
+    "extruder/cable_core_profile/#": Route("extruder_cable_core_profile", None, "cable_core_profile"),
+    "extruder/alerts/#": Route(ALERTS_TOPIC, None, None, alert=True),
+}
+
+unrouted_counter = metrics.counter("router_unrouted")
+reload_counter = metrics.counter("router_reloads")
+
+
+class _Node:
+    __slots__ = ("children", "route", "wildcard_route")
+
+    def __init__(self):
+        self.children = {}
+        self.route = None           # Маршрут для топика, заканчивающегося на этом уровне
+        self.wildcard_route = None  # Маршрут шаблона '#' на этом уровне
+
+
+class TopicRouter:
+    """Префиксное дерево MQTT-шаблонов с поддержкой '+' и '#', компилируется один раз"""
+
+    def __init__(self, routes: dict):
+        self.routes = dict(routes)
+        self._root = _Node()
+        self._cache = {}
+        for pattern, route in self.routes.items():
+            self._insert(pattern, route)
+
+    def _insert(self, pattern, route):
+        node = self._root
+        levels = pattern.split("/")
+        for i, level in enumerate(levels):
+            if level == "#":
+                if i != len(levels) - 1:
+                    raise ValueError(f"Шаблон '#' допускается только в конце топика: {pattern}")
+                node.wildcard_route = route
+                return
+            node = node.children.setdefault(level, _Node())
+        node.route = route
+
+    def _match(self, levels, index, node):
+        # '#' совпадает и с родительским уровнем: "a/#" подходит для "a"
+        if index == len(levels):
+            return node.route or node.wildcard_route
+
+        # Точное совпадение важнее '+', а '+' важнее '#'
+        child = node.children.get(levels[index])
+        if child is not None:
+            route = self._match(levels, index + 1, child)
+            if route is not None:
+                return route
+        child = node.children.get("+")
+        if child is not None:
+            route = self._match(levels, index + 1, child)
+            if route is not None:
+                return route
+        return node.wildcard_route
+
+    def match(self, topic):
+        """Возвращает маршрут для топика или None"""
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        route = self._match(topic.split("/"), 0, self._root)
+        if route is None:
+            unrouted_counter.inc()
+        elif len(self._cache) < config.ROUTER_CACHE_SIZE:
+            self._cache[topic] = route
+        return route
+
+    def subscriptions(self):
+        """Шаблоны, на которые нужно подписаться в брокере"""
+        return sorted(self.routes)
+
+
+router = TopicRouter(DEFAULT_ROUTES)
+_listeners = []
+
+
+def add_reload_listener(callback):
+    """Регистрирует корутину, вызываемую после замены маршрутизатора"""
+    _listeners.append(callback)
+
+
+def get_router():
+    return router
+
+
+async def load_routes():
+    """Загружает сопоставление топиков с датчиками из таблицы sensors"""
+    from database.connection import async_session
+    from database.models import Sensors
+
+    async with async_session() as session:
+        query = select(Sensors.mqtt_topic, Sensors.kafka_topic, Sensors.id, Sensors.value_key).where(
+            Sensors.mqtt_topic.is_not(None),
+            Sensors.active == True
+        )
+        result = await session.execute(query)
+        rows = result.all()
+
+    routes = dict(DEFAULT_ROUTES)
+    for mqtt_topic, kafka_topic, sensor_id, value_key in rows:
+        default = routes.get(mqtt_topic)
+        kafka_topic = kafka_topic or (default.kafka_topic if default else "default_data")
+        # Датчик без value_key - не оповещения: значение ищется по ключам по умолчанию
+        routes[mqtt_topic] = Route(
+            kafka_topic,
+            sensor_id,
+            value_key or (default.value_key if default else None),
+            alert=kafka_topic == ALERTS_TOPIC
+        )
+    return routes
+
+
+async def reload_router():
+    """Перечитывает маршруты и заменяет маршрутизатор, если таблица изменилась"""
+    global router
+    try:
+        routes = await load_routes()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки маршрутов MQTT из БД: {e}")
+        return False
+
+    if routes == router.routes:
+        return False
+
+    router = TopicRouter(routes)
+    reload_counter.inc()
+    logger.info(f"Маршрутизатор MQTT перестроен, шаблонов: {len(routes)}")
+    for callback in _listeners:
+        try:
+            await callback(router)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика перезагрузки маршрутов: {e}")
+    return True
+
+
+async def router_reload_loop():
+    """Периодически проверяет таблицу sensors и перестраивает маршрутизатор при изменениях"""
+    while True:
+        await reload_router()
+        await asyncio.sleep(config.ROUTER_RELOAD_INTERVAL)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+from config import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Процессы используют spawn, чтобы не наследовать цикл событий и соединения родителя
+_context = multiprocessing.get_context("spawn")
+
+
+def shared_topic(topic, group):
+    """Шаблон общей подписки MQTT 5: брокер распределяет сообщения между участниками группы"""
+    return f"$share/{group}/{topic}"
+
+
+async def _report_stats(index, stats_queue):
+    """Периодически отправляет родительскому процессу счетчики пропускной способности воркера"""
+    received = metrics.meter("mqtt_received")
+    processed = metrics.meter("mqtt_processed")
+    while True:
+        await asyncio.sleep(config.MQTT_WORKER_STATS_INTERVAL)
+        try:
+            stats_queue.put_nowait({
+                "worker": index,
+                "received": received.total,
+                "received_rate": round(received.rate(), 2),
+                "processed": processed.total,
+                "processed_rate": round(processed.rate(), 2),
+                "queue_depth": metrics.gauge("mqtt_queue_depth").value,
+            })
+        except queue.Full:
+            pass
+
+
+async def _worker_loop(index, stats_queue):
+    from mqtt import client
+    from kafka import producer
+
+    # Подписки воркера идут через общую группу с протоколом MQTT 5
+    client.subscription_group = config.MQTT_SHARED_GROUP
+    client.protocol_version = 5
+    # У каждого воркера свой каталог спула
+    producer.spool_name = f"worker-{index}"
+
+    reporter = asyncio.create_task(_report_stats(index, stats_queue))
+    try:
+        await client.mqtt_client()
+    finally:
+        reporter.cancel()
+
+
+def worker_main(index, stats_queue):
+    """Точка входа процесса-воркера приема MQTT"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    try:
+        asyncio.run(_worker_loop(index, stats_queue))
+    except KeyboardInterrupt:
+        pass
+
+
+class IngestWorkerPool:
+    """Пул процессов приема MQTT, подписанных через общую подписку"""
+
+    def __init__(self, size):
+        self.size = size
+        self.stats_queue = _context.Queue(maxsize=1000)
+        self.processes = {}
+
+    def _start_worker(self, index):
+        process = _context.Process(
+            target=worker_main,
+            args=(index, self.stats_queue),
+            name=f"mqtt-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Запущен воркер приема MQTT {index} (pid={process.pid})")
+
+    def start(self):
+        for index in range(self.size):
+            self._start_worker(index)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=5)
+        self.processes.clear()
+        logger.info("Воркеры приема MQTT остановлены")
+
+    def _collect_stats(self):
+        """Переносит накопленную статистику воркеров в метрики родительского процесса"""
+        while True:
+            try:
+                stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            prefix = f"mqtt_worker_{stats['worker']}"
+            for key in ("received", "received_rate", "processed", "processed_rate", "queue_depth"):
+                metrics.gauge(f"{prefix}_{key}").set(stats[key])
+
+    async def supervise(self):
+        """Собирает статистику и перезапускает упавшие воркеры"""
+        while True:
+            await asyncio.sleep(config.MQTT_WORKER_STATS_INTERVAL)
+            self._collect_stats()
+            total_rate = sum(
+                metrics.gauge(f"mqtt_worker_{index}_received_rate").value for index in self.processes
+            )
+            metrics.gauge("mqtt_workers_received_rate").set(round(total_rate, 2))
+
+            for index, process in list(self.processes.items()):
+                if not process.is_alive():
+                    logger.warning(f"Воркер приема MQTT {index} завершился с кодом {process.exitcode}, перезапуск")
+                    metrics.counter("mqtt_worker_restarts").inc()
+                    self._start_worker(index)
+
+
+async def run_ingest_workers(size=None):
+    """Запускает N процессов приема MQTT и следит за ними до отмены задачи"""
+    pool = IngestWorkerPool(size or config.MQTT_INGEST_WORKERS)
+    pool.start()
+    try:
+        await pool.supervise()
+    finally:
+        pool.stop()
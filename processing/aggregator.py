@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import text, select, func
+from sqlalchemy.dialects.postgresql import insert
+from config import config
+from metrics import metrics
+from database.connection import async_session
+from database.models import SensorRollup, RollupBackfill, CurrentValues
+
+logger = logging.getLogger(__name__)
+
+# Длины окон агрегации, секунды, и соответствующие единицы date_trunc
+RESOLUTIONS = (1, 60, 3600)
+RESOLUTION_UNITS = ("second", "minute", "hour")
+BACKFILL_ID = 1  # Строка отметки в rollup_backfill
+
+open_windows_gauge = metrics.gauge("rollup_open_windows")
+flushed_counter = metrics.counter("rollup_flushed")
+flush_errors = metrics.counter("rollup_flush_errors")
+
+
+def rollup_resolution(period_seconds, max_error=0.01):
+    """Наибольшая длина окна, при которой неполные окна на границах периода дают погрешность не больше max_error"""
+    suitable = [resolution for resolution in RESOLUTIONS if resolution <= period_seconds * max_error]
+    return max(suitable, default=RESOLUTIONS[0])
+
+
+class Window:
+    """Агрегаты показаний датчика за одно окно"""
+    __slots__ = ("count", "sum", "min", "max", "out_of_range")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.out_of_range = 0
+
+    def add(self, value, outside):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if outside:
+            self.out_of_range += 1
+
+
+class RollupAggregator:
+    """Неперекрывающиеся окна 1 с, 1 мин и 1 ч по каждому датчику.
+    Окно закрывается, когда время устройства (или системное, если показаний нет) уходит
+    за его конец на ROLLUP_LATENESS_SECONDS;
+    закрытые окна записываются в sensor_rollups. Опоздавшие показания попадают в новое окно
+    с тем же началом, и при записи агрегаты складываются с уже сохраненными"""
+
+    def __init__(self, lateness):
+        self.lateness = lateness
+        self.windows = {}  # (sensor_id, resolution, начало окна) -> Window
+        self.watermark = 0.0  # Наибольшее время устройства среди показаний
+        self._flusher = None
+
+    def add_batch(self, readings, outside_rows=()):
+        """Добавляет пакет показаний; outside_rows - номера показаний вне пределов"""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self.flush_loop())
+        windows = self.windows
+        for row, reading in enumerate(readings):
+            ts = reading.ts
+            outside = row in outside_rows
+            for resolution in RESOLUTIONS:
+                key = (reading.sensor_id, resolution, int(ts // resolution) * resolution)
+                window = windows.get(key)
+                if window is None:
+                    window = windows[key] = Window()
+                window.add(reading.value, outside)
+            if ts > self.watermark:
+                self.watermark = ts
+        open_windows_gauge.set(len(windows))
+
+    def take_closed(self, force=False):
+        """Забирает окна, закрытые относительно водяного знака (или все при force)"""
+        closed = {}
+        # Если показания перестали поступать, окна закрываются по системному времени
+        watermark = max(self.watermark, time.time())
+        for key in list(self.windows):
+            _, resolution, start = key
+            if force or start + resolution + self.lateness <= watermark:
+                closed[key] = self.windows.pop(key)
+        open_windows_gauge.set(len(self.windows))
+        return closed
+
+    async def flush(self, force=False):
+        """Записывает закрытые окна; при ошибке они возвращаются в память до следующей попытки"""
+        closed = self.take_closed(force)
+        if not closed:
+            return 0
+        rows = [
+            {
+                "sensors_id": sensor_id,
+                "resolution": resolution,
+                "window_start": datetime.fromtimestamp(start),
+                "count": window.count,
+                "sum": window.sum,
+                "min": window.min,
+                "max": window.max,
+                "out_of_range": window.out_of_range,
+            }
+            for (sensor_id, resolution, start), window in closed.items()
+        ]
+        statement = insert(SensorRollup)
+        excluded = statement.excluded
+        # Повторная запись окна (опоздавшие показания, несколько процессов) дополняет агрегаты
+        statement = statement.on_conflict_do_update(
+            index_elements=["sensors_id", "resolution", "window_start"],
+            set_={
+                "count": SensorRollup.count + excluded.count,
+                "sum": SensorRollup.sum + excluded.sum,
+                "min": text("LEAST(sensor_rollups.min, excluded.min)"),
+                "max": text("GREATEST(sensor_rollups.max, excluded.max)"),
+                "out_of_range": SensorRollup.out_of_range + excluded.out_of_range,
+            }
+        )
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    await session.execute(statement, rows)
+        except Exception as e:
+            flush_errors.inc()
+            self._restore(closed)
+            logger.error(f"Ошибка записи агрегатов показаний ({len(rows)} окон): {e}")
+            return 0
+        flushed_counter.inc(len(rows))
+        logger.debug(f"Записано окон агрегации: {len(rows)}")
+        return len(rows)
+
+    def _restore(self, closed):
+        for key, window in closed.items():
+            current = self.windows.get(key)
+            if current is None:
+                self.windows[key] = window
+                continue
+            current.count += window.count
+            current.sum += window.sum
+            current.min = min(current.min, window.min)
+            current.max = max(current.max, window.max)
+            current.out_of_range += window.out_of_range
+        open_windows_gauge.set(len(self.windows))
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(config.ROLLUP_FLUSH_INTERVAL)
+            await self.flush()
+
+
+async def prepare_rollup_backfill():
+    """Фиксирует до начала приема границу построения агрегатов по сохраненным показаниям: id последнего
+    показания. Показания после границы агрегирует RollupAggregator, поэтому агрегаты не задваиваются
+    и не теряются при любом порядке записи. Возвращает границу или None, если строить нечего"""
+    async with async_session() as session:
+        async with session.begin():
+            marker = await session.get(RollupBackfill, BACKFILL_ID, with_for_update=True)
+            if marker is None:
+                # Непустые агрегаты без отметки построены init_db и пополнялись агрегатором
+                has_rollups = (await session.execute(select(SensorRollup.id).limit(1))).first() is not None
+                cutoff = (await session.execute(select(func.max(CurrentValues.id)))).scalar()
+                marker = RollupBackfill(id=BACKFILL_ID, cutoff_id=cutoff, done=has_rollups or cutoff is None)
+                session.add(marker)
+            return None if marker.done else marker.cutoff_id
+
+
+async def backfill_rollups(cutoff_id):
+    """Строит агрегаты всех длин окон по показаниям с id не больше cutoff_id за один проход по таблице
+    и отмечает построение выполненным в той же транзакции. Агрегаты складываются с уже записанными"""
+    windows = " UNION ALL ".join(
+        f"""SELECT sensors_id, {resolution}, date_trunc('{unit}', window_start), sum(count), sum(sum),
+                   min(min), max(max), sum(out_of_range)
+            FROM seconds GROUP BY sensors_id, date_trunc('{unit}', window_start)"""
+        for resolution, unit in zip(RESOLUTIONS, RESOLUTION_UNITS)
+    )
+    async with async_session() as session:
+        async with session.begin():
+            marker = await session.get(RollupBackfill, BACKFILL_ID, with_for_update=True)
+            if marker is None or marker.done:
+                return
+            await session.execute(text(f"""
+                WITH seconds AS (
+                    SELECT cv.sensors_id, date_trunc('second', cv.time) AS window_start,
+                           count(*) AS count, sum(cv.value) AS sum, min(cv.value) AS min, max(cv.value) AS max,
+                           count(*) FILTER (WHERE cv.value < es.min_value OR cv.value > es.max_value) AS out_of_range
+                    FROM current_values cv
+                    LEFT JOIN (
+                        SELECT DISTINCT ON (sensor_id) sensor_id, min_value, max_value
+                        FROM equipment_settings ORDER BY sensor_id, id
+                    ) es ON es.sensor_id = cv.sensors_id
+                    WHERE cv.id <= :cutoff_id AND cv.time IS NOT NULL
+                    GROUP BY cv.sensors_id, date_trunc('second', cv.time)
+                )
+                INSERT INTO sensor_rollups (sensors_id, resolution, window_start, count, sum, min, max, out_of_range)
+                {windows}
+                ON CONFLICT (sensors_id, resolution, window_start) DO UPDATE SET
+                    count = sensor_rollups.count + excluded.count,
+                    sum = sensor_rollups.sum + excluded.sum,
+                    min = LEAST(sensor_rollups.min, excluded.min),
+                    max = GREATEST(sensor_rollups.max, excluded.max),
+                    out_of_range = sensor_rollups.out_of_range + excluded.out_of_range
+            """), {"cutoff_id": cutoff_id})
+            marker.done = True
+    logger.info(f"Агрегаты по сохраненным показаниям построены (id показаний до {cutoff_id})")
+
+
+_aggregator = None
+
+
+def get_aggregator():
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = RollupAggregator(config.ROLLUP_LATENESS_SECONDS)
+    return _aggregator
@@ -0,0 +1,241 @@
+import copy
+import logging
+from datetime import datetime
+from config import config
+from metrics import metrics
+from database.models import Events
+from processing.alerts import SYSTEM_USER_ID, threshold_message, evaluate_thresholds
+from processing.decoder import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Типы событий в столбце events.event_type
+EVENT_EXCURSION_OPEN = "excursion_open"
+EVENT_EXCURSION_CLOSE = "excursion_close"
+EVENT_DEVICE_ALERT = "device_alert"
+
+# Состояния отклонения по датчику; NORMAL - датчика нет в таблице состояний
+PENDING = "pending"  # Значение вне пределов, минимальная длительность еще не набрана
+OPEN = "open"
+
+open_gauge = metrics.gauge("alert_excursions_open")
+suppressed_counter = metrics.counter("alert_suppressed")
+merged_counter = metrics.counter("alert_device_merged")
+
+
+class Excursion:
+    """Отклонение показаний датчика от допустимых пределов"""
+    __slots__ = ("state", "started", "first_value", "extreme", "clear_since", "device_alerts", "source",
+                 "last_reading", "last_alert")
+
+    def __init__(self, ts, value, source):
+        self.state = PENDING
+        self.started = ts
+        self.first_value = value
+        self.extreme = value
+        self.clear_since = None
+        self.device_alerts = 0
+        self.source = source  # server - по показаниям, device - по оповещению устройства
+        self.last_reading = ts if source == "server" else None  # Время последнего показания отклонения
+        self.last_alert = ts if source == "device" else None  # Время последнего оповещения устройства
+
+    def update_extreme(self, value, meta):
+        # Экстремум - наиболее удаленное от нормы значение
+        if meta.max_value is not None and value > meta.max_value:
+            if self.extreme is None or value > self.extreme:
+                self.extreme = value
+        elif meta.min_value is not None and value < meta.min_value:
+            if self.extreme is None or value < self.extreme:
+                self.extreme = value
+
+
+def outside_rows_of(metadata, readings):
+    """Номера показаний пакета, вышедших за пределы"""
+    return set(evaluate_thresholds(
+        metadata,
+        [reading.sensor_id for reading in readings],
+        [reading.value for reading in readings]
+    ).tolist())
+
+
+def hysteresis_band(meta, fraction):
+    """Ширина полосы гистерезиса: доля диапазона или, при одном пределе, доля его модуля"""
+    if meta.min_value is not None and meta.max_value is not None:
+        return fraction * (meta.max_value - meta.min_value)
+    limit = meta.min_value if meta.min_value is not None else meta.max_value
+    return fraction * abs(limit or 0.0)
+
+
+def is_clear(meta, value, band):
+    """Отклонение закрывается только после возврата внутрь пределов, суженных на полосу гистерезиса"""
+    return ((meta.min_value is None or value >= meta.min_value + band) and
+            (meta.max_value is None or value <= meta.max_value - band))
+
+
+class AlertEngine:
+    """Автомат состояний оповещений по датчикам: одно событие на начало и одно на окончание
+    отклонения. Оповещения устройства о том же отклонении объединяются с серверными.
+    Состояние хранится в процессе; показания и оповещения датчика должны обрабатываться одним процессом.
+    В Kafka это обеспечивают ключ сообщения (id датчика) и распределение партиций по диапазонам
+    (kafka/bus.py): партиция с тем же номером во всех топиках достается одному консьюмеру, если
+    число партиций у топиков одинаковое. Если показания датчика сюда все же не приходят, отклонение,
+    открытое оповещением, закрывается после stale_after секунд без оповещений"""
+
+    def __init__(self, hysteresis, min_duration, clear_duration, stale_after):
+        self.hysteresis = hysteresis
+        self.min_duration = min_duration
+        self.clear_duration = clear_duration
+        self.stale_after = stale_after
+        self.excursions = {}  # sensor_id -> Excursion
+
+    def _event(self, sensor_id, event_type, description, ts):
+        return Events(
+            sensors_id=sensor_id,
+            description=description,
+            users_id=SYSTEM_USER_ID,
+            event_type=event_type,
+            time=datetime.fromtimestamp(ts)
+        )
+
+    def _open_event(self, sensor_id, meta, excursion):
+        message = None
+        if excursion.first_value is not None:
+            message = threshold_message(excursion.first_value, meta.min_value, meta.max_value)
+        message = message or "Оповещение устройства"
+        description = f"Начало отклонения: {message} для датчика '{meta.sensor_name}' ({meta.location_name})"
+        return self._event(sensor_id, EVENT_EXCURSION_OPEN, description, excursion.started)
+
+    def _close_event(self, sensor_id, meta, excursion, ts):
+        description = (f"Окончание отклонения для датчика '{meta.sensor_name}' ({meta.location_name}): "
+                       f"длительность {ts - excursion.started:.1f} с, экстремум {excursion.extreme}")
+        if excursion.device_alerts:
+            description += f", оповещений устройства: {excursion.device_alerts}"
+        return self._event(sensor_id, EVENT_EXCURSION_CLOSE, description, ts)
+
+    def observe(self, sensor_id, meta, ts, value, outside, events):
+        """Обрабатывает показание датчика с открытым или ожидающим отклонением либо вне пределов"""
+        excursion = self.excursions.get(sensor_id)
+        if excursion is None:
+            if not outside:
+                return
+            excursion = self.excursions[sensor_id] = Excursion(ts, value, "server")
+        excursion.last_reading = ts
+
+        if excursion.state == PENDING:
+            if not outside:
+                # Кратковременный выброс короче минимальной длительности не регистрируется
+                del self.excursions[sensor_id]
+                suppressed_counter.inc()
+                return
+            excursion.update_extreme(value, meta)
+            if ts - excursion.started >= self.min_duration:
+                excursion.state = OPEN
+                events.append(self._open_event(sensor_id, meta, excursion))
+            return
+
+        if is_clear(meta, value, hysteresis_band(meta, self.hysteresis)):
+            if excursion.clear_since is None:
+                excursion.clear_since = ts
+            if ts - excursion.clear_since >= self.clear_duration:
+                del self.excursions[sensor_id]
+                events.append(self._close_event(sensor_id, meta, excursion, ts))
+        else:
+            excursion.clear_since = None
+            excursion.update_extreme(value, meta)
+
+    def process_readings(self, metadata, readings, events, outside_rows=None):
+        """Пакет показаний: векторная проверка пределов, автомат - только для датчиков
+        с нарушением или с уже открытым отклонением"""
+        if not readings:
+            return
+        if outside_rows is None:
+            outside_rows = outside_rows_of(metadata, readings)
+        excursions = self.excursions
+        for row, reading in enumerate(readings):
+            outside = row in outside_rows
+            if not outside and reading.sensor_id not in excursions:
+                continue
+            meta = metadata.get(reading.sensor_id)
+            if meta is not None:
+                self.observe(reading.sensor_id, meta, reading.ts, reading.value, outside, events)
+
+    def process_device_alert(self, metadata, alert, events):
+        """Оповещение устройства: объединяется с отклонением датчика или открывает его"""
+        sensor_id = alert.get("sensor_id")
+        meta = metadata.get(sensor_id)
+        if meta is None:
+            logger.warning(f"Датчик с id={sensor_id} не найден при обработке оповещения")
+            return
+
+        try:
+            ts = parse_timestamp(alert.get("timestamp"))
+        except ValueError:
+            ts = parse_timestamp(None)
+
+        excursion = self.excursions.get(sensor_id)
+        if (excursion is not None and excursion.last_reading is None
+                and ts - excursion.last_alert > self.stale_after):
+            # Показания датчика в этот процесс не приходят, закрыть отклонение по ним нельзя
+            del self.excursions[sensor_id]
+            events.append(self._close_event(sensor_id, meta, excursion, excursion.last_alert))
+            excursion = None
+
+        if excursion is not None:
+            excursion.device_alerts += 1
+            excursion.last_alert = ts
+            merged_counter.inc()
+            if excursion.state == PENDING:
+                # Устройство подтверждает отклонение - минимальная длительность не ожидается
+                excursion.state = OPEN
+                events.append(self._open_event(sensor_id, meta, excursion))
+            return
+
+        if meta.min_value is None and meta.max_value is None:
+            # Пределы на сервере не заданы - закрыть отклонение по показаниям нельзя
+            events.append(self._event(sensor_id, EVENT_DEVICE_ALERT,
+                                      alert.get("message", "Оповещение без описания"), ts))
+            return
+
+        # Оповещение пришло раньше показания: отклонение открывается и закроется по показаниям
+        value = alert.get("value")
+        value = float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+        excursion = self.excursions[sensor_id] = Excursion(ts, value, "device")
+        excursion.device_alerts = 1
+        excursion.state = OPEN
+        events.append(self._open_event(sensor_id, meta, excursion))
+
+    def snapshot(self, sensor_ids):
+        """Копия состояния отклонений датчиков для восстановления, если пакет не будет записан"""
+        excursions = self.excursions
+        return {sensor_id: copy.copy(excursions.get(sensor_id)) for sensor_id in sensor_ids}
+
+    def restore(self, snapshot):
+        """Возвращает состояние отклонений датчиков к снимку"""
+        for sensor_id, excursion in snapshot.items():
+            if excursion is None:
+                self.excursions.pop(sensor_id, None)
+            else:
+                self.excursions[sensor_id] = excursion
+        open_gauge.set(sum(1 for excursion in self.excursions.values() if excursion.state == OPEN))
+
+    def process(self, metadata, readings=(), alerts=(), outside_rows=None):
+        """Возвращает события для пакета показаний и оповещений устройств"""
+        events = []
+        self.process_readings(metadata, readings, events, outside_rows)
+        for alert in alerts:
+            self.process_device_alert(metadata, alert, events)
+        open_gauge.set(sum(1 for excursion in self.excursions.values() if excursion.state == OPEN))
+        if events:
+            logger.warning(f"Создано событий об отклонениях: {len(events)}")
+        return events
+
+
+_engine = None
+
+
+def get_alert_engine():
+    global _engine
+    if _engine is None:
+        _engine = AlertEngine(config.ALERT_HYSTERESIS, config.ALERT_MIN_DURATION_SECONDS,
+                              config.ALERT_CLEAR_DURATION_SECONDS, config.ALERT_DEVICE_STALE_SECONDS)
+    return _engine
@@ -0,0 +1,125 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from config import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+jobs_counter = metrics.counter("analytics_jobs")
+timeouts_counter = metrics.counter("analytics_timeouts")
+cancelled_counter = metrics.counter("analytics_cancelled")
+errors_counter = metrics.counter("analytics_errors")
+running_gauge = metrics.gauge("analytics_running")
+job_ms = metrics.histogram("analytics_job_ms")
+
+
+def share_array(array):
+    """Копирует массив в общую память; возвращает сегмент и описание для процесса пула"""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    """Открывает массив из общей памяти без копирования (в процессе пула)"""
+    name, shape, dtype = spec
+    # Процессы пула используют трекер ресурсов родителя, сегмент удаляет родитель после задачи
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _run_job(func, specs, kwargs):
+    """Выполняется в процессе пула: подключает массивы и вызывает задачу"""
+    attached = [attach_array(spec) for spec in specs]
+    segments = [shm for shm, _ in attached]
+    try:
+        return func(*[array for _, array in attached], **kwargs)
+    finally:
+        # Представления массивов освобождаются до закрытия сегментов
+        del attached
+        for shm in segments:
+            shm.close()
+
+
+class AnalyticsExecutor:
+    """Пул процессов для тяжелой аналитики, чтобы не блокировать цикл событий
+    (прием MQTT, веб-сервер, WebSocket). Массивы передаются через общую память"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def _restart_pool(self):
+        """Прерывает зависшие задачи: процессы пула завершаются, следующий вызов создаст новый пул.
+        Остальные выполняющиеся задачи при этом завершатся с ошибкой, поэтому только по таймауту"""
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        # У ProcessPoolExecutor нет отмены запущенной задачи, процессы завершаются напрямую
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+        logger.warning("Пул аналитики перезапущен после отмены задачи")
+
+    async def run(self, func, *arrays, timeout=None, **kwargs):
+        """Выполняет func(*arrays, **kwargs) в процессе пула; при превышении timeout - TimeoutError"""
+        timeout = timeout or config.ANALYTICS_TIMEOUT_SECONDS
+        shared = [share_array(array) for array in arrays]
+        started = time.perf_counter()
+        jobs_counter.inc()
+        running_gauge.inc()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                self._get_pool(),
+                functools.partial(_run_job, func, [spec for _, spec in shared], kwargs)
+            )
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            timeouts_counter.inc()
+            logger.error(f"Задача аналитики {func.__name__} не уложилась в {timeout} с и прервана")
+            self._restart_pool()
+            raise
+        except asyncio.CancelledError:
+            # Клиент ушел: еще не начатая задача снимается с очереди пула, начатая дорабатывает,
+            # а ее результат отбрасывается - перезапуск пула прервал бы задачи других клиентов
+            cancelled_counter.inc()
+            raise
+        except Exception:
+            errors_counter.inc()
+            raise
+        finally:
+            running_gauge.dec()
+            job_ms.observe((time.perf_counter() - started) * 1000)
+            for shm, _ in shared:
+                shm.close()
+                shm.unlink()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+_executor = None
+
+
+def get_analytics_executor():
+    global _executor
+    if _executor is None:
+        _executor = AnalyticsExecutor(config.ANALYTICS_WORKERS)
+    return _executor
@@ -0,0 +1,53 @@
+import numpy as np
+
+# Тяжелые вычисления, выполняемые в процессах пула аналитики (processing/analytics_executor.py).
+# Функции получают массивы NumPy поверх общей памяти и возвращают небольшие результаты
+# из обычных типов Python, без ссылок на входные массивы.
+
+
+def long_range_statistics(timestamps, values, bins=50):
+    """Статистика показаний за длительный период: моменты, процентили и гистограмма"""
+    if not len(values):
+        return {"count": 0}
+    percentiles = np.percentile(values, [1, 5, 25, 50, 75, 95, 99])
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        "count": int(len(values)),
+        "from": float(timestamps[0]),
+        "to": float(timestamps[-1]),
+        "mean": float(values.mean()),
+        "std": float(values.std(ddof=1)) if len(values) > 1 else 0.0,
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "percentiles": dict(zip(("p1", "p5", "p25", "p50", "p75", "p95", "p99"), percentiles.tolist())),
+        "histogram": {"counts": counts.tolist(), "edges": edges.tolist()},
+    }
+
+
+def spectrum(timestamps, values, top=10):
+    """Спектр сигнала (например, толщины изоляции): показания приводятся к равномерной сетке,
+    возвращаются частоты с наибольшей амплитудой"""
+    if len(values) < 4:
+        return {"count": int(len(values)), "sample_rate": None, "peaks": []}
+
+    # Шаг сетки - медианный интервал между показаниями
+    step = float(np.median(np.diff(timestamps)))
+    if step <= 0:
+        return {"count": int(len(values)), "sample_rate": None, "peaks": []}
+    grid = np.arange(timestamps[0], timestamps[-1], step)
+    signal = np.interp(grid, timestamps, values)
+    signal = (signal - signal.mean()) * np.hanning(len(signal))
+
+    amplitudes = np.abs(np.fft.rfft(signal)) * 2 / len(signal)
+    frequencies = np.fft.rfftfreq(len(signal), d=step)
+    # Нулевая частота (постоянная составляющая) не учитывается
+    order = np.argsort(amplitudes[1:])[::-1][:top] + 1
+    return {
+        "count": int(len(values)),
+        "sample_rate": 1 / step,
+        "peaks": [
+            {"frequency": float(frequencies[i]), "period": float(1 / frequencies[i]), "amplitude": float(amplitudes[i])}
+            for i in order
+        ],
+    }
+
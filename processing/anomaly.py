@@ -0,0 +1,165 @@
+import math
+import logging
+from datetime import datetime
+import numpy as np
+from config import config
+from metrics import metrics
+from database.models import Events
+from processing.alerts import SYSTEM_USER_ID
+
+logger = logging.getLogger(__name__)
+
+# Тип события в столбце events.event_type
+EVENT_ANOMALY = "anomaly"
+
+anomaly_counter = metrics.counter("anomaly_detected")
+untracked_counter = metrics.counter("anomaly_untracked_readings")
+
+
+class AnomalyDetector:
+    """Обнаружение отклонений внутри допустимых пределов: z-оценка относительно скользящего
+    окна и контрольные границы EWMA. Кольцевые буферы всех датчиков - одна матрица NumPy
+    фиксированного размера (max_sensors x window), обработка показания - O(1)"""
+
+    def __init__(self, max_sensors, window, z_threshold, ewma_lambda, ewma_width, min_samples, cooldown):
+        self.window = window
+        self.z_threshold = z_threshold
+        self.ewma_lambda = ewma_lambda
+        # Границы EWMA: среднее ± L * sigma * sqrt(lambda / (2 - lambda))
+        self.ewma_factor = ewma_width * math.sqrt(ewma_lambda / (2 - ewma_lambda))
+        self.min_samples = min(min_samples, window)
+        self.cooldown = cooldown
+
+        self.buffers = np.zeros((max_sensors, window), dtype=np.float64)
+        self.counts = np.zeros(max_sensors, dtype=np.int64)
+        self.positions = np.zeros(max_sensors, dtype=np.int64)
+        self.sums = np.zeros(max_sensors, dtype=np.float64)
+        self.squares = np.zeros(max_sensors, dtype=np.float64)
+        self.ewma = np.full(max_sensors, np.nan, dtype=np.float64)
+        self.rows = {}  # sensor_id -> строка матрицы
+        self.last_event = {}  # sensor_id -> время последнего события
+
+    def _row(self, sensor_id):
+        row = self.rows.get(sensor_id)
+        if row is None:
+            if len(self.rows) >= len(self.counts):
+                # Память ограничена заранее: датчики сверх ANOMALY_MAX_SENSORS не отслеживаются
+                untracked_counter.inc()
+                return None
+            row = self.rows[sensor_id] = len(self.rows)
+        return row
+
+    def observe(self, sensor_id, value):
+        """Добавляет показание; возвращает (вид аномалии, среднее, СКО) или None"""
+        row = self._row(sensor_id)
+        if row is None:
+            return None
+
+        count = int(self.counts[row])
+        ewma = float(self.ewma[row])
+        ewma = value if math.isnan(ewma) else ewma + self.ewma_lambda * (value - ewma)
+        self.ewma[row] = ewma
+
+        # Проверка по окну до добавления текущего показания
+        anomaly = None
+        if count >= self.min_samples:
+            mean = self.sums[row] / count
+            std = math.sqrt(max(self.squares[row] / count - mean * mean, 0.0))
+            if std > 0:
+                if abs(value - mean) > self.z_threshold * std:
+                    anomaly = ("zscore", mean, std)
+                elif abs(ewma - mean) > self.ewma_factor * std:
+                    anomaly = ("ewma", mean, std)
+
+        # Кольцевой буфер: вытесняемое значение вычитается из сумм
+        position = int(self.positions[row])
+        if count == self.window:
+            old = self.buffers[row, position]
+            self.sums[row] -= old
+            self.squares[row] -= old * old
+        else:
+            self.counts[row] = count + 1
+        self.buffers[row, position] = value
+        self.sums[row] += value
+        self.squares[row] += value * value
+        position = (position + 1) % self.window
+        self.positions[row] = position
+        if position == 0:
+            # Раз за оборот суммы пересчитываются заново, чтобы не копилась ошибка округления
+            self.sums[row] = self.buffers[row].sum()
+            self.squares[row] = np.dot(self.buffers[row], self.buffers[row])
+        return anomaly
+
+    def _arrays(self):
+        return self.buffers, self.counts, self.positions, self.sums, self.squares, self.ewma
+
+    def snapshot(self, sensor_ids):
+        """Копия строк буферов датчиков и времени их последних событий для восстановления,
+        если пакет не будет записан"""
+        rows = [self.rows[sensor_id] for sensor_id in sensor_ids if sensor_id in self.rows]
+        new = [sensor_id for sensor_id in sensor_ids if sensor_id not in self.rows]
+        index = np.array(rows, dtype=np.int64)
+        last_event = {sensor_id: self.last_event.get(sensor_id) for sensor_id in sensor_ids}
+        return index, [array[index].copy() for array in self._arrays()], new, last_event
+
+    def restore(self, snapshot):
+        """Возвращает буферы и время последних событий датчиков к снимку;
+        строки, выделенные новым датчикам, остаются за ними, но очищаются"""
+        index, saved, new, last_event = snapshot
+        for array, values in zip(self._arrays(), saved):
+            array[index] = values
+        new_rows = np.array([self.rows[sensor_id] for sensor_id in new if sensor_id in self.rows], dtype=np.int64)
+        for array in self._arrays():
+            array[new_rows] = np.nan if array is self.ewma else 0
+        for sensor_id, ts in last_event.items():
+            if ts is None:
+                self.last_event.pop(sensor_id, None)
+            else:
+                self.last_event[sensor_id] = ts
+
+    def process(self, metadata, readings):
+        """Возвращает события об аномалиях пакета; для датчика не чаще раза в ANOMALY_COOLDOWN_SECONDS"""
+        events = []
+        for reading in readings:
+            anomaly = self.observe(reading.sensor_id, reading.value)
+            if anomaly is None:
+                continue
+            anomaly_counter.inc()
+            last = self.last_event.get(reading.sensor_id)
+            if last is not None and reading.ts - last < self.cooldown:
+                continue
+            self.last_event[reading.sensor_id] = reading.ts
+
+            kind, mean, std = anomaly
+            meta = metadata.get(reading.sensor_id)
+            sensor = f"'{meta.sensor_name}' ({meta.location_name})" if meta is not None else f"id={reading.sensor_id}"
+            method = "z-оценка" if kind == "zscore" else "EWMA"
+            events.append(Events(
+                sensors_id=reading.sensor_id,
+                description=(f"Аномалия ({method}): значение {reading.value} при среднем {mean:.4g} "
+                             f"и СКО {std:.3g} для датчика {sensor}"),
+                users_id=SYSTEM_USER_ID,
+                event_type=EVENT_ANOMALY,
+                time=datetime.fromtimestamp(reading.ts)
+            ))
+        if events:
+            logger.warning(f"Обнаружено аномалий: {len(events)}")
+        return events
+
+
+_detector = None
+
+
+def get_anomaly_detector():
+    global _detector
+    if _detector is None:
+        _detector = AnomalyDetector(
+            config.ANOMALY_MAX_SENSORS,
+            config.ANOMALY_WINDOW,
+            config.ANOMALY_Z_THRESHOLD,
+            config.ANOMALY_EWMA_LAMBDA,
+            config.ANOMALY_EWMA_WIDTH,
+            config.ANOMALY_MIN_SAMPLES,
+            config.ANOMALY_COOLDOWN_SECONDS
+        )
+    return _detector
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограммы размеров пакетов
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class MicroBatcher:
+    """Собирает элементы очереди в пакеты: сброс по N элементам или через T мс, что наступит раньше"""
+
+    def __init__(self, queue: asyncio.Queue, handler, max_size: int, max_delay_ms: int, name: str = "ingest"):
+        self.queue = queue
+        self.handler = handler
+        self.max_size = max(1, max_size)
+        self.max_delay = max(0, max_delay_ms) / 1000
+        self.name = name
+
+        self.size_histogram = metrics.histogram(f"{name}_batch_size", BATCH_SIZE_BUCKETS)
+        self.fill_histogram = metrics.histogram(f"{name}_batch_fill_ms")
+        self.latency_histogram = metrics.histogram(f"{name}_batch_latency_ms")
+        self.errors = metrics.counter(f"{name}_batch_errors")
+
+    async def next_batch(self):
+        """Ожидает первый элемент и добирает пакет до лимита размера или времени"""
+        batch = [await self.queue.get()]
+        started = time.perf_counter()
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+
+        while len(batch) < self.max_size:
+            # Сначала забираем все, что уже лежит в очереди
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        self.fill_histogram.observe((time.perf_counter() - started) * 1000)
+        return batch
+
+    async def flush(self, batch):
+        """Передает пакет обработчику и фиксирует метрики"""
+        started = time.perf_counter()
+        try:
+            await self.handler(batch)
+        except Exception as e:
+            self.errors.inc()
+            logger.error(f"Ошибка обработки пакета {self.name} из {len(batch)} сообщений: {e}")
+        finally:
+            self.size_histogram.observe(len(batch))
+            self.latency_histogram.observe((time.perf_counter() - started) * 1000)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def run(self):
+        """Основной цикл сборки и сброса пакетов"""
+        logger.info(f"Микро-пакетирование {self.name}: до {self.max_size} сообщений или {self.max_delay * 1000:.0f} мс")
+        while True:
+            batch = await self.next_batch()
+            await self.flush(batch)
@@ -1,163 +1,166 @@
-import asyncio
 import logging
-import json
-from sqlalchemy import select
-from database.connection import async_session
-from database.models import CurrentValues, Sensors, Events, EquipmentSettings
-from processing.alerts import check_alert_conditions
+import math
+from functools import partial
+from config import config
+from metrics import metrics
+from database.telemetry_writer import write_telemetry
+from processing.alert_engine import get_alert_engine, outside_rows_of
+from processing.aggregator import get_aggregator
+from processing.running_stats import get_running_stats
+from processing.anomaly import get_anomaly_detector
+from processing.spc import get_spc_engine
+from processing.latest_values import get_latest_values_store
+from processing.dedup import drop_duplicates, forget, alert_key
+from processing.metadata import get_metadata
+from processing.pipeline import Pipeline, PipelineBatch
 
 logger = logging.getLogger(__name__)
 
 
-async def process_data(topic, data):
-    """Асинхронная обработка данных, полученных из MQTT"""
+# Физически допустимые значения по типу датчика (Sensors.value_key); показания вне них -
+# ошибка датчика или передачи, а не отклонение процесса, и в БД не записываются
+SENSOR_TYPE_LIMITS = {
+    "temperature": (-273.15, math.inf),
+    "move_speed": (0.0, math.inf),
+    "isolation_thickness": (0.0, math.inf),
+    "cable_core_profile": (0.0, math.inf),
+}
+
+rejected_counter = metrics.counter("pipeline_rejected")
+unknown_counter = metrics.counter("pipeline_unknown_sensor")
+
+
+def dedup_stage(batch):
+    """Повторные доставки (QoS 1, перезапуск Kafka, режим both) отсекаются до записи в БД"""
+    batch.readings = drop_duplicates(batch.readings)
+    batch.alerts = drop_duplicates(batch.alerts, alert_key)
+
+
+async def validate_stage(batch):
+    """Отбрасывает показания неизвестных датчиков, нечисловые (NaN, бесконечность)
+    и физически невозможные для типа датчика значения"""
+    # Кэш обновляется здесь же: в новом процессе воркера или консьюмера он еще пуст
+    metadata = await get_metadata()
+    valid = []
+    for reading in batch.readings:
+        meta = metadata.get(reading.sensor_id)
+        if meta is None and metadata.loaded:
+            # Показание неизвестного датчика нарушило бы внешний ключ и сорвало запись всего пакета
+            unknown_counter.inc()
+            logger.debug(f"Отброшено показание неизвестного датчика: {reading}")
+            continue
+        value = reading.value
+        if math.isfinite(value):
+            limits = SENSOR_TYPE_LIMITS.get(meta.sensor_type) if meta is not None else None
+            if limits is None or limits[0] <= value <= limits[1]:
+                valid.append(reading)
+                continue
+        rejected_counter.inc()
+        logger.debug(f"Отброшено недопустимое показание: {reading}")
+    batch.readings = valid
+
+
+async def enrich_stage(batch):
+    """Метаданные датчиков и номера показаний вне пределов - для оповещений и агрегатов"""
+    batch.metadata = await get_metadata()
+    batch.outside_rows = outside_rows_of(batch.metadata, batch.readings) if batch.readings else set()
+
+
+def alert_stage(batch):
+    """События отклонений и аномалий; требует стадии enrich.
+    Если пакет не будет записан, состояние отклонений и окон аномалий восстанавливается -
+    повтор пакета создаст те же события"""
+    engine = get_alert_engine()
+    sensor_ids = {reading.sensor_id for reading in batch.readings}
+    sensor_ids.update(alert.get("sensor_id") for alert in batch.alerts)
+    batch.on_rollback(partial(engine.restore, engine.snapshot(sensor_ids)))
+    # Одно событие на начало и одно на окончание отклонения, оповещения устройств объединяются с ним
+    batch.events += engine.process(batch.metadata, batch.readings, batch.alerts, batch.outside_rows)
+    if config.ANOMALY_ENABLED:
+        # Без восстановления повтор пакета учел бы показания в окнах и EWMA дважды
+        detector = get_anomaly_detector()
+        snapshot = detector.snapshot({reading.sensor_id for reading in batch.readings})
+        batch.on_rollback(partial(detector.restore, snapshot))
+        batch.events += detector.process(batch.metadata, batch.readings)
+
+
+def spc_stage(batch):
+    """Подгруппы контрольных карт и события о нарушении правил Western Electric; требует стадии enrich.
+    Если пакет не будет записан, подгруппы восстанавливаются - повтор не попадет в них дважды"""
+    engine = get_spc_engine()
+    tracked = {reading.sensor_id for reading in batch.readings if engine.tracks(batch.metadata.get(reading.sensor_id))}
+    batch.on_rollback(partial(engine.restore, engine.snapshot(tracked)))
+    batch.events += engine.process(batch.metadata, batch.readings)
+
+
+async def persist_stage(batch):
+    """Сохраняет показания и все вызванные ими события одной транзакцией; при ошибке - исключение"""
+    await write_telemetry(batch.readings, batch.events)
+    # Пакет записан: изменения состояния стадий окончательные
+    batch.rollbacks.clear()
+    logger.debug(f"Сохранено показаний датчиков: {len(batch.readings)}, событий: {len(batch.events)}")
+
+
+def aggregate_stage(batch):
+    """Агрегаты и текущая статистика; выполняется после записи, чтобы повтор пакета не учитывался дважды"""
+    get_aggregator().add_batch(batch.readings, batch.outside_rows)
+    get_running_stats().add_batch(batch.readings)
+
+
+def latest_stage(batch):
+    """Последние показания датчиков для API и дашборда; требует стадии enrich"""
+    get_latest_values_store().add_batch(batch.metadata, batch.readings)
+
+
+# Реестр стадий; порядок стадий задается PIPELINE_STAGES. Декодирование выполняют транспорты
+# (MQTT-клиент, консьюмер Kafka), его время учитывается в метриках стадии decode
+STAGES = {
+    "dedup": dedup_stage,
+    "validate": validate_stage,
+    "enrich": enrich_stage,
+    "alert": alert_stage,
+    "spc": spc_stage,
+    "persist": persist_stage,
+    "aggregate": aggregate_stage,
+    "latest": latest_stage,
+}
+
+# Стадии, которые должны выполниться раньше данной: метаданные пакета задает enrich,
+# агрегаты и последние значения учитывают только записанные показания
+STAGE_REQUIRES = {
+    "alert": ("enrich",),
+    "spc": ("enrich",),
+    "aggregate": ("enrich", "persist"),
+    "latest": ("enrich", "persist"),
+}
+# Стадии, раньше которых должна стоять данная: события записываются вместе с показаниями
+STAGE_PRECEDES = {
+    "alert": ("persist",),
+    "spc": ("persist",),
+}
+
+_pipeline = None
+
+
+def get_pipeline():
+    """Конвейер обработки пакетов, собирается один раз при первом обращении (при запуске)"""
+    global _pipeline
+    if _pipeline is None:
+        names = [name.strip() for name in config.PIPELINE_STAGES.split(",") if name.strip()]
+        _pipeline = Pipeline.from_names(STAGES, names, STAGE_REQUIRES, STAGE_PRECEDES)
+        logger.info(f"Конвейер обработки: {' -> '.join(_pipeline.names)}")
+    return _pipeline
+
+
+async def process_batch(readings, alerts=()):
+    """Пакетная обработка декодированных показаний и оповещений; при ошибке записи - исключение"""
+    batch = PipelineBatch(readings, alerts)
     try:
-        logger.debug(f"Обработка данных из топика {topic}: {data}")
-
-        # Если данные пришли в виде строки, преобразуем их в словарь
-        if isinstance(data, str):
-            try:
-                data = json.loads(data)
-            except json.JSONDecodeError:
-                logger.error(f"Невозможно преобразовать данные в JSON: {data}")
-                return
-
-        # Проверяем, есть ли в данных идентификатор датчика
-        if "sensor_id" in data:
-            sensor_id = data["sensor_id"]
-        elif "id" in data:
-            sensor_id = data["id"]
-        else:
-            # Пытаемся определить датчик из топика
-            async with async_session() as session:
-                # Анализируем топик для определения датчика
-                topic_parts = topic.split('/')
-                if len(topic_parts) >= 2 and topic_parts[0] == "autoclave":
-                    # Определяем тип датчика экструдера из топика
-                    sensor_type = topic_parts[1]
-                    
-                    # Сопоставляем топик с типом датчика
-                    sensor_type_mapping = {
-                        "temperature": "Температура экструдера",
-                        "move_speed": "Скорость протяжки",
-                        "isolation_thickness": "Толщина изоляции в экструдере",
-                        "cable_core_profile": "Сечение жилы",
-                    }
-                    
-                    sensor_name = sensor_type_mapping.get(sensor_type)
-                    
-                    if sensor_name:
-                        # Ищем датчик по имени
-                        query = select(Sensors).where(Sensors.sensor_name == sensor_name)
-                        result = await session.execute(query)
-                        sensor = result.scalars().first()
-                        
-                        if sensor:
-                            sensor_id = sensor.id
-                            logger.debug(f"Определен sensor_id={sensor_id} из топика {topic}")
-                        else:
-                            logger.warning(f"Не удалось найти датчик с именем {sensor_name}")
-                            return
-                    else:
-                        logger.warning(f"Неизвестный тип датчика в топике {topic}")
-                        return
-                else:
-                    logger.warning(f"Неподдерживаемый формат топика {topic}")
-                    return
-
-        # Определяем тип значения для сохранения
-        if isinstance(data, dict):
-            # Извлекаем числовое значение для проверки оповещений
-            numeric_value = None
-
-            # Пытаемся найти числовое значение для датчиков экструдера
-            for key in ['value', 'temperature', 'move_speed', 'isolation_thickness', 'cable_core_profile']:
-                if key in data and isinstance(data[key], (int, float)):
-                    numeric_value = data[key]
-                    break
-
-            # Если это оповещение, обрабатываем отдельно
-            if "alert_type" in data and topic.endswith("/alerts"):
-                await process_alert(data)
-                return
-
-            # Сохраняем показание датчика
-            await save_sensor_reading(sensor_id, numeric_value)
-        else:
-            # Если это не словарь, сохраняем как есть
-            await save_sensor_reading(sensor_id, float(data) if data.replace('.', '', 1).isdigit() else 0)
-
-    except Exception as e:
-        logger.error(f"Ошибка обработки данных: {e}")
-
-
-async def save_sensor_reading(sensor_id, value):
-    """Сохранение показаний датчика в БД"""
-    async with async_session() as session:
-        try:
-            # Создаем новую запись показаний датчика
-            new_reading = CurrentValues(sensors_id=sensor_id, value=value)
-            session.add(new_reading)
-
-            # Проверяем условия для оповещений
-            if value is not None:
-                await check_alert_conditions(sensor_id, value)
-
-            await session.commit()
-            logger.debug(f"Сохранено показание датчика: sensors_id={sensor_id}, value={value}")
-        except Exception as e:
-            await session.rollback()
-            logger.error(f"Ошибка при сохранении показания датчика: {e}")
-
-
-async def process_alert(data):
-    """Обработка оповещений от датчиков"""
-    async with async_session() as session:
-        try:
-            sensor_id = data.get("sensor_id")
-            if not sensor_id:
-                logger.warning("В оповещении отсутствует sensor_id")
-                return
-                
-            # Ищем датчик в БД
-            query = select(Sensors).where(Sensors.id == sensor_id)
-            result = await session.execute(query)
-            sensor = result.scalars().first()
-            
-            if not sensor:
-                logger.warning(f"Датчик с id={sensor_id} не найден при обработке оповещения")
-                return
-                
-            # Создаем запись в таблице событий
-            new_event = Events(
-                sensors_id=sensor_id,
-                description=data.get("message", "Оповещение без описания"),
-                users_id=1  # Пользователь системы по умолчанию
-            )
-            
-            session.add(new_event)
-            await session.commit()
-            logger.info(f"Создано оповещение: {data.get('message')}, sensor_id={sensor_id}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при обработке оповещения: {e}")
-
-
-async def process_extruder_temperature(data):
-    logger.debug(f"Обработка данных температуры экструдера: {data}")
-    # Здесь может быть дополнительная логика...
-
-
-async def process_extruder_move_speed(data):
-    logger.debug(f"Обработка данных скорости протяжки: {data}")
-    # Здесь может быть дополнительная логика...
-
-
-async def process_extruder_isolation_thickness(data):
-    logger.debug(f"Обработка данных толщины изоляции: {data}")
-    # Здесь может быть дополнительная логика...
-
-
-async def process_extruder_cable_core_profile(data):
-    logger.debug(f"Обработка данных сечения жилы: {data}")
-    # Здесь может быть дополнительная логика...
\ No newline at end of file
+        await get_pipeline().run(batch)
+    except Exception:
+        # Показания не записаны - при повторной доставке их нельзя считать дубликатами,
+        # а состояние стадий возвращается к началу пакета, чтобы повтор не учитывался дважды
+        batch.rollback()
+        forget(batch.readings)
+        forget(batch.alerts, alert_key)
+        raise
@@ -0,0 +1,190 @@
+import json
+import logging
+import time
+from datetime import datetime
+from config import config
+from metrics import metrics
+from processing.wire import decode_frame
+from processing.pipeline import Stage
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # Необязательная зависимость
+    orjson = None
+
+# Ключи, в которых симулятор и старые датчики передают значение
+FALLBACK_VALUE_KEYS = ('value', 'temperature', 'move_speed', 'isolation_thickness', 'cable_core_profile')
+
+decoded_counter = metrics.counter("decode_ok")
+malformed_counter = metrics.counter("decode_malformed")
+# Декодирование - первая стадия обработки, выполняется транспортом (MQTT-клиент, консьюмер Kafka)
+decode_stage = Stage("decode")
+
+
+class Reading:
+    """Компактная запись показания датчика"""
+    __slots__ = ("sensor_id", "ts", "value")
+
+    def __init__(self, sensor_id: int, ts: float, value: float):
+        self.sensor_id = sensor_id
+        self.ts = ts  # Время измерения на устройстве, секунды Unix
+        self.value = value
+
+    def __repr__(self):
+        return f"Reading(sensor_id={self.sensor_id}, ts={self.ts}, value={self.value})"
+
+    def __eq__(self, other):
+        return (isinstance(other, Reading) and self.sensor_id == other.sensor_id
+                and self.ts == other.ts and self.value == other.value)
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.ts)
+
+
+def _json_loads(payload):
+    # Для байтов json.loads сам определяет кодировку, явное decode() заметно быстрее
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode()
+    return json.loads(payload)
+
+
+def get_json_loads(backend="auto"):
+    """Возвращает функцию разбора JSON для выбранного бэкенда (auto, orjson, json)"""
+    if backend == "orjson" or (backend == "auto" and orjson is not None):
+        if orjson is None:
+            raise ImportError("Бэкенд orjson выбран, но пакет orjson не установлен")
+        return orjson.loads
+    return _json_loads
+
+
+class MalformedPayload(ValueError):
+    pass
+
+
+def parse_timestamp(timestamp):
+    """Метка времени устройства (ISO-строка или секунды Unix) -> секунды Unix"""
+    if timestamp is None:
+        return time.time()
+    elif isinstance(timestamp, str):
+        return datetime.fromisoformat(timestamp).timestamp()
+    elif isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        return float(timestamp)
+    raise MalformedPayload(f"некорректная метка времени: {timestamp!r}")
+
+
+_last_received = 0.0
+
+
+def receive_time():
+    """Время приема сообщения для показаний и оповещений без метки времени устройства. Строго возрастает
+    с шагом не меньше 1 мс: у сообщений датчика, принятых подряд, не совпадают ключи отсева повторов"""
+    global _last_received
+    _last_received = max(time.time(), _last_received + 0.001)
+    return _last_received
+
+
+class ReadingDecoder:
+    """Декодер сообщений датчиков: байты -> Reading за один проход с проверкой схемы"""
+
+    def __init__(self, backend=None):
+        self.loads = get_json_loads(backend or config.PAYLOAD_JSON_BACKEND)
+
+    def decode_json(self, payload):
+        """Разбирает JSON-объект без интерпретации полей (для оповещений)"""
+        data = self.loads(payload)
+        if not isinstance(data, dict):
+            raise MalformedPayload("ожидался JSON-объект")
+        return data
+
+    def reading_from(self, data, route=None):
+        """Преобразует разобранное сообщение датчика в Reading, при несоответствии схеме - MalformedPayload"""
+        sensor_id = data.get("sensor_id")
+        if sensor_id is None:
+            # Старые датчики передают идентификатор в ключе id
+            sensor_id = data.get("id")
+        if sensor_id is None:
+            sensor_id = route.sensor_id if route is not None else None
+        if type(sensor_id) is not int:
+            raise MalformedPayload(f"некорректный sensor_id: {sensor_id!r}")
+
+        value = None
+        if route is not None and route.value_key is not None:
+            value = data.get(route.value_key)
+        if value is None:
+            for key in FALLBACK_VALUE_KEYS:
+                value = data.get(key)
+                if value is not None:
+                    break
+        if type(value) is not float and type(value) is not int:
+            raise MalformedPayload(f"некорректное значение: {value!r}")
+
+        return Reading(sensor_id, parse_timestamp(data.get("timestamp")), float(value))
+
+    def _interpret(self, data, route):
+        if route is not None and route.alert:
+            return data
+        return self.reading_from(data, route)
+
+    def decode(self, payload, route=None):
+        """Декодирует сообщение: Reading для показаний, dict для оповещений, None для ошибочных"""
+        try:
+            result = self._interpret(self.decode_json(payload), route)
+        except (ValueError, TypeError) as e:
+            # Ошибки только считаются, итог выводится в журнал один раз на пакет
+            malformed_counter.inc()
+            logger.debug(f"Некорректное сообщение: {e}")
+            return None
+        decoded_counter.inc()
+        return result
+
+    def decode_received(self, payload, route, received):
+        """Декодирует сообщение при приеме из MQTT; сообщению без метки времени устройства присваивается
+        время приема received. Время, датчик маршрута (если датчик задан топиком) и значение из ключа
+        маршрута дописываются в сообщение для Kafka: консьюмер не знает маршрута MQTT и декодирует
+        то же показание по стандартным ключам. Возвращает (результат decode(), сообщение для Kafka)"""
+        try:
+            data = self.decode_json(payload)
+            changed = False
+            if data.get("timestamp") is None:
+                data["timestamp"] = received
+                changed = True
+            if (data.get("sensor_id") is None and data.get("id") is None
+                    and route is not None and route.sensor_id is not None):
+                data["sensor_id"] = route.sensor_id
+                changed = True
+            result = self._interpret(data, route)
+            if isinstance(result, Reading) and data.get("value") != result.value:
+                data["value"] = result.value
+                changed = True
+            if changed:
+                payload = json.dumps(data).encode('utf-8')
+        except (ValueError, TypeError) as e:
+            malformed_counter.inc()
+            logger.debug(f"Некорректное сообщение: {e}")
+            return None, payload
+        decoded_counter.inc()
+        return result, payload
+
+    def decode_binary(self, payload):
+        """Декодирует двоичный кадр в список Reading, для ошибочного кадра - пустой список"""
+        try:
+            readings = [Reading(sensor_id, ts, value) for sensor_id, ts, value in decode_frame(payload)]
+        except (ValueError, TypeError) as e:
+            malformed_counter.inc()
+            logger.debug(f"Некорректный двоичный кадр: {e}")
+            return []
+        decoded_counter.inc(len(readings))
+        return readings
+
+
+_decoder = None
+
+
+def get_decoder():
+    global _decoder
+    if _decoder is None:
+        _decoder = ReadingDecoder()
+    return _decoder
@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+from config import config
+from metrics import metrics
+from processing.decoder import parse_timestamp
+
+dropped_counter = metrics.counter("dedup_dropped")
+size_gauge = metrics.gauge("dedup_window_size")
+
+
+class DedupWindow:
+    """Ограниченное окно последних ключей с вытеснением по времени и по размеру"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl = ttl_seconds
+        self.max_size = max_size
+        self._seen = OrderedDict()  # ключ -> время добавления, в порядке добавления
+
+    def _evict(self, now):
+        seen = self._seen
+        while seen:
+            key, added = next(iter(seen.items()))
+            if now - added <= self.ttl and len(seen) < self.max_size:
+                break
+            seen.popitem(last=False)
+
+    def check_and_add(self, key, now=None):
+        """Возвращает True, если ключ уже встречался в окне; иначе запоминает его"""
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        return False
+
+    def discard(self, key):
+        self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+def reading_key(reading):
+    """Ключ идемпотентности показания: датчик и время измерения на устройстве (мс)"""
+    return reading.sensor_id, int(round(reading.ts * 1000))
+
+
+def alert_key(alert):
+    """Ключ идемпотентности оповещения: датчик, время на устройстве (мс) и текст;
+    None - оповещение без метки времени, повторы которого отсеять нельзя"""
+    timestamp = alert.get("timestamp")
+    if timestamp is None:
+        return None
+    try:
+        ts = parse_timestamp(timestamp)
+    except ValueError:
+        return None
+    return "alert", alert.get("sensor_id"), int(round(ts * 1000)), str(alert.get("message"))
+
+
+_window = DedupWindow(config.DEDUP_WINDOW_SECONDS, config.DEDUP_WINDOW_SIZE)
+
+
+def drop_duplicates(items, key=reading_key):
+    """Отбрасывает повторно доставленные показания (или оповещения с key=alert_key) без обращения к БД"""
+    now = time.monotonic()
+    unique = []
+    for item in items:
+        item_key = key(item)
+        if item_key is None or not _window.check_and_add(item_key, now):
+            unique.append(item)
+    if len(unique) != len(items):
+        dropped_counter.inc(len(items) - len(unique))
+    size_gauge.set(len(_window))
+    return unique
+
+
+def forget(items, key=reading_key):
+    """Убирает показания (оповещения) из окна, если их запись не удалась и ожидается повторная доставка"""
+    for item in items:
+        item_key = key(item)
+        if item_key is not None:
+            _window.discard(item_key)
+    size_gauge.set(len(_window))
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import select, true
+from config import config
+from database.connection import async_session
+from database.models import CurrentValues, Sensors
+from processing.metadata import get_metadata
+
+logger = logging.getLogger(__name__)
+
+
+def sensor_status(value, meta):
+    """Статус показания относительно пределов датчика: low, high или normal"""
+    if meta is not None:
+        if meta.min_value is not None and value < meta.min_value:
+            return "low"
+        if meta.max_value is not None and value > meta.max_value:
+            return "high"
+    return "normal"
+
+
+class LatestValue:
+    """Последнее показание датчика"""
+    __slots__ = ("value", "ts", "status")
+
+    def __init__(self, value, ts, status):
+        self.value = value
+        self.ts = ts
+        self.status = status
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.ts)
+
+
+def readings_written_here():
+    """Записывает ли все показания этот процесс. Воркеры приема (MQTT_INGEST_WORKERS > 1)
+    и консьюмеры в отдельных процессах пишут показания сами, и хранилище этого процесса их не видит"""
+    if config.INGEST_MODE in ("direct", "both") and config.MQTT_INGEST_WORKERS > 1:
+        return False
+    if (config.INGEST_MODE in ("kafka", "both") and config.KAFKA_CONSUMER_MODE == "processes"
+            and config.BUS_BACKEND != "memory"):
+        return False
+    return True
+
+
+class LatestValues:
+    """Последнее показание каждого датчика в памяти. Обновляется при записи показаний (O(1) на показание).
+    Если показания записывает этот процесс, из БД хранилище загружается один раз - при холодном старте;
+    иначе оно перечитывается из БД, когда данные старше ttl секунд"""
+
+    def __init__(self, ttl=None):
+        self.values = {}  # sensor_id -> LatestValue
+        self.ttl = ttl
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def stale(self):
+        if self._loaded_at is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl
+
+    def get(self, sensor_id):
+        return self.values.get(sensor_id)
+
+    def add_batch(self, metadata, readings):
+        """Обновляет значения по записанному пакету; показания старше сохраненного пропускаются"""
+        newest = {}
+        for reading in readings:
+            current = newest.get(reading.sensor_id)
+            if current is None or reading.ts >= current.ts:
+                newest[reading.sensor_id] = reading
+        values = self.values
+        for sensor_id, reading in newest.items():
+            current = values.get(sensor_id)
+            if current is None or reading.ts >= current.ts:
+                status = sensor_status(reading.value, metadata.get(sensor_id))
+                values[sensor_id] = LatestValue(reading.value, reading.ts, status)
+
+    async def load(self, metadata):
+        """Последнее показание каждого датчика из БД по индексу (sensors_id, time)"""
+        async with self._lock:
+            if not self.stale:
+                return
+            latest = select(CurrentValues.value, CurrentValues.time).where(
+                CurrentValues.sensors_id == Sensors.id
+            ).order_by(CurrentValues.time.desc()).limit(1).lateral()
+            query = select(Sensors.id, latest.c.value, latest.c.time).join(latest, true())
+            async with async_session() as session:
+                result = await session.execute(query)
+            for sensor_id, value, measured in result.all():
+                ts = measured.timestamp()
+                current = self.values.get(sensor_id)
+                # Показания, записанные во время загрузки, новее загруженных
+                if current is None or ts > current.ts:
+                    self.values[sensor_id] = LatestValue(value, ts, sensor_status(value, metadata.get(sensor_id)))
+            first = self._loaded_at is None
+            self._loaded_at = time.monotonic()
+            if first:
+                logger.info(f"Загружены последние показания датчиков: {len(self.values)}")
+
+
+_latest_values = None
+
+
+def get_latest_values_store():
+    global _latest_values
+    if _latest_values is None:
+        if readings_written_here():
+            _latest_values = LatestValues()
+        else:
+            logger.info("Показания записываются в других процессах: последние показания читаются из БД "
+                        f"не реже раза в {config.LATEST_VALUES_REFRESH_SECONDS} с")
+            _latest_values = LatestValues(config.LATEST_VALUES_REFRESH_SECONDS)
+    return _latest_values
+
+
+async def get_latest_values():
+    """Возвращает хранилище последних показаний, загружая его из БД при первом обращении
+    (и по истечении срока, если показания записывают другие процессы)"""
+    store = get_latest_values_store()
+    if store.stale:
+        await store.load(await get_metadata())
+    return store
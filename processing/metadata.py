@@ -0,0 +1,165 @@
+import asyncio
+import time
+import logging
+from collections import namedtuple
+import numpy as np
+from sqlalchemy import select
+from config import config
+from database.data_base import async_session, engine
+from database.models import Sensors, EquipmentSettings, ProductionLine
+
+logger = logging.getLogger(__name__)
+
+# Канал уведомлений PostgreSQL; триггеры на sensors, equipment_settings и production_line
+# создаются в SCHEMA_MIGRATIONS (database/connection.py)
+NOTIFY_CHANNEL = "sensor_metadata"
+
+# sensor_type - ключ значения в сообщениях датчика (Sensors.value_key): temperature, move_speed и т.д.
+SensorMeta = namedtuple("SensorMeta", ["sensor_id", "sensor_name", "location_name", "min_value", "max_value",
+                                       "sensor_type", "active"], defaults=(None, True))
+
+# Участок экструдера в production_line; в данных встречается с разным регистром
+EXTRUDER_LOCATION = "Экструдер"
+
+
+def is_extruder(meta):
+    """Относится ли датчик к участку экструдера (название сравнивается без учета регистра)"""
+    return meta.location_name.casefold() == EXTRUDER_LOCATION.casefold()
+
+
+class MetadataCache:
+    """Датчики, их участки и пределы в памяти процесса: проверка пределов без обращения к БД.
+    Обновляется по уведомлению PostgreSQL (LISTEN/NOTIFY), а без него - по истечении TTL"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._sensors = {}
+        # Пределы в виде массивов, упорядоченных по id датчика, для векторной проверки пакетов;
+        # отсутствующий предел - NaN (сравнение с ним всегда ложно)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.min_values = np.empty(0, dtype=np.float64)
+        self.max_values = np.empty(0, dtype=np.float64)
+        self._loaded_at = None
+        self.loaded = False  # Метаданные загружены хотя бы раз
+        self._dirty = False
+        self._lock = asyncio.Lock()
+        self._listener = None
+
+    def get(self, sensor_id):
+        return self._sensors.get(sensor_id)
+
+    def __contains__(self, sensor_id):
+        return sensor_id in self._sensors
+
+    def __len__(self):
+        return len(self._sensors)
+
+    def values(self):
+        return self._sensors.values()
+
+    @property
+    def stale(self):
+        return self._dirty or self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    async def load(self):
+        """Загружает метаданные всех датчиков одним запросом"""
+        query = select(
+            Sensors.id,
+            Sensors.sensor_name,
+            Sensors.value_key,
+            Sensors.active,
+            ProductionLine.name,
+            EquipmentSettings.min_value,
+            EquipmentSettings.max_value
+        ).outerjoin(
+            ProductionLine, ProductionLine.id == Sensors.location
+        ).outerjoin(
+            EquipmentSettings, EquipmentSettings.sensor_id == Sensors.id
+        ).order_by(Sensors.id, EquipmentSettings.id)
+
+        # Флаг сбрасывается до запроса: уведомление во время загрузки вызовет повторную
+        self._dirty = False
+        async with async_session() as session:
+            result = await session.execute(query)
+
+        sensors = {}
+        for sensor_id, sensor_name, sensor_type, active, location_name, min_value, max_value in result.all():
+            # Для датчика используется первая запись настроек, как и раньше
+            if sensor_id not in sensors:
+                sensors[sensor_id] = SensorMeta(
+                    sensor_id,
+                    sensor_name,
+                    location_name or "Неизвестно",
+                    float(min_value) if min_value is not None else None,
+                    float(max_value) if max_value is not None else None,
+                    sensor_type,
+                    active is not False
+                )
+        self._sensors = sensors
+        self._build_arrays()
+        self._loaded_at = time.monotonic()
+        self.loaded = True
+        logger.info(f"Загружены метаданные датчиков: {len(sensors)}")
+
+    def _build_arrays(self):
+        metas = sorted(self._sensors.values(), key=lambda meta: meta.sensor_id)
+        self.ids = np.array([meta.sensor_id for meta in metas], dtype=np.int64)
+        self.min_values = np.array([np.nan if meta.min_value is None else meta.min_value for meta in metas],
+                                   dtype=np.float64)
+        self.max_values = np.array([np.nan if meta.max_value is None else meta.max_value for meta in metas],
+                                   dtype=np.float64)
+
+    async def refresh(self):
+        """Перезагружает кэш, если он устарел или пришло уведомление; запускает прослушивание"""
+        if self._listener is None:
+            self._listener = asyncio.create_task(self.listen())
+        if not self.stale:
+            return
+        async with self._lock:
+            if self.stale:
+                try:
+                    await self.load()
+                except Exception as e:
+                    # Остаемся на прежних данных, следующая попытка через интервал повтора
+                    self._loaded_at = time.monotonic() - self.ttl + config.METADATA_RETRY_INTERVAL
+                    logger.error(f"Ошибка загрузки метаданных датчиков: {e}")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        logger.debug(f"Изменены метаданные датчиков: {payload}")
+        self._dirty = True
+
+    async def listen(self):
+        """Держит отдельное соединение с LISTEN на канале метаданных и переподключается при обрыве"""
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    raw = await conn.get_raw_connection()
+                    driver = raw.driver_connection
+                    await driver.add_listener(NOTIFY_CHANNEL, self._on_notify)
+                    # Изменения, пропущенные без соединения, подхватываются перезагрузкой
+                    self._dirty = True
+                    logger.info(f"Подписка на изменения метаданных датчиков ({NOTIFY_CHANNEL})")
+                    while not driver.is_closed():
+                        await asyncio.sleep(config.METADATA_RETRY_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Нет подписки на изменения метаданных, обновление по TTL: {e}")
+            await asyncio.sleep(config.METADATA_RETRY_INTERVAL)
+
+
+_cache = None
+
+
+def get_metadata_cache():
+    global _cache
+    if _cache is None:
+        _cache = MetadataCache(config.METADATA_TTL_SECONDS)
+    return _cache
+
+
+async def get_metadata():
+    """Возвращает актуальный кэш метаданных датчиков"""
+    cache = get_metadata_cache()
+    await cache.refresh()
+    return cache
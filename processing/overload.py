@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import deque
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Политики перегрузки очереди приема
+POLICY_BLOCK = "block"  # Производитель ждет, пока очередь не опустится до нижней отметки (offer - до maxsize)
+POLICY_DROP_OLDEST = "drop_oldest"  # Новые сообщения вытесняют самые старые
+POLICY_COALESCE = "coalesce"  # Из ожидающих сообщений по ключу (датчику) остается только последнее
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_COALESCE)
+
+
+class OverloadQueue(asyncio.Queue):
+    """Очередь asyncio с политикой перегрузки. Перегрузка начинается, когда в очереди
+    high_water элементов, и заканчивается, когда их становится не больше low_water.
+    Элементы, для которых key() возвращает None (например, оповещения), не отбрасываются и не объединяются;
+    maxsize - жесткий предел, при его достижении блокируется производитель при любой политике.
+    Производитель, который ждать не может (обратный вызов клиента MQTT), помещает элементы через offer():
+    сверх maxsize отбрасываются только элементы с ключом, и каждый учитывается в {name}_queue_shed"""
+
+    def __init__(self, maxsize, policy=POLICY_BLOCK, high_water=None, low_water=None, key=None, name="ingest"):
+        if policy not in POLICIES:
+            raise ValueError(f"Неизвестная политика перегрузки: {policy}; доступны: {', '.join(POLICIES)}")
+        self.policy = policy
+        self.high_water = min(high_water or maxsize, maxsize)
+        self.low_water = min(low_water if low_water is not None else self.high_water // 2, self.high_water)
+        self.key = key or (lambda item: None)
+        self.overloaded = False
+        self._rejecting = False  # В текущей перегрузке уже отбрасывались элементы (для журнала)
+        self.name = name
+
+        self.shed_counter = metrics.counter(f"{name}_queue_shed")  # Все отброшенные, включая объединенные
+        self.coalesced_counter = metrics.counter(f"{name}_queue_coalesced")
+        self.rejected_counter = metrics.counter(f"{name}_queue_rejected")  # Не принятые offer() сверх maxsize
+        self.episodes_counter = metrics.counter(f"{name}_queue_overloads")
+        self.overloaded_gauge = metrics.gauge(f"{name}_queue_overloaded")
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = deque()  # Ячейки [ключ, элемент]
+        self._pending = {}  # Ключ -> ячейка последнего ожидающего элемента
+
+    def _qsize(self):
+        return len(self._queue)
+
+    def _update_state(self):
+        size = len(self._queue)
+        if not self.overloaded and size >= self.high_water:
+            self.overloaded = True
+            self.episodes_counter.inc()
+            self.overloaded_gauge.set(1)
+            # При block до maxsize ничего не отбрасывается: ожидающий производитель приостанавливается
+            log = logger.info if self.policy == POLICY_BLOCK else logger.warning
+            log(f"Очередь {self.name} перегружена ({size} элементов), политика: {self.policy}")
+        elif self.overloaded and size <= self.low_water:
+            self.overloaded = False
+            self._rejecting = False
+            self.overloaded_gauge.set(0)
+            logger.info(f"Очередь {self.name} разгружена ({size} элементов)")
+
+    def full(self):
+        if self.policy == POLICY_BLOCK and self.overloaded:
+            return True
+        return super().full()
+
+    def offer(self, item):
+        """Помещает элемент без ожидания. В заполненную до maxsize очередь элемент с ключом принимается,
+        только если политика вытесняет или объединяет ожидающий элемент; иначе он отбрасывается.
+        Элементы без ключа принимаются всегда. Возвращает False, если элемент отброшен"""
+        if 0 < self.maxsize <= self.qsize():
+            key = self.key(item)
+            if key is not None and not self._replaces(key):
+                self.shed_counter.inc()
+                self.rejected_counter.inc()
+                if not self._rejecting:
+                    self._rejecting = True
+                    logger.warning(f"Очередь {self.name} заполнена ({self.qsize()} элементов): "
+                                   f"новые сообщения отбрасываются до разгрузки")
+                return False
+        # put_nowait() отказывает при full(), а здесь элемент принимается и сверх отметки перегрузки
+        self._put(item)
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+        return True
+
+    def _replaces(self, key):
+        """Займет ли элемент с ключом место уже ожидающего элемента"""
+        if self.policy == POLICY_COALESCE:
+            return key in self._pending
+        if self.policy == POLICY_DROP_OLDEST:
+            # Каждый элемент с ключом зарегистрирован в _pending, так что есть что вытеснить
+            return bool(self._pending)
+        return False
+
+    def _put(self, item):
+        key = self.key(item) if self.policy != POLICY_BLOCK else None
+        if self.overloaded and key is not None:
+            if self.policy == POLICY_COALESCE:
+                slot = self._pending.get(key)
+                if slot is not None:
+                    # Сообщение сохраняет место в очереди, но несет последнее значение;
+                    # замещаемое сообщение уже учтено в счетчике незавершенных задач
+                    slot[1] = item
+                    self.shed_counter.inc()
+                    self.coalesced_counter.inc()
+                    self.task_done()
+                    return
+            elif self.policy == POLICY_DROP_OLDEST:
+                self._drop_oldest()
+
+        slot = [key, item]
+        self._queue.append(slot)
+        if key is not None:
+            self._pending[key] = slot
+        self._update_state()
+
+    def _drop_oldest(self):
+        """Отбрасывает самый старый элемент, который разрешено отбрасывать"""
+        for index, slot in enumerate(self._queue):
+            if slot[0] is not None:
+                del self._queue[index]
+                if self._pending.get(slot[0]) is slot:
+                    del self._pending[slot[0]]
+                self.shed_counter.inc()
+                self.task_done()
+                return
+
+    def _get(self):
+        slot = self._queue.popleft()
+        key, item = slot
+        if key is not None and self._pending.get(key) is slot:
+            del self._pending[key]
+        self._update_state()
+        return item
@@ -0,0 +1,110 @@
+import inspect
+import logging
+import time
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineBatch:
+    """Данные пакета, передаваемые от стадии к стадии"""
+    __slots__ = ("readings", "alerts", "metadata", "outside_rows", "events", "rollbacks")
+
+    def __init__(self, readings, alerts=()):
+        self.readings = readings
+        self.alerts = list(alerts)
+        self.metadata = None
+        self.outside_rows = set()  # Номера показаний вне пределов
+        self.events = []  # События для записи вместе с показаниями
+        self.rollbacks = []  # Восстановление состояния стадий, если пакет не будет записан
+
+    def __len__(self):
+        return len(self.readings) + len(self.alerts)
+
+    def on_rollback(self, restore):
+        """Регистрирует функцию, возвращающую состояние стадии к началу пакета"""
+        self.rollbacks.append(restore)
+
+    def rollback(self):
+        """Отменяет изменения состояния стадий в обратном порядке"""
+        while self.rollbacks:
+            self.rollbacks.pop()()
+
+
+class Stage:
+    """Стадия обработки с собственными метриками: время выполнения на пакет,
+    число обработанных показаний и оповещений, ошибки"""
+
+    def __init__(self, name, func=None):
+        self.name = name
+        self.func = func
+        self.is_async = inspect.iscoroutinefunction(func)
+        self.latency = metrics.histogram(f"pipeline_{name}_ms")
+        self.throughput = metrics.meter(f"pipeline_{name}")
+        self.errors = metrics.counter(f"pipeline_{name}_errors")
+
+    def record(self, started, count):
+        """Учитывает выполнение стадии, начатое в started (time.perf_counter()).
+        Для стадий, которые выполняются вне конвейера, например декодирования в транспорте"""
+        self.latency.observe((time.perf_counter() - started) * 1000)
+        self.throughput.mark(count)
+
+    async def run(self, batch):
+        count = len(batch)
+        started = time.perf_counter()
+        try:
+            if self.is_async:
+                await self.func(batch)
+            else:
+                self.func(batch)
+        except Exception:
+            self.errors.inc()
+            raise
+        finally:
+            self.record(started, count)
+
+    def __repr__(self):
+        return f"Stage({self.name})"
+
+
+class Pipeline:
+    """Цепочка стадий, собранная один раз по списку имен из реестра стадий"""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    @classmethod
+    def from_names(cls, registry, names, requires=None, precedes=None):
+        """Собирает конвейер и проверяет порядок стадий: requires - стадии, которые должны быть
+        в конвейере раньше данной, precedes - стадии, раньше которых данная должна стоять, если они есть"""
+        unknown = [name for name in names if name not in registry]
+        if unknown:
+            raise ValueError(f"Неизвестные стадии конвейера: {', '.join(unknown)}; доступны: {', '.join(registry)}")
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Стадии конвейера указаны несколько раз: {', '.join(duplicates)}")
+
+        position = {name: index for index, name in enumerate(names)}
+        errors = []
+        for name in names:
+            for required in (requires or {}).get(name, ()):
+                if position.get(required, len(names)) > position[name]:
+                    errors.append(f"{name} требует стадии {required} перед ней")
+            for later in (precedes or {}).get(name, ()):
+                if later in position and position[later] < position[name]:
+                    errors.append(f"{name} должна выполняться до {later}")
+        if errors:
+            raise ValueError(f"Недопустимый порядок стадий конвейера {', '.join(names)}: {'; '.join(errors)}")
+        return cls(Stage(name, registry[name]) for name in names)
+
+    @property
+    def names(self):
+        return [stage.name for stage in self.stages]
+
+    async def run(self, batch):
+        """Пропускает пакет через стадии; обработка прекращается, если в пакете ничего не осталось"""
+        for stage in self.stages:
+            if not batch:
+                break
+            await stage.run(batch)
+        return batch
@@ -0,0 +1,173 @@
+import math
+import time
+from datetime import datetime
+from config import config
+
+# Скользящие окна статистики в памяти: имя -> длина, секунды
+SLIDING_WINDOWS = {"5m": 300, "1h": 3600}
+BUCKETS_PER_WINDOW = 60
+
+
+class Moments:
+    """Количество, среднее, сумма квадратов отклонений (Уэлфорд), минимум и максимум"""
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Объединение двух наборов (формула Чана для параллельного Уэлфорда)"""
+        if not other.count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0, "mean": None, "std": None, "min": None, "max": None}
+        variance = self.m2 / (self.count - 1) if self.count > 1 else 0.0
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": math.sqrt(variance),
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+class SlidingWindow:
+    """Скользящее окно из корзин фиксированной длины: добавление O(1), сводка O(число корзин)"""
+
+    def __init__(self, seconds, buckets=BUCKETS_PER_WINDOW):
+        self.bucket_seconds = seconds / buckets
+        self.buckets = [Moments() for _ in range(buckets)]
+        self.bucket_ids = [None] * buckets  # Номер интервала, к которому относится корзина
+
+    def add(self, ts, value):
+        bucket_id = int(ts // self.bucket_seconds)
+        index = bucket_id % len(self.buckets)
+        if self.bucket_ids[index] != bucket_id:
+            # Корзина переиспользуется для нового интервала
+            if self.bucket_ids[index] is not None and self.bucket_ids[index] > bucket_id:
+                return  # Показание старше окна
+            self.buckets[index].reset()
+            self.bucket_ids[index] = bucket_id
+        self.buckets[index].add(value)
+
+    def summary(self, now):
+        current = int(now // self.bucket_seconds)
+        oldest = current - len(self.buckets) + 1
+        total = Moments()
+        for bucket_id, bucket in zip(self.bucket_ids, self.buckets):
+            if bucket_id is not None and oldest <= bucket_id <= current:
+                total.merge(bucket)
+        return total.summary()
+
+
+def shift_start(ts):
+    """Начало смены, к которой относится момент времени (смены по SHIFT_HOURS от SHIFT_START_HOUR)"""
+    moment = datetime.fromtimestamp(ts)
+    day_start = moment.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    offset = ts - day_start - config.SHIFT_START_HOUR * 3600
+    shift_seconds = config.SHIFT_HOURS * 3600
+    return day_start + config.SHIFT_START_HOUR * 3600 + (offset // shift_seconds) * shift_seconds
+
+
+class SensorStats:
+    """Текущая статистика одного датчика"""
+
+    def __init__(self, ewma_alpha):
+        self.alpha = ewma_alpha
+        self.windows = {name: SlidingWindow(seconds) for name, seconds in SLIDING_WINDOWS.items()}
+        self.shift = Moments()
+        self.shift_started = None
+        self.ewma = None
+        self.last_value = None
+        self.last_ts = None
+
+    def add(self, ts, value):
+        for window in self.windows.values():
+            window.add(ts, value)
+
+        started = shift_start(ts)
+        if self.shift_started is None or started > self.shift_started:
+            self.shift.reset()
+            self.shift_started = started
+        if started == self.shift_started:
+            self.shift.add(value)
+
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+        if self.last_ts is None or ts >= self.last_ts:
+            self.last_value = value
+            self.last_ts = ts
+
+    def summary(self, now):
+        result = {name: window.summary(now) for name, window in self.windows.items()}
+        shift = self.shift.summary() if self.shift_started == shift_start(now) else Moments().summary()
+        result["shift"] = shift
+        return {
+            "last_value": self.last_value,
+            "last_time": datetime.fromtimestamp(self.last_ts).isoformat() if self.last_ts else None,
+            "ewma": self.ewma,
+            "windows": result,
+        }
+
+
+class RunningStats:
+    """Статистика по всем датчикам, обновляемая по мере записи показаний.
+    Хранится в процессе, который записывает показания в БД"""
+
+    def __init__(self, ewma_alpha):
+        self.ewma_alpha = ewma_alpha
+        self.sensors = {}
+
+    def add_batch(self, readings):
+        sensors = self.sensors
+        for reading in readings:
+            stats = sensors.get(reading.sensor_id)
+            if stats is None:
+                stats = sensors[reading.sensor_id] = SensorStats(self.ewma_alpha)
+            stats.add(reading.ts, reading.value)
+
+    def summary(self, sensor_id=None):
+        now = time.time()
+        if sensor_id is not None:
+            stats = self.sensors.get(sensor_id)
+            return stats.summary(max(now, stats.last_ts)) if stats is not None else None
+        return {sensor_id: stats.summary(max(now, stats.last_ts)) for sensor_id, stats in self.sensors.items()}
+
+
+_running_stats = None
+
+
+def get_running_stats():
+    global _running_stats
+    if _running_stats is None:
+        _running_stats = RunningStats(config.STATS_EWMA_ALPHA)
+    return _running_stats
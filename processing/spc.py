@@ -0,0 +1,321 @@
+import copy
+import math
+import logging
+from collections import deque
+from datetime import datetime
+from config import config
+from metrics import metrics
+from database.models import Events
+from processing.alerts import SYSTEM_USER_ID
+from processing.running_stats import Moments
+
+logger = logging.getLogger(__name__)
+
+# Тип события в столбце events.event_type
+EVENT_SPC = "spc"
+
+# Коэффициенты контрольных карт по размеру подгруппы n:
+# A2, D3, D4 - карта X̄-R; A3, B3, B4 - карта X̄-S; d2 - оценка сигмы по среднему размаху
+SPC_CONSTANTS = {
+    2: {"A2": 1.880, "D3": 0.0, "D4": 3.267, "A3": 2.659, "B3": 0.0, "B4": 3.267, "d2": 1.128},
+    3: {"A2": 1.023, "D3": 0.0, "D4": 2.574, "A3": 1.954, "B3": 0.0, "B4": 2.568, "d2": 1.693},
+    4: {"A2": 0.729, "D3": 0.0, "D4": 2.282, "A3": 1.628, "B3": 0.0, "B4": 2.266, "d2": 2.059},
+    5: {"A2": 0.577, "D3": 0.0, "D4": 2.114, "A3": 1.427, "B3": 0.0, "B4": 2.089, "d2": 2.326},
+    6: {"A2": 0.483, "D3": 0.0, "D4": 2.004, "A3": 1.287, "B3": 0.030, "B4": 1.970, "d2": 2.534},
+    7: {"A2": 0.419, "D3": 0.076, "D4": 1.924, "A3": 1.182, "B3": 0.118, "B4": 1.882, "d2": 2.704},
+    8: {"A2": 0.373, "D3": 0.136, "D4": 1.864, "A3": 1.099, "B3": 0.185, "B4": 1.815, "d2": 2.847},
+    9: {"A2": 0.337, "D3": 0.184, "D4": 1.816, "A3": 1.032, "B3": 0.239, "B4": 1.761, "d2": 2.970},
+    10: {"A2": 0.308, "D3": 0.223, "D4": 1.777, "A3": 0.975, "B3": 0.284, "B4": 1.716, "d2": 3.078},
+}
+
+# Правила Western Electric для карты средних и выход размаха за границы карты R
+RULE_DESCRIPTIONS = {
+    "WE1": "точка за пределами 3 сигм",
+    "WE2": "2 из 3 точек за пределами 2 сигм с одной стороны",
+    "WE3": "4 из 5 точек за пределами 1 сигмы с одной стороны",
+    "WE4": "8 точек подряд по одну сторону от центральной линии",
+    "R": "размах подгруппы за границами карты R",
+}
+
+violations_counter = metrics.counter("spc_violations")
+
+
+class Subgroup:
+    """Итоги завершенной подгруппы"""
+    __slots__ = ("ts", "mean", "range", "std", "m2")
+
+    def __init__(self, ts, moments):
+        self.ts = ts
+        self.mean = moments.mean
+        self.range = moments.max - moments.min
+        self.m2 = moments.m2
+        self.std = math.sqrt(moments.m2 / (moments.count - 1))
+
+
+class SensorSPC:
+    """Статистика подгрупп одного датчика: текущая подгруппа и кольцо последних завершенных.
+    Суммы по кольцу обновляются при добавлении и вытеснении подгруппы - O(1) на показание"""
+
+    def __init__(self, size, window):
+        self.size = size
+        self.constants = SPC_CONSTANTS[size]
+        self.current = Moments()
+        self.subgroups = deque(maxlen=window)
+        self.completed = 0
+        self.sum_mean = 0.0
+        self.sum_mean_sq = 0.0
+        self.sum_range = 0.0
+        self.sum_std = 0.0
+        self.sum_m2 = 0.0
+        self.recent = deque(maxlen=8)  # Средние последних подгрупп для правил Western Electric
+        self.violations = deque(maxlen=50)
+
+    def add(self, ts, value):
+        """Добавляет показание; по завершении подгруппы возвращает ее, иначе None"""
+        self.current.add(value)
+        if self.current.count < self.size:
+            return None
+        subgroup = Subgroup(ts, self.current)
+        self.current = Moments()
+
+        if len(self.subgroups) == self.subgroups.maxlen:
+            self._apply(self.subgroups[0], -1)
+        self.subgroups.append(subgroup)
+        self._apply(subgroup, 1)
+        self.recent.append(subgroup.mean)
+        self.completed += 1
+        if self.completed % self.subgroups.maxlen == 0:
+            # Раз за оборот кольца суммы пересчитываются заново, чтобы не копилась ошибка округления
+            self._recompute()
+        return subgroup
+
+    def copy(self):
+        """Копия состояния; подгруппы после завершения не изменяются и разделяются с копией"""
+        state = copy.copy(self)
+        state.current = copy.copy(self.current)
+        state.subgroups = self.subgroups.copy()
+        state.recent = self.recent.copy()
+        state.violations = self.violations.copy()
+        return state
+
+    def _apply(self, subgroup, sign):
+        self.sum_mean += sign * subgroup.mean
+        self.sum_mean_sq += sign * subgroup.mean * subgroup.mean
+        self.sum_range += sign * subgroup.range
+        self.sum_std += sign * subgroup.std
+        self.sum_m2 += sign * subgroup.m2
+
+    def _recompute(self):
+        self.sum_mean = self.sum_mean_sq = self.sum_range = self.sum_std = self.sum_m2 = 0.0
+        for subgroup in self.subgroups:
+            self._apply(subgroup, 1)
+
+    def limits(self):
+        """Центральные линии и границы карт X̄-R и X̄-S по подгруппам кольца"""
+        k = len(self.subgroups)
+        if not k:
+            return None
+        c = self.constants
+        center = self.sum_mean / k
+        r_bar = self.sum_range / k
+        s_bar = self.sum_std / k
+        return {
+            "center": center,
+            "xbar_r": {
+                "ucl": center + c["A2"] * r_bar,
+                "lcl": center - c["A2"] * r_bar,
+                "r_center": r_bar,
+                "r_ucl": c["D4"] * r_bar,
+                "r_lcl": c["D3"] * r_bar,
+            },
+            "xbar_s": {
+                "ucl": center + c["A3"] * s_bar,
+                "lcl": center - c["A3"] * s_bar,
+                "s_center": s_bar,
+                "s_ucl": c["B4"] * s_bar,
+                "s_lcl": c["B3"] * s_bar,
+            },
+        }
+
+    def sigmas(self):
+        """Сигма внутри подгрупп (по среднему размаху) и общая сигма всех показаний кольца"""
+        k = len(self.subgroups)
+        within = self.sum_range / k / self.constants["d2"]
+        total = k * self.size
+        # Общая сумма квадратов отклонений: внутри подгрупп плюс между средними подгрупп
+        between = self.size * (self.sum_mean_sq - self.sum_mean * self.sum_mean / k)
+        overall = math.sqrt(max(self.sum_m2 + between, 0.0) / (total - 1))
+        return within, overall
+
+    def check_rules(self, subgroup, limits):
+        """Правила Western Electric для новой точки; учитываются только серии, в которые она входит"""
+        center = limits["center"]
+        sigma = (limits["xbar_r"]["ucl"] - center) / 3
+        violated = []
+        if sigma > 0:
+            zones = [(mean - center) / sigma for mean in self.recent]
+            last = zones[-1]
+            side = 1 if last >= 0 else -1
+            if abs(last) > 3:
+                violated.append("WE1")
+            if side * last > 2 and sum(1 for z in zones[-3:] if side * z > 2) >= 2:
+                violated.append("WE2")
+            if side * last > 1 and sum(1 for z in zones[-5:] if side * z > 1) >= 4:
+                violated.append("WE3")
+            if len(zones) == 8 and all(side * z > 0 for z in zones):
+                violated.append("WE4")
+        r_limits = limits["xbar_r"]
+        if subgroup.range > r_limits["r_ucl"] or subgroup.range < r_limits["r_lcl"]:
+            violated.append("R")
+        return violated
+
+
+def capability(mean, sigma, lsl, usl):
+    """Индексы пригодности процесса к допуску [lsl, usl]; для одностороннего допуска - только Cpk"""
+    if not sigma:
+        return None, None
+    sides = []
+    if usl is not None:
+        sides.append((usl - mean) / (3 * sigma))
+    if lsl is not None:
+        sides.append((mean - lsl) / (3 * sigma))
+    cp = (usl - lsl) / (6 * sigma) if usl is not None and lsl is not None else None
+    return cp, min(sides) if sides else None
+
+
+class SPCEngine:
+    """Статистическое управление процессом по подгруппам последовательных показаний датчика:
+    контрольные карты X̄-R и X̄-S, индексы Cp/Cpk и Pp/Ppk по допускам из equipment_settings,
+    правила Western Electric. Хранится в процессе, который записывает показания"""
+
+    def __init__(self, size, window, min_subgroups, sensor_types, cooldown):
+        if size not in SPC_CONSTANTS:
+            raise ValueError(f"Размер подгруппы SPC должен быть от 2 до 10, задан {size}")
+        self.size = size
+        self.window = window
+        self.min_subgroups = min_subgroups
+        self.sensor_types = set(sensor_types)
+        self.cooldown = cooldown
+        self.sensors = {}
+        self.last_event = {}
+
+    def tracks(self, meta):
+        return meta is not None and (not self.sensor_types or meta.sensor_type in self.sensor_types)
+
+    def snapshot(self, sensor_ids):
+        """Копия подгрупп датчиков и времени их последних событий для восстановления, если пакет не будет записан"""
+        states = {sensor_id: self.sensors[sensor_id].copy() if sensor_id in self.sensors else None
+                  for sensor_id in sensor_ids}
+        return states, {sensor_id: self.last_event.get(sensor_id) for sensor_id in sensor_ids}
+
+    def restore(self, snapshot):
+        """Возвращает подгруппы и время последних событий датчиков к снимку"""
+        states, last_event = snapshot
+        for target, saved in ((self.sensors, states), (self.last_event, last_event)):
+            for sensor_id, value in saved.items():
+                if value is None:
+                    target.pop(sensor_id, None)
+                else:
+                    target[sensor_id] = value
+
+    def process(self, metadata, readings):
+        """Обновляет подгруппы по пакету; возвращает события о нарушениях правил"""
+        events = []
+        for reading in readings:
+            meta = metadata.get(reading.sensor_id)
+            if not self.tracks(meta):
+                continue
+            state = self.sensors.get(reading.sensor_id)
+            if state is None:
+                state = self.sensors[reading.sensor_id] = SensorSPC(self.size, self.window)
+            subgroup = state.add(reading.ts, reading.value)
+            if subgroup is None or len(state.subgroups) < self.min_subgroups:
+                continue
+
+            violated = state.check_rules(subgroup, state.limits())
+            if not violated:
+                continue
+            violations_counter.inc(len(violated))
+            for rule in violated:
+                state.violations.append({
+                    "time": datetime.fromtimestamp(subgroup.ts).isoformat(),
+                    "rule": rule,
+                    "mean": subgroup.mean,
+                    "range": subgroup.range,
+                })
+
+            last = self.last_event.get(reading.sensor_id)
+            if last is not None and subgroup.ts - last < self.cooldown:
+                continue
+            self.last_event[reading.sensor_id] = subgroup.ts
+            rules = "; ".join(f"{rule}: {RULE_DESCRIPTIONS[rule]}" for rule in violated)
+            events.append(Events(
+                sensors_id=reading.sensor_id,
+                description=(f"Процесс вне статистической управляемости ({rules}) для датчика "
+                             f"'{meta.sensor_name}' ({meta.location_name}): среднее подгруппы {subgroup.mean:.4g}"),
+                users_id=SYSTEM_USER_ID,
+                event_type=EVENT_SPC,
+                time=datetime.fromtimestamp(subgroup.ts)
+            ))
+        if events:
+            logger.warning(f"Нарушений правил контрольных карт: {len(events)}")
+        return events
+
+    def summary(self, metadata, sensor_id, detail=False):
+        """Карты, индексы пригодности и нарушения датчика; None, если датчик не отслеживается"""
+        state = self.sensors.get(sensor_id)
+        if state is None:
+            return None
+        meta = metadata.get(sensor_id)
+        result = {
+            "sensor_id": sensor_id,
+            "sensor_name": meta.sensor_name if meta is not None else None,
+            "subgroup_size": self.size,
+            "subgroups": len(state.subgroups),
+            "lsl": meta.min_value if meta is not None else None,
+            "usl": meta.max_value if meta is not None else None,
+            "violations": list(state.violations) if detail else len(state.violations),
+        }
+        limits = state.limits()
+        if limits is not None:
+            within, overall = state.sigmas()
+            cp, cpk = capability(limits["center"], within, result["lsl"], result["usl"])
+            pp, ppk = capability(limits["center"], overall, result["lsl"], result["usl"])
+            result.update(limits)
+            result.update({
+                "sigma_within": within,
+                "sigma_overall": overall,
+                "cp": cp,
+                "cpk": cpk,
+                "pp": pp,
+                "ppk": ppk,
+                # До накопления SPC_MIN_SUBGROUPS подгрупп границы карт предварительные
+                "established": len(state.subgroups) >= self.min_subgroups,
+            })
+        if detail:
+            result["points"] = [
+                {
+                    "time": datetime.fromtimestamp(subgroup.ts).isoformat(),
+                    "mean": subgroup.mean,
+                    "range": subgroup.range,
+                    "std": subgroup.std,
+                }
+                for subgroup in state.subgroups
+            ]
+        return result
+
+
+_engine = None
+
+
+def get_spc_engine():
+    global _engine
+    if _engine is None:
+        _engine = SPCEngine(
+            config.SPC_SUBGROUP_SIZE,
+            config.SPC_WINDOW_SUBGROUPS,
+            config.SPC_MIN_SUBGROUPS,
+            [name.strip() for name in config.SPC_SENSOR_TYPES.split(",") if name.strip()],
+            config.SPC_COOLDOWN_SECONDS
+        )
+    return _engine
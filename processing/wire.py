@@ -0,0 +1,52 @@
+import struct
+
+# Компактный двоичный формат показаний датчиков.
+# Кадр: байт-маркер 0xB1, число показаний (uint16, little-endian), затем показания
+# по 16 байт: sensor_id (uint32), время в мс Unix (int64), значение (float32).
+# JSON-сообщение начинается с '{' или пробела, поэтому формат определяется по первому байту.
+FRAME_MAGIC = 0xB1
+HEADER = struct.Struct("<BH")
+RECORD = struct.Struct("<Iqf")
+MAX_READINGS_PER_FRAME = 0xFFFF
+
+
+def is_binary(payload) -> bool:
+    """Проверяет, является ли сообщение двоичным кадром"""
+    return len(payload) >= HEADER.size and payload[0] == FRAME_MAGIC
+
+
+def encode_frame(readings) -> bytes:
+    """Упаковывает последовательность (sensor_id, ts_seconds, value) в один кадр"""
+    readings = list(readings)
+    if len(readings) > MAX_READINGS_PER_FRAME:
+        raise ValueError(f"В кадре допускается не более {MAX_READINGS_PER_FRAME} показаний")
+
+    buffer = bytearray(HEADER.size + RECORD.size * len(readings))
+    HEADER.pack_into(buffer, 0, FRAME_MAGIC, len(readings))
+    offset = HEADER.size
+    for sensor_id, ts, value in readings:
+        RECORD.pack_into(buffer, offset, sensor_id, int(ts * 1000), value)
+        offset += RECORD.size
+    return bytes(buffer)
+
+
+def encode_frames(readings):
+    """Разбивает показания на кадры допустимого размера"""
+    readings = list(readings)
+    return [
+        encode_frame(readings[i:i + MAX_READINGS_PER_FRAME])
+        for i in range(0, len(readings), MAX_READINGS_PER_FRAME)
+    ]
+
+
+def decode_frame(payload):
+    """Распаковывает кадр в список (sensor_id, ts_seconds, value), при ошибке формата - ValueError"""
+    if not is_binary(payload):
+        raise ValueError("Сообщение не является двоичным кадром")
+    _, count = HEADER.unpack_from(payload, 0)
+    if len(payload) != HEADER.size + RECORD.size * count:
+        raise ValueError(f"Неверная длина кадра: {len(payload)} байт для {count} показаний")
+    return [
+        (sensor_id, ts_ms / 1000, value)
+        for sensor_id, ts_ms, value in RECORD.iter_unpack(memoryview(payload)[HEADER.size:])
+    ]
@@ -6,6 +6,7 @@ import paho.mqtt.client as mqtt
 import json
 import logging
 import argparse
+from processing.wire import encode_frame
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,6 +20,10 @@ MQTT_BROKER = config.MQTT_BROKER
 MQTT_PORT = config.MQTT_PORT
 MQTT_USERNAME = config.MQTT_USERNAME
 MQTT_PASSWORD = config.MQTT_PASSWORD
+MQTT_QOS = config.MQTT_QOS
+
+# Накопленные показания для двоичного формата: {топик: [(sensor_id, ts, value), ...]}
+pending_readings = {}
 
 # Конфигурация датчиков экструдера
 SENSORS = {
@@ -76,10 +81,12 @@ def generate_value(sensor, anomaly_chance=0.05):
 
 
 # Функция для отправки данных в MQTT
-def send_sensor_data(client, sensor_name, sensor_config, anomaly_chance=0.05):
+def send_sensor_data(client, sensor_name, sensor_config, anomaly_chance=0.05, wire_format="json", pack=1,
+                     qos=MQTT_QOS):
     """Отправляет сгенерированные данные датчика в MQTT топик"""
     value = generate_value(sensor_config, anomaly_chance)
-    timestamp = datetime.now().isoformat()
+    now = datetime.now()
+    timestamp = now.isoformat()
 
     # Формируем сообщение
     message = {
@@ -115,17 +122,29 @@ def send_sensor_data(client, sensor_name, sensor_config, anomaly_chance=0.05):
             "alert_type": "value_out_of_range",
             "message": f"Значение вне допустимого диапазона: {round(value, 2)} {sensor_config['unit']}"
         }
-        client.publish("extruder/alerts", json.dumps(alert_message))
+        client.publish("extruder/alerts", json.dumps(alert_message), qos=qos)
         logger.warning(f"Оповещение: {json.dumps(alert_message)}")
 
+    # Двоичный формат: показания копятся и отправляются кадром по pack штук
+    if wire_format == "binary":
+        readings = pending_readings.setdefault(sensor_config["topic"], [])
+        readings.append((sensor_config["id"], now.timestamp(), value))
+        if len(readings) >= pack:
+            frame = encode_frame(readings)
+            client.publish(sensor_config["topic"], frame, qos=qos)
+            logger.info(f"Отправлено: {sensor_config['topic']} - {len(readings)} показаний, {len(frame)} байт")
+            readings.clear()
+        return
+
     # Отправляем сообщение
-    client.publish(sensor_config["topic"], json.dumps(message))
+    client.publish(sensor_config["topic"], json.dumps(message), qos=qos)
     logger.info(f"Отправлено: {sensor_config['topic']} - {json.dumps(message)}")
 
 
 # Основная функция для запуска симулятора
 def run_simulator(broker=MQTT_BROKER, port=MQTT_PORT, username=MQTT_USERNAME,
-                  password=MQTT_PASSWORD, interval=5, anomaly_chance=0.05):
+                  password=MQTT_PASSWORD, interval=5, anomaly_chance=0.05, wire_format="json", pack=1,
+                  qos=MQTT_QOS):
     """Запускает симулятор данных датчиков экструдера"""
     logger.info(f"Запуск симулятора датчиков экструдера с подключением к {broker}:{port}")
 
@@ -152,7 +171,7 @@ def run_simulator(broker=MQTT_BROKER, port=MQTT_PORT, username=MQTT_USERNAME,
         while True:
             # Отправляем данные со всех датчиков
             for sensor_name, sensor_config in SENSORS.items():
-                send_sensor_data(client, sensor_name, sensor_config, anomaly_chance)
+                send_sensor_data(client, sensor_name, sensor_config, anomaly_chance, wire_format, pack, qos)
 
             # Задержка между отправками
             time.sleep(interval)
@@ -173,6 +192,9 @@ if __name__ == "__main__":
     parser.add_argument('--password', default=MQTT_PASSWORD, help='Пароль MQTT')
     parser.add_argument('--interval', type=int, default=5, help='Интервал отправки данных (сек)')
     parser.add_argument('--anomaly', type=float, default=0.05, help='Вероятность аномалий (0-1)')
+    parser.add_argument('--format', choices=['json', 'binary'], default='json', help='Формат сообщений')
+    parser.add_argument('--pack', type=int, default=1, help='Показаний в одном двоичном кадре')
+    parser.add_argument('--qos', type=int, choices=[0, 1, 2], default=MQTT_QOS, help='Уровень QoS MQTT')
 
     args = parser.parse_args()
 
@@ -183,5 +205,8 @@ if __name__ == "__main__":
         username=args.username,
         password=args.password,
         interval=args.interval,
-        anomaly_chance=args.anomaly
+        anomaly_chance=args.anomaly,
+        wire_format=args.format,
+        pack=args.pack,
+        qos=args.qos
     )
\ No newline at end of file
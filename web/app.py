@@ -17,6 +17,9 @@ from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 import typing
 from web.websockets import manager
+from processing.running_stats import get_running_stats
+from processing.metadata import get_metadata, is_extruder, EXTRUDER_LOCATION
+from processing.latest_values import get_latest_values
 import logging
 import asyncio
 import random
@@ -376,40 +379,21 @@ async def websocket_dashboard(websocket: WebSocket, db: AsyncSession = Depends(g
 
 async def generate_dashboard_data(db: AsyncSession):
     try:
-        # Получаем последние показания датчиков
-        latest_readings_query = sa.select(
-            CurrentValues.sensors_id,
-            sa.func.max(CurrentValues.time).label("latest_time")
-        ).group_by(CurrentValues.sensors_id).subquery()
-
-        latest_data_query = sa.select(
-            CurrentValues,
-            Sensors.sensor_name,
-            ProductionLine.name.label("location_name")
-        ).join(
-            latest_readings_query,
-            sa.and_(
-                CurrentValues.sensors_id == latest_readings_query.c.sensors_id,
-                CurrentValues.time == latest_readings_query.c.latest_time
-            )
-        ).join(
-            Sensors, CurrentValues.sensors_id == Sensors.id
-        ).join(
-            ProductionLine, Sensors.location == ProductionLine.id
-        )
-
-        latest_data_result = await db.execute(latest_data_query)
-        latest_readings = latest_data_result.fetchall()
-
+        # Последние показания датчиков из памяти - без запросов к БД на каждое обновление
+        metadata = await get_metadata()
+        latest_values = await get_latest_values()
         sensor_readings = []
-        for row in latest_readings:
+        for meta in metadata.values():
+            latest = latest_values.get(meta.sensor_id)
+            if latest is None:
+                continue
             sensor_readings.append({
-                "sensor_id": row.CurrentValues.sensors_id,
-                "sensor_name": row.sensor_name,
-                "location_name": row.location_name,
-                "value": float(row.CurrentValues.value),
-                "unit": SENSOR_UNITS.get(row.sensor_name, ""),
-                "time": row.CurrentValues.time.strftime("%Y-%m-%d %H:%M:%S") if row.CurrentValues.time else None
+                "sensor_id": meta.sensor_id,
+                "sensor_name": meta.sensor_name,
+                "location_name": meta.location_name,
+                "value": latest.value,
+                "unit": SENSOR_UNITS.get(meta.sensor_name, ""),
+                "time": latest.time.strftime("%Y-%m-%d %H:%M:%S")
             })
 
         # Получаем последние события/оповещения
@@ -445,7 +429,9 @@ async def generate_dashboard_data(db: AsyncSession):
         return {
             "sensor_readings": sensor_readings,
             "recent_events": recent_events,
-            "extruder_status": extruder_status
+            "extruder_status": extruder_status,
+            # Текущая статистика датчиков из памяти, без запросов к БД
+            "sensor_stats": get_running_stats().summary()
         }
     except Exception as e:
         logger.error(f"Ошибка при генерации данных дашборда: {e}")
@@ -463,7 +449,9 @@ async def generate_dashboard_data(db: AsyncSession):
 async def generate_extruder_status(db: AsyncSession):
     try:
         # Получаем ID местоположения
-        location_query = sa.select(ProductionLine.id).where(ProductionLine.name == "Экструдер")
+        location_query = sa.select(ProductionLine.id).where(
+            sa.func.lower(ProductionLine.name) == EXTRUDER_LOCATION.lower()
+        ).limit(1)
         location_result = await db.execute(location_query)
         location_id = location_result.scalar_one_or_none()
 
@@ -495,21 +483,13 @@ async def generate_extruder_status(db: AsyncSession):
         active_sensors_result = await db.execute(active_sensors_query)
         active_sensors = active_sensors_result.scalar() or 0
 
-        # Получаем данные о последних показаниях
-        latest_readings_query = sa.select(
-            CurrentValues
-        ).join(
-            Sensors, CurrentValues.sensors_id == Sensors.id
-        ).where(
-            Sensors.location == location_id
-        ).order_by(
-            CurrentValues.time.desc()
-        ).limit(1)
-
-        latest_reading_result = await db.execute(latest_readings_query)
-        latest_reading = latest_reading_result.scalar_one_or_none()
+        # Время последнего показания датчиков экструдера - из памяти
+        metadata = await get_metadata()
+        latest_values = await get_latest_values()
+        sensor_ids = [meta.sensor_id for meta in metadata.values() if is_extruder(meta)]
+        timestamps = [latest.ts for latest in map(latest_values.get, sensor_ids) if latest is not None]
 
-        last_update = latest_reading.time if latest_reading else datetime.now()
+        last_update = datetime.fromtimestamp(max(timestamps)) if timestamps else datetime.now()
 
         # Определяем статус экструдера на основе имеющихся данных
         if events_count > 5:
@@ -693,43 +673,29 @@ async def websocket_sensors(websocket: WebSocket, db: AsyncSession = Depends(get
         sensors_data = []
 
         if sensors:
+            metadata = await get_metadata()
+            latest_values = await get_latest_values()
             for sensor in sensors:
-                # Получаем последние показания для датчика
-                readings_query = sa.select(CurrentValues).where(
-                    CurrentValues.sensors_id == sensor.id
-                ).order_by(
-                    CurrentValues.time.desc()
-                ).limit(1)
-
-                readings_result = await db.execute(readings_query)
-                reading = readings_result.scalars().first()
-
-                # Получаем настройки датчика
-                settings_query = sa.select(EquipmentSettings).where(
-                    EquipmentSettings.sensor_id == sensor.id
-                )
-                settings_result = await db.execute(settings_query)
-                settings = settings_result.scalars().first()
+                # Последнее показание и пределы датчика - из памяти
+                reading = latest_values.get(sensor.id)
+                meta = metadata.get(sensor.id)
 
                 # Определяем статус
                 status = "active" if sensor.active else "inactive"
-                if reading and settings:
-                    if reading.value < settings.min_value:
-                        status = "low"
-                    elif reading.value > settings.max_value:
-                        status = "high"
+                if reading is not None and reading.status != "normal":
+                    status = reading.status
 
                 sensor_dict = {
                     "id": sensor.id,
                     "name": sensor.sensor_name,
                     "status": status,
                     "location": sensor.location_name,
-                    "value": float(reading.value) if reading else 0,
+                    "value": reading.value if reading is not None else 0,
                     "unit": SENSOR_UNITS.get(sensor.sensor_name, ""),
-                    "min_value": float(settings.min_value) if settings else None,
-                    "max_value": float(settings.max_value) if settings else None,
+                    "min_value": meta.min_value if meta is not None else None,
+                    "max_value": meta.max_value if meta is not None else None,
                     "last_updated": reading.time.strftime(
-                        "%Y-%m-%d %H:%M:%S") if reading and reading.time else "Нет данных"
+                        "%Y-%m-%d %H:%M:%S") if reading is not None else "Нет данных"
                 }
 
                 sensors_data.append(sensor_dict)